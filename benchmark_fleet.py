@@ -0,0 +1,121 @@
+import argparse
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Fleet benchmark. Starts the octoprint simulator (skynet/tools/octoprint_simulator.py), registers its virtual printers as
+OctoprintConnection/Printer instances, and measures:
+ - Poller throughput: update_octoprint_status calls per second, sequential and concurrent (as celery workers do)
+ - Dispatcher latency: time taken by octoprint_task_dispatcher to send a task to every idle printer
+ - DB load: queries per poll and per dispatcher run
+Celery tasks are executed eagerly, so no broker is needed. Everything runs on a throwaway test database (test_<NAME>,
+as Django's test runner does), created at the start and destroyed at the end, so the configured database isn't touched.
+    python benchmark_fleet.py --printers 200 --workers 8
+'''
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def create_fleet(simulator, printer_profile):
+    connections = []
+    for url in simulator.urls:
+        # The pre_save hook pings the (simulated) instance
+        conn = skynet_models.OctoprintConnection.objects.create(url=url, apikey='benchmark')
+        skynet_models.Printer.objects.create(name='Benchmark {}'.format(conn.id), printer_type=printer_profile,
+                                             connection=conn)
+        connections.append(conn)
+    return connections
+
+
+def create_printer_profile():
+    config_file = ConfigurationFile.objects.create(name='Benchmark', version='0')
+    return PrinterProfile.objects.create(name='Benchmark', printer_model='Benchmark', config_name='Benchmark',
+                                         config_file=config_file, bed_shape=[200, 200, 200], config={})
+
+
+def poll_round(connections, workers):
+    if workers <= 1:
+        for conn in connections:
+            skynet_tasks.update_octoprint_status(conn.id)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(skynet_tasks.update_octoprint_status, [c.id for c in connections]))
+
+
+def benchmark_polling(connections, rounds, workers):
+    print('\nPoller throughput ({} printers)'.format(len(connections)))
+    for w in sorted(set([1, workers])):
+        durations = [timed(poll_round, connections, w)[0] for _ in range(rounds)]
+        mean = statistics.mean(durations)
+        print('  {workers:3d} worker(s): {rate:8.1f} polls/s, {latency:6.1f} ms/poll (round {mean:.2f} s)'.format(
+            workers=w, rate=len(connections) / mean, latency=1000 * mean * w / len(connections), mean=mean))
+    with CaptureQueriesContext(db_connection) as ctx:
+        skynet_tasks.update_octoprint_status(connections[0].id)
+    print('  DB queries per poll: {}'.format(len(ctx.captured_queries)))
+
+
+def benchmark_dispatcher(connections, gcode_size):
+    print('\nDispatcher latency')
+    gcode = ContentFile(b'G1 X10 Y10 E1\n' * (gcode_size // 14 + 1))
+    for conn in connections:
+        conn.create_task(file=gcode)
+    with CaptureQueriesContext(db_connection) as ctx:
+        duration, _ = timed(skynet_tasks.octoprint_task_dispatcher)
+    sent = skynet_models.OctoprintTask.objects.filter(connection__in=connections, state='printing').count()
+    print('  Dispatcher run: {:.2f} s, {} of {} jobs printing ({:.1f} ms/printer)'.format(
+        duration, sent, len(connections), 1000 * duration / len(connections)))
+    print('  DB queries per dispatcher run: {} ({:.1f}/printer)'.format(
+        len(ctx.captured_queries), len(ctx.captured_queries) / len(connections)))
+    # An idle run, where nothing is sent
+    with CaptureQueriesContext(db_connection) as ctx:
+        duration, _ = timed(skynet_tasks.octoprint_task_dispatcher)
+    print('  Idle dispatcher run: {:.2f} s, {} DB queries'.format(duration, len(ctx.captured_queries)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PoMa fleet benchmark, using the octoprint simulator')
+    parser.add_argument('--printers', type=int, default=100)
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--workers', type=int, default=8, help='Concurrent pollers')
+    parser.add_argument('--rounds', type=int, default=3, help='Polling rounds')
+    parser.add_argument('--print-duration', type=float, default=3600)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--gcode-size', type=int, default=1024 * 1024, help='Uploaded G-code size, in bytes')
+    args = parser.parse_args()
+
+    import django
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'poma2.settings')
+    django.setup()
+    from django.core.files.base import ContentFile
+    from django.db import connection as db_connection
+    from django.test.utils import CaptureQueriesContext
+    from poma2.celery import app
+    from skynet import models as skynet_models
+    from skynet import tasks as skynet_tasks
+    from skynet.tools.octoprint_simulator import OctoprintSimulator
+    from slaicer.models import PrinterProfile, ConfigurationFile
+
+    # Tasks are executed inline
+    app.conf.task_always_eager = True
+    # From here on, every connection (including the pollers threads ones) uses the test database
+    old_name = db_connection.settings_dict['NAME']
+    db_connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    simulator = OctoprintSimulator.create_fleet(args.printers, port=args.port, print_duration=args.print_duration,
+                                                failure_rate=args.failure_rate, latency=args.latency)
+    simulator.start_in_thread()
+    try:
+        duration, connections = timed(create_fleet, simulator, create_printer_profile())
+        print('Fleet of {} simulated printers registered in {:.2f} s'.format(len(connections), duration))
+        benchmark_polling(connections, args.rounds, args.workers)
+        benchmark_dispatcher(connections, args.gcode_size)
+        print('\nSimulator handled {} requests'.format(simulator.requests_count))
+    finally:
+        simulator.stop()
+        db_connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,61 @@
+import argparse
+import os
+import time
+
+'''
+Orientation benchmark. Runs Tweaker on each model in full resolution and multi-resolution modes (see
+slaicer/tools/orientation_optimization.py), and compares running time, unprintability and the chosen orientation.
+Only Tweaker-3 (slaicer/lib) is needed; the database isn't used.
+    python benchmark_orientation.py model1.stl model2.3mf --proxy-faces 20000 --candidates 5
+'''
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def angle_between(a, b):
+    # Angle (degrees) between the down vectors chosen by each mode
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    cos = np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+    return np.degrees(np.arccos(np.clip(cos, -1, 1)))
+
+
+def benchmark_model(path, proxy_faces, candidates):
+    triangles = mesh_artifact.parse_triangles(path)
+    print('\n{} ({} faces)'.format(os.path.basename(path), len(triangles)))
+    full_time, full = timed(orientation_optimization.tweak, triangles)
+    multires_time, multires = timed(orientation_optimization.tweak_multiresolution, triangles, proxy_faces, candidates)
+    print('  {:10s} {:>10s} {:>16s}'.format('mode', 'time (s)', 'unprintability'))
+    print('  {:10s} {:10.2f} {:16.4f}'.format('full', full_time, full.unprintability))
+    print('  {:10s} {:10.2f} {:16.4f}'.format('multires', multires_time, multires.unprintability))
+    print('  Speedup: {:.1f}x, orientation difference: {:.2f} deg, max matrix difference: {:.4f}'.format(
+        full_time / multires_time, angle_between(full.alignment, multires.alignment),
+        np.abs(np.asarray(full.matrix) - np.asarray(multires.matrix)).max()))
+    print('  Full matrix:     {}'.format(np.round(np.asarray(full.matrix), 4).tolist()))
+    print('  Multires matrix: {}'.format(np.round(np.asarray(multires.matrix), 4).tolist()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tweaker full resolution vs multi-resolution benchmark')
+    parser.add_argument('models', nargs='+', help='Model files (STL, OBJ, 3MF, etc)')
+    parser.add_argument('--proxy-faces', type=int, default=None, help='Proxy mesh faces (ORIENTATION_PROXY_FACES)')
+    parser.add_argument('--candidates', type=int, default=None, help='Refined candidates (ORIENTATION_CANDIDATES)')
+    args = parser.parse_args()
+
+    import django
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'poma2.settings')
+    django.setup()
+    import numpy as np
+    from django.conf import settings
+    from slaicer.tools import mesh_artifact, orientation_optimization
+
+    proxy_faces = args.proxy_faces or settings.ORIENTATION_PROXY_FACES
+    candidates = args.candidates or settings.ORIENTATION_CANDIDATES
+    # Tweaker is loaded before timing anything
+    orientation_optimization.load_tweaker_modules()
+    for path in args.models:
+        benchmark_model(path, proxy_faces, candidates)
@@ -194,6 +194,71 @@ forbidden_zone = collections.namedtuple('zone', 'start duration')
 FORBIDDEN_ZONES = [forbidden_zone(start=21, duration=12)]
 ## Send a beep to printers that are awaiting for human intervention (interval)
 BEEP_THRESHOLD_COUNT = 60000
+## Filament change duration estimation, from previous changes (per printer and material transition). Estimations are
+## cached, and computed again every FILAMENT_CHANGE_DURATION_TTL seconds. Changes confirmed after
+## FILAMENT_CHANGE_MAX_DURATION seconds are ignored (i.e., left for the next day)
+FILAMENT_CHANGE_DURATION_TTL = 3600
+FILAMENT_CHANGE_MIN_SAMPLES = 3
+FILAMENT_CHANGE_MAX_DURATION = 3600 * 4
+## Plate packing: queued copies of STL pieces that share print settings and filament are printed together, on the same
+## bed, as a single job. Up to PLATE_PACKING_MAX_PIECES copies per plate, PLATE_PACKING_SPACING mm apart, and up to
+## PLATE_PACKING_MAX_BUILD_TIME seconds per plate
+PLATE_PACKING = True
+PLATE_PACKING_SPACING = 10
+PLATE_PACKING_MAX_PIECES = 16
+PLATE_PACKING_MAX_BUILD_TIME = 3600 * 12
+
+# G-code storage. New G-code files (uploaded or sliced) are stored gzipped
+GCODE_COMPRESSION = True
+GCODE_COMPRESSION_LEVEL = 6
+## G-code without slicer estimations is analysed move by move, with this acceleration (mm/s^2) and jerk (mm/s), unless
+## the G-code sets its own acceleration (M204)
+GCODE_ANALYZER_ACCELERATION = 1000
+GCODE_ANALYZER_JERK = 10
+
+# Geometry analysis. Meshes with more than GEOMETRY_ANALYSIS_CHUNK_SIZE faces are analysed by chunks, in parallel
+GEOMETRY_ANALYSIS_WORKERS = os.cpu_count()
+GEOMETRY_ANALYSIS_CHUNK_SIZE = 250000
+## Workers running on other hosts keep a local cache of downloaded models, of up to MODEL_CACHE_MAX_SIZE bytes
+MODEL_CACHE_DIR = os.path.join(BASE_DIR, 'tmp', 'model_cache')
+MODEL_CACHE_MAX_SIZE = 2 * 1024 ** 3
+## Load Tweaker-3 when each worker process starts, instead of on the first orientation task
+TWEAKER_PRELOAD = True
+## Multi-resolution orientation: candidates are searched on a proxy of ORIENTATION_PROXY_FACES faces, and the best
+## ORIENTATION_CANDIDATES are evaluated again on the full mesh
+ORIENTATION_PROXY_FACES = 20000
+ORIENTATION_CANDIDATES = 5
+## Slicer backend: 'slic3r' (slaicer/lib/Slic3r) or 'prusaslicer' (PrusaSlicer/SuperSlicer binary, at SLICER_PATH or in
+## the PATH). Slicing tasks run on the 'slicer' queue, whose concurrency is set per host (see run_celery.sh)
+SLICER_BACKEND = 'slic3r'
+SLICER_PATH = None
+## Slicing progress (the slicer output) is reported on the task state at most once every SLICER_PROGRESS_INTERVAL seconds
+SLICER_PROGRESS_INTERVAL = 2
+
+# Fleet operations (pause/cancel all, beeps). Commands are sent to every printer concurrently
+FLEET_OPERATION_WORKERS = 32
+## Per printer timeout (seconds)
+FLEET_OPERATION_TIMEOUT = 5
+
+# OctoPrint polling
+## Status polls timeout (seconds). Polls are retried only once
+OCTOPRINT_POLL_TIMEOUT = 5
+## Circuit breaker: after this many failed polls in a row, the host is marked as down, and it's polled again after
+## OCTOPRINT_BACKOFF_BASE * 2^n seconds (n: failures since it went down), up to OCTOPRINT_MAX_BACKOFF
+OCTOPRINT_FAILURE_THRESHOLD = 3
+OCTOPRINT_BACKOFF_BASE = 4
+OCTOPRINT_MAX_BACKOFF = 300
+
+# Printer telemetry (temperatures and job progress)
+## One sample every TELEMETRY_RESOLUTION seconds. Samples are stored in chunks of TELEMETRY_CHUNK_LENGTH samples
+TELEMETRY_RESOLUTION = 30
+TELEMETRY_CHUNK_LENGTH = 120
+TELEMETRY_RETENTION_DAYS = 90
+
+# Print time correction. Slicer estimations are corrected with a linear model, fitted from successful print jobs
+PRINT_TIME_CORRECTION = True
+## Minimum print jobs needed to fit a (PrinterProfile, PrintProfile) combination
+PRINT_TIME_CORRECTION_MIN_SAMPLES = 5
 
 # Temp WooCommerce API Key
 # Test Site
@@ -32,6 +32,20 @@ def set_octoprint_dispatcher_scheduler():
                                 name='Octoprint dispatcher',
                                 task='skynet.tasks.octoprint_task_dispatcher')
 
+def set_telemetry_retention_scheduler():
+    global PeriodicTask, IntervalSchedule
+    schedule, created = IntervalSchedule.objects.get_or_create(every=1, period=IntervalSchedule.HOURS)
+    PeriodicTask.objects.create(interval=schedule,
+                                name='Telemetry retention',
+                                task='skynet.tasks.prune_telemetry')
+
+def set_print_time_correction_scheduler():
+    global PeriodicTask, IntervalSchedule
+    schedule, created = IntervalSchedule.objects.get_or_create(every=1, period=IntervalSchedule.DAYS)
+    PeriodicTask.objects.create(interval=schedule,
+                                name='Print time correction fit',
+                                task='skynet.tasks.fit_print_time_correction')
+
 def set_scheduler_keepalive():
     global PeriodicTask, IntervalSchedule
     schedule, created = IntervalSchedule.objects.get_or_create(every=10, period=IntervalSchedule.SECONDS)
@@ -125,6 +139,8 @@ if __name__ == '__main__':
     site_config(Site)
     check_for_lib()
     set_octoprint_dispatcher_scheduler()
+    set_telemetry_retention_scheduler()
+    set_print_time_correction_scheduler()
     hypercube_profiles_setup()
     prusa_profiles_setup()
     filament_setup()
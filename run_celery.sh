@@ -2,4 +2,7 @@
 
 echo "Remember to install and run rabbitmq-server before starting the celery instance"
 #celery purge -f -A poma2
+# Slicing jobs have their own worker, so a few large slices can't take every worker process. Concurrent slices on this
+# host can be set with SLICER_CONCURRENCY (default: number of CPUs)
+celery -A poma2 worker -Q slicer -c "${SLICER_CONCURRENCY:-$(nproc)}" -n slicer@%h -E -l info &
 celery -A poma2 worker -B -E -l info
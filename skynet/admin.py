@@ -1,6 +1,7 @@
 from django.contrib import admin
 from skynet.models import *
 from django.utils.html import format_html_join, format_html
+from slaicer.tools.task_results import ResolveTaskStatusAdminMixin
 
 # Register your models here.
 
@@ -57,8 +58,10 @@ class FilamentAdmin(admin.ModelAdmin):
 
 
 @admin.register(Piece)
-class PieceAdmin(admin.ModelAdmin):
+class PieceAdmin(ResolveTaskStatusAdminMixin, admin.ModelAdmin):
     list_display = ('order', 'copies',  'stl', 'build_time', 'weight')
+    list_select_related = ('quote', 'gcode')
+    task_status_lookups = (('quote', 'celery_id'), ('gcode', 'celery_id'))
 
     def build_time(self, obj):
         return obj.get_build_time()
@@ -79,10 +82,19 @@ class PieceInline(admin.TabularInline):
 
     ready.boolean = True
 
+class OrderQuoteInline(admin.StackedInline):
+    model = OrderQuote
+    extra = 0
+    fields = ('progress', 'quoted_count', 'failed_count', 'failed', 'started', 'finished', 'results')
+    readonly_fields = fields
+
+    def progress(self, obj):
+        return "{:.0%}".format(obj.progress)
+
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     list_display = ('client', 'due_date', 'priority', 'ready')
-    inlines = (PieceInline,)
+    inlines = (OrderQuoteInline, PieceInline)
 
     def ready(self, obj):
         return True if all([x.completed_pieces == x.copies for x in obj.pieces.all()]) else False
@@ -91,6 +103,7 @@ class OrderAdmin(admin.ModelAdmin):
 
 class OctoprintStatusInline(admin.StackedInline):
     model = OctoprintStatus
+    exclude = ('telemetry_buffer',)
 
 @admin.register(OctoprintConnection)
 class OctoprintConnectionAdmin(admin.ModelAdmin):
@@ -117,16 +130,13 @@ class OctoprintConnectionAdmin(admin.ModelAdmin):
 
 @admin.register(OctoprintTask)
 class OctoprintTaskAdmin(admin.ModelAdmin):
-    list_display = ('connection', 'type', 'file', 'job_sent', 'ready', 'awaiting_for_human_intervention')
+    list_display = ('connection', 'type', 'file', 'state', 'job_sent', 'ready', 'awaiting_for_human_intervention')
+    list_filter = ('state',)
     actions = ['cancel_tasks']
 
     def cancel_tasks(self, request, queryset):
-        queryset.update(cancelled=True)
-        for o in queryset:
-            if hasattr(o, 'print_job'):
-                self.active_task.print_job.success = False
-                self.active_task.print_job.save()
-        self.message_user(request, "{} successfully cancelled".format(queryset.count()))
+        cancelled = len([o for o in queryset if o.cancel()])
+        self.message_user(request, "{} successfully cancelled".format(cancelled))
 
     cancel_tasks.short_description = "Cancel tasks"
 
@@ -152,7 +162,7 @@ class PrinterAdmin(admin.ModelAdmin):
 
 @admin.register(FilamentChange)
 class FilamentChangeAdmin(admin.ModelAdmin):
-    list_display = ('id', 'new_filament', 'confirmed', 'printer')
+    list_display = ('id', 'old_filament', 'new_filament', 'confirmed', 'printer')
     actions = ['confirm_change']
 
     def printer(self, obj):
@@ -186,8 +196,14 @@ class PrintJobAdmin(admin.ModelAdmin):
 
 
 @admin.register(Schedule)
-class ScheduleAdmin(admin.ModelAdmin):
-    list_display = ('id', 'created', 'launched_tasks_count', 'processing_time', 'status')
+class ScheduleAdmin(ResolveTaskStatusAdminMixin, admin.ModelAdmin):
+    list_display = ('id', 'created', 'launched_tasks_count', 'processing_time', 'status', 'ready')
+    task_status_lookups = (('', 'celery_id'), ('', 'dispatcher_celery_id'))
+
+    def ready(self, obj):
+        return obj.ready()
+
+    ready.boolean = True
     readonly_fields = ('print_schedule_disp',)
 
     def launched_tasks_count(self, obj):
@@ -212,3 +228,8 @@ class ScheduleEntryAdmin(admin.ModelAdmin):
     list_display = ('id', 'schedule', 'start')
     sortable_by = ('start',)
 
+
+
+@admin.register(PrintTimeCorrection)
+class PrintTimeCorrectionAdmin(admin.ModelAdmin):
+    list_display = ('printer_profile', 'print_profile', 'slope', 'intercept', 'samples', 'updated')
@@ -12,14 +12,27 @@ import json
 from django.core.exceptions import ValidationError
 from django.core.files import File
 import random, string
+import os
 import traceback
 from django_celery_beat.models import PeriodicTask, IntervalSchedule
 from datetime import timedelta
 from slaicer.models import *
-from skynet.tasks import quote_gcode
+from skynet.tasks import quote_gcode, record_piece_quote, finish_order_quote
 from django.core.files.base import ContentFile
+from django.db.models.fields.files import FieldFile
+from skynet.tools.gcode_upload import MultipartGcodeStream
+from skynet.tools import telemetry, print_time_correction
+from django.db import transaction
+from django.db.models import F, Sum, Count, ExpressionWrapper
+from django.core.cache import cache
+import collections
+import math
+from django.contrib.postgres.fields import JSONField, ArrayField
+from slaicer.tools import gcode_storage
+from slaicer.tools.task_results import task_ready, TaskStatusMixin
 from django_celery_results.models import TaskResult
-from celery import states
+from celery import states, group, chord
+from celery.utils import uuid
 import pytz
 urllib3.disable_warnings()
 
@@ -111,8 +124,8 @@ OctoprintConnection handles API endpoints with octoprint
 
 class FilamentChangeManager(models.Manager):
     def issue_change(self, new_filament, connection):
-        o = self.create(new_filament=new_filament)
         old_filament = connection.printer.filament
+        o = self.create(new_filament=new_filament, old_filament=old_filament)
         gcode = "M104 S{nozzle_temp} \nM140 S{bed_temp} \n M117 {color}-{material}-{brand}".format(
             bed_temp=max(new_filament.get_bed_temperature(), old_filament.get_bed_temperature()),
             nozzle_temp=max(new_filament.get_nozzle_temperature(), old_filament.get_nozzle_temperature()),
@@ -129,9 +142,42 @@ class FilamentChangeManager(models.Manager):
         p_task = connection.create_task(commands=commands, file=file, slicejob=slicejob, dependency=cf_task.task)
         return cf_task
 
+    def _durations(self):
+        # Mean duration (seconds) and count of confirmed changes, for each (printer, old material, new material)
+        duration = ExpressionWrapper(F('confirmed_date') - F('created'), output_field=models.DurationField())
+        rows = self.filter(confirmed=True, confirmed_date__isnull=False).annotate(duration=duration).filter(
+            duration__lt=timedelta(seconds=settings.FILAMENT_CHANGE_MAX_DURATION)).values_list(
+            'task__connection__printer', 'old_filament__material', 'new_filament__material').annotate(
+            total=Sum('duration'), count=Count('id'))
+        # Rollups: None stands for any printer / material
+        stats = collections.defaultdict(lambda: [0, 0])
+        for printer, old, new, total, count in rows:
+            for key in [(printer, old, new), (printer, None, None), (None, old, new), (None, None, None)]:
+                stats[key][0] += total.total_seconds()
+                stats[key][1] += count
+        return {k: (v[0] / v[1], v[1]) for k, v in stats.items()}
+
+    def durations(self):
+        # Cached, so it can be called on every estimation. It's computed again every FILAMENT_CHANGE_DURATION_TTL seconds
+        stats = cache.get('filament_change_durations')
+        if stats is None:
+            stats = self._durations()
+            cache.set('filament_change_durations', stats, settings.FILAMENT_CHANGE_DURATION_TTL)
+        return stats
+
+    def mean_duration(self, printer_id=None, old_material_id=None, new_material_id=None):
+        # From the most specific estimation to the global one. Without enough data, we assume 15 minutes
+        stats = self.durations()
+        for key in [(printer_id, old_material_id, new_material_id), (printer_id, None, None),
+                    (None, old_material_id, new_material_id), (None, None, None)]:
+            if key in stats and stats[key][1] >= settings.FILAMENT_CHANGE_MIN_SAMPLES:
+                return stats[key][0]
+        return 15 * 60
+
 
 class FilamentChange(models.Model):
     new_filament = models.ForeignKey(Filament, on_delete=models.CASCADE)
+    old_filament = models.ForeignKey(Filament, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
     task = models.OneToOneField('OctoprintTask', on_delete=models.CASCADE, related_name='filament_change', null=True)
     confirmed = models.BooleanField(default=False)
     created = models.DateTimeField(default=timezone.now)
@@ -141,8 +187,14 @@ class FilamentChange(models.Model):
 
     @staticmethod
     def filament_change_mean_duration():
-        # Time that takes a filament change. The idea es to calculate this automatically, based on previous events
-        return 15 * 60
+        # Time that takes a filament change, based on previous events
+        return FilamentChange.objects.mean_duration()
+
+    def expected_duration(self):
+        printer = self.get_printer()
+        return FilamentChange.objects.mean_duration(printer.id,
+                                                    self.old_filament.material_id if self.old_filament is not None else None,
+                                                    self.new_filament.material_id)
 
     def get_printer(self):
         return self.task.connection.printer
@@ -157,17 +209,29 @@ def update_printer_filament_on_confirmation(sender, update_fields, instance, cre
         printer.save()
         instance.confirmed_date = timezone.now()
         instance.save(update_fields=['confirmed_date'])
+        instance.task.human_intervention_done()
 
 
 class OctoprintTaskManager(models.Manager):
+    def dispatchable(self):
+        # Pending tasks, whose dependency (if any) is done
+        return self.filter(state='pending', celery_id=None).filter(
+            models.Q(dependency=None) | models.Q(dependency__state='done'))
+
     def create_task(self, connection, commands=None, file=None, slicejob=None, dependency=None):
         # It's a valid task?
         if len([x for x in [slicejob, commands, file] if x is not None]) != 1:
             raise ValidationError("Please specify a command or a file or a slicejob")
         if file is not None:
-            file_name = ''.join(random.choices(string.ascii_uppercase + string.digits, k=10)) + '.gcode'
             o = self.create(type='job', connection=connection, dependency=dependency)
-            o.file.save(file_name, file)
+            if isinstance(file, FieldFile):
+                # The file is already stored (i.e., a Gcode print_file), so we reference it instead of copying it
+                o.file.name = file.name
+                o.gcode_size = getattr(file.instance, 'gcode_size', None)
+                o.save(update_fields=['file', 'gcode_size'])
+            else:
+                file_name = ''.join(random.choices(string.ascii_uppercase + string.digits, k=10)) + '.gcode'
+                o.file.save(file_name, file)
         elif commands is not None:
             # So, it's a command task. Before, we check if the object received is a file, or just a string
             if hasattr(commands, 'open'):
@@ -182,25 +246,75 @@ class OctoprintTask(models.Model):
     task_types = (('command', 'Command'),
                   ('job', 'Print job'),
                   ('slice-and-print-job', 'Slice and print job'))
+    # Task life cycle: pending -> (slicing) -> uploading -> printing -> (awaiting_human) -> done. Any unfinished
+    # task can be cancelled
+    task_states = (('pending', 'Pending'),
+                   ('slicing', 'Slicing'),
+                   ('uploading', 'Uploading'),
+                   ('printing', 'Printing'),
+                   ('awaiting_human', 'Awaiting for human intervention'),
+                   ('done', 'Done'),
+                   ('cancelled', 'Cancelled'))
+    # The printer is free on ready states. Finished states are final
+    ready_states = ('awaiting_human', 'done', 'cancelled')
+    finished_states = ('done', 'cancelled')
     celery_id = models.CharField(max_length=200, null=True)
     connection = models.ForeignKey('OctoprintConnection', on_delete=models.CASCADE, related_name='tasks')
     type = models.CharField(choices=task_types, default='job', max_length=200)
     # Accepts multiple commands, separated each one with a newline ('\n')
     commands = models.TextField(null=True)
     file = models.FileField(null=True)
+    # Decompressed file size, if it's a compressed Gcode print_file (see gcode_storage)
+    gcode_size = models.BigIntegerField(null=True, blank=True)
     slicejob = models.ForeignKey('slaicer.SliceJob', null=True, on_delete=models.SET_NULL, blank=True)
     # Used to track task status
+    state = models.CharField(choices=task_states, default='pending', max_length=50, db_index=True)
     job_sent = models.BooleanField(default=False)
     job_filename = models.CharField(max_length=300, null=True)
-    cancelled = models.BooleanField(default=False)
     # We support task dependency (something similar to celery chains)
     dependency = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE, related_name='dependencies')
+    # Actual print duration, used to correct print time estimations (see PrintTimeCorrection)
+    print_started = models.DateTimeField(null=True, blank=True)
+    print_finished = models.DateTimeField(null=True, blank=True)
     objects = OctoprintTaskManager()
 
+    def transition(self, state):
+        # Finished states are final, so we never leave them (i.e., a cancelled task stays cancelled)
+        now = timezone.now()
+        fields = {'print_started': now} if state == 'printing' else {}
+        updated = OctoprintTask.objects.filter(pk=self.pk).exclude(state__in=self.finished_states).update(state=state, **fields)
+        if updated:
+            self.state = state
+            if state in ('awaiting_human', 'done'):
+                # The print is over (only recorded the first time)
+                OctoprintTask.objects.filter(pk=self.pk, print_started__isnull=False, print_finished=None).update(print_finished=now)
+        return bool(updated)
+
+    def cancel(self):
+        if not self.transition('cancelled'):
+            return False
+        # If we have a print job, we set the result
+        if hasattr(self, 'print_job'):
+            self.print_job.success = False
+            self.print_job.save()
+        # Tasks that depend on this one can't be executed anymore
+        for t in self.dependencies.exclude(state__in=self.finished_states):
+            t.cancel()
+        return True
+
+    def human_intervention_done(self):
+        # Called when a filament change or a print job result is confirmed
+        if self.state == 'awaiting_human' and not self.human_intervention_required:
+            return self.transition('done')
+        return False
 
     @property
     def status(self):
-        return 'PENDING' if self.celery_id is None else TaskResult.objects.filter(task_id=self.celery_id).last().status
+        return self.state
+
+    @property
+    def cancelled(self):
+        return self.state == 'cancelled'
 
     @property
     def slice_job_ready(self):
@@ -211,28 +325,23 @@ class OctoprintTask(models.Model):
 
     @property
     def ready(self):
-        if self.cancelled:
-            return True
-        if not self.slice_job_ready:
-            return False
-        if self.celery_id is None:
-            return False
-        else:
-            return False if not TaskResult.objects.filter(
-                task_id=self.celery_id).exists() else TaskResult.objects.filter(
-                task_id=self.celery_id).first().status in states.READY_STATES
+        return self.state in self.ready_states
 
     @property
-    def awaiting_for_human_intervention(self):
+    def human_intervention_required(self):
         if hasattr(self, 'filament_change'):
             return not self.filament_change.confirmed
         if hasattr(self, 'print_job'):
-            return self.print_job.awaiting_for_bed_removal
+            return self.print_job.success is None
         return False
 
+    @property
+    def awaiting_for_human_intervention(self):
+        return self.state == 'awaiting_human'
+
     @property
     def finished(self):
-        return self.ready and not self.awaiting_for_human_intervention
+        return self.state in self.finished_states
 
     @property
     def time_left(self):
@@ -240,7 +349,7 @@ class OctoprintTask(models.Model):
         if not self.slice_job_ready:
             self.slicejob.get_estimated_build_time()
         if hasattr(self, 'filament_change'):
-            return FilamentChange.filament_change_mean_duration()
+            return self.filament_change.expected_duration()
         if hasattr(self, 'print_job'):
             if self.print_job.awaiting_for_bed_removal:
                 return 60 * 15
@@ -254,7 +363,8 @@ class OctoprintTask(models.Model):
 
     @property
     def dependencies_ready(self):
-        return (self.dependency.dependencies_ready and self.dependency.finished) if self.dependency is not None else True
+        # A dependency can only be done if its own dependencies were done before
+        return self.dependency.state == 'done' if self.dependency is not None else True
 
     def get_file(self):
         if self.type == 'job':
@@ -262,11 +372,16 @@ class OctoprintTask(models.Model):
         else:
             return self.slicejob.gcode
 
+    def get_gcode_size(self):
+        # Decompressed size of get_file, if it was stored. Otherwise, it's read from the file (see gcode_storage)
+        return self.gcode_size if self.type == 'job' else self.slicejob.gcode_size
+
 
 class OctoprintJobStatus(models.Model):
     name = models.CharField(max_length=300, null=True)
     estimated_print_time = models.IntegerField(null=True)
     estimated_print_time_left = models.IntegerField(null=True)
+    completion = models.FloatField(null=True)
 
 
 class OctoprintTemperature(models.Model):
@@ -288,6 +403,12 @@ class OctoprintStatus(models.Model):
     sdReady = models.BooleanField(default=False)
     connectionError = models.BooleanField(default=False)
     printCancelled = models.BooleanField(default=False)
+    # Circuit breaker. After OCTOPRINT_FAILURE_THRESHOLD failed polls, the host is considered down, and it's only
+    # polled again after retry_after (exponential backoff)
+    consecutive_failures = models.IntegerField(default=0)
+    retry_after = models.DateTimeField(null=True, blank=True)
+    # Telemetry samples not yet written to a TelemetryChunk (see skynet/tools/telemetry.py)
+    telemetry_buffer = JSONField(default=list, blank=True)
     last_update = models.DateTimeField(auto_now=True)
     temperature = models.OneToOneField(OctoprintTemperature, on_delete=models.CASCADE, null=True)
     job = models.OneToOneField(OctoprintJobStatus, on_delete=models.CASCADE, null=True)
@@ -301,6 +422,39 @@ class OctoprintStatus(models.Model):
     def instance_ready(self):
         return self.ready and not self.printer_disabled
 
+    @property
+    def host_down(self):
+        return self.consecutive_failures >= settings.OCTOPRINT_FAILURE_THRESHOLD
+
+    @property
+    def circuit_open(self):
+        return self.host_down and self.retry_after is not None and self.retry_after > timezone.now()
+
+    def record_telemetry(self):
+        # Called on each poll, but only one sample per TELEMETRY_RESOLUTION seconds is stored
+        values = {'tool': self.temperature.tool, 'bed': self.temperature.bed, 'completion': self.job.completion,
+                  'print_time_left': self.job.estimated_print_time_left}
+        if not telemetry.append_sample(self.telemetry_buffer, timezone.now(), values, settings.TELEMETRY_RESOLUTION):
+            return False
+        chunk = telemetry.pop_chunk(self.telemetry_buffer, settings.TELEMETRY_CHUNK_LENGTH)
+        if chunk is not None:
+            start, arrays = chunk
+            TelemetryChunk.objects.create(connection=self.connection, resolution=settings.TELEMETRY_RESOLUTION,
+                                          start=telemetry.slot_datetime(start, settings.TELEMETRY_RESOLUTION),
+                                          **arrays)
+        OctoprintStatus.objects.filter(pk=self.pk).update(telemetry_buffer=self.telemetry_buffer)
+        return True
+
+    def record_failure(self):
+        self.connectionError = True
+        self.consecutive_failures += 1
+        if self.host_down:
+            exponent = min(self.consecutive_failures - settings.OCTOPRINT_FAILURE_THRESHOLD, 16)
+            backoff = min(settings.OCTOPRINT_BACKOFF_BASE * 2 ** exponent, settings.OCTOPRINT_MAX_BACKOFF)
+            self.retry_after = timezone.now() + timedelta(seconds=backoff)
+        # Only the failure fields: a whole row save would overwrite telemetry_buffer (see record_telemetry)
+        self.save(update_fields=['connectionError', 'consecutive_failures', 'retry_after'])
+
 
 
 
@@ -318,7 +472,10 @@ class OctoprintConnection(models.Model):
         return self.url
 
     @staticmethod
-    def _get_connection_pool():
+    def _get_connection_pool(timeout=None):
+        if timeout is not None:
+            # Fleet operations: a single retry, and the whole request bounded by timeout (seconds)
+            return PoolManager(retries=Retry(total=1, read=0, backoff_factor=0), timeout=Timeout(total=timeout))
         retry_policy = Retry(total=20, status_forcelist=list(range(405, 501)), connect=10, read=10, backoff_factor=0.2)
         timeout_policy = Timeout(read=50, connect=20)
         return PoolManager(retries=retry_policy, timeout=timeout_policy)
@@ -329,9 +486,9 @@ class OctoprintConnection(models.Model):
         else:
             return {'x-api-key': self.apikey}
 
-    def _issue_command(self, commands: str):
+    def _issue_command(self, commands: str, timeout=None):
         fields = {'commands': commands.split('\n')}
-        r = self._get_connection_pool().request('POST', urljoin(self.url, 'api/printer/command'),
+        r = self._get_connection_pool(timeout).request('POST', urljoin(self.url, 'api/printer/command'),
                                                 headers=self._get_connection_headers(),
                                                 body=json.dumps(fields).encode('utf-8'))
         if r.status == 204:
@@ -339,29 +496,47 @@ class OctoprintConnection(models.Model):
         else:
             raise MaxRetryError("Error sending command to instance")
 
-    def _print_file(self, file: File):
-        # Accepts Django File or ContentFile class
+    def _print_file(self, file: File, gcode_size=None):
+        # Accepts Django File or ContentFile class. gcode_size: decompressed size, if known
         file_name = ''.join(
-            random.choices(string.ascii_uppercase + string.digits, k=10)) + '.gcode' if file.name is None else file.name
-        with file.open('r') as f:
-            # We add a M400 command at the end of the file, so, we avoid problems due marlin gcode cache
-            file_content = f.read() + '\nM400 \nM115'
-            r = json.loads(self._get_connection_pool().request('POST', urljoin(self.url, 'api/files/local'),
-                                                               headers=self._get_connection_headers(json_content=False),
-                                                               fields={'print': True,
-                                                                       'file': (file_name, file_content)}).data.decode(
-                'utf-8'))
+            random.choices(string.ascii_uppercase + string.digits, k=10)) + '.gcode' if file.name is None else gcode_storage.plain_name(os.path.basename(file.name))
+        # The file is streamed from disk while we send the request (M400 trailer included), so we don't load it in memory
+        body = MultipartGcodeStream(file, file_name, fields={'print': 'true'}, gcode_size=gcode_size)
+        try:
+            r = json.loads(self._get_connection_pool().urlopen('POST', urljoin(self.url, 'api/files/local'),
+                                                               headers={**self._get_connection_headers(json_content=False),
+                                                                        **body.headers},
+                                                               body=body).data.decode('utf-8'))
+        finally:
+            body.close()
 
         if r.get('done'):
             return file_name
         else:
             raise MaxRetryError("Error sending command to instance")
 
-    def _cancel_octoprint_task(self):
-        fields = {'command': 'cancel'}
-        r = self._get_connection_pool().request('POST', urljoin(self.url, 'api/job'),
-                                                headers=self._get_connection_headers(),
-                                                body=json.dumps(fields).encode('utf-8'))
+    def _job_command(self, fields, timeout=None):
+        r = self._get_connection_pool(timeout).request('POST', urljoin(self.url, 'api/job'),
+                                                       headers=self._get_connection_headers(),
+                                                       body=json.dumps(fields).encode('utf-8'))
+        # 409: there is no job to cancel/pause
+        return r.status == 204
+
+    def _cancel_octoprint_task(self, timeout=None):
+        return self._job_command({'command': 'cancel'}, timeout)
+
+    def _pause_octoprint_task(self, action='pause', timeout=None):
+        # action can be pause, resume or toggle
+        return self._job_command({'command': 'pause', 'action': action}, timeout)
+
+    def _reconnect(self, timeout=None):
+        statuses = []
+        for command in ['disconnect', 'connect']:
+            r = self._get_connection_pool(timeout).request('POST', urljoin(self.url, 'api/connection'),
+                                                           headers=self._get_connection_headers(),
+                                                           body=json.dumps({'command': command}).encode('utf-8'))
+            statuses.append(r.status)
+        return all(s == 204 for s in statuses)
 
     @property
     def connection_ready(self):
@@ -400,20 +575,24 @@ class OctoprintConnection(models.Model):
             return False
 
     def update_status(self):
+        # Polls use short timeouts and a single retry, so a dead host doesn't hold a worker
+        pool = self._get_connection_pool(settings.OCTOPRINT_POLL_TIMEOUT)
         try:
             # Connection status
-            r = json.loads(self._get_connection_pool().request('GET', urljoin(self.url, 'api/connection'),
-                                                    headers=self._get_connection_headers()).data.decode(
-                'utf-8'))
+            r = json.loads(pool.request('GET', urljoin(self.url, 'api/connection'),
+                                        headers=self._get_connection_headers()).data.decode('utf-8'))
             if r['current']['state'] in ["Closed"]:
+                # The host is reachable, but the printer isn't connected to it
                 self.status.connectionError = True
-                self.status.save()
+                self.status.consecutive_failures = 0
+                self.status.retry_after = None
+                self.status.save(update_fields=['connectionError', 'consecutive_failures', 'retry_after'])
                 return False
             # Instance status
-            r = json.loads(self._get_connection_pool().request('GET', urljoin(self.url, 'api/printer'),
-                                                               headers=self._get_connection_headers()).data.decode(
-                'utf-8'))
-            OctoprintStatus.objects.filter(connection=self).update(**r['state']['flags'], connectionError=False)
+            r = json.loads(pool.request('GET', urljoin(self.url, 'api/printer'),
+                                        headers=self._get_connection_headers()).data.decode('utf-8'))
+            OctoprintStatus.objects.filter(connection=self).update(**r['state']['flags'], connectionError=False,
+                                                                   consecutive_failures=0, retry_after=None)
             self.refresh_from_db()
             if 'temperature' in r.keys():
                 self.status.temperature.tool = r['temperature'].get('tool0')['actual'] if r['temperature'].get(
@@ -422,21 +601,47 @@ class OctoprintConnection(models.Model):
                     'bed') is not None else None
                 self.status.temperature.save()
             # Job status
-            r = json.loads(self._get_connection_pool().request('GET', urljoin(self.url, 'api/job'),
-                                                               headers=self._get_connection_headers()).data.decode(
-                'utf-8'))
+            r = json.loads(pool.request('GET', urljoin(self.url, 'api/job'),
+                                        headers=self._get_connection_headers()).data.decode('utf-8'))
             self.status.job.name = r['job']['file']['name']
             self.status.job.estimated_print_time = r['job']['estimatedPrintTime']
             if self.status.printing:
                 self.status.job.estimated_print_time_left = r['progress']['printTimeLeft']
+            self.status.job.completion = r['progress'].get('completion')
             self.status.job.save()
         except:
-            self.status.connectionError = True
-            self.status.save()
+            self.status.record_failure()
+        else:
+            self.status.record_telemetry()
 
     def get_status(self):
         return self.status
 
+    def telemetry_series(self, since=None):
+        # (datetime, tool, bed, completion, print_time_left) tuples. Stored chunks, plus the samples still on the buffer
+        chunks = self.telemetry_chunks.order_by('start')
+        if since is not None:
+            chunks = chunks.filter(start__gte=since - timedelta(seconds=settings.TELEMETRY_RESOLUTION * settings.TELEMETRY_CHUNK_LENGTH))
+        for chunk in chunks:
+            yield from (s for s in chunk.samples() if since is None or s[0] >= since)
+        yield from (s for s in telemetry.buffer_series(self.status.telemetry_buffer, settings.TELEMETRY_RESOLUTION)
+                    if since is None or s[0] >= since)
+
+    def check_job_completion(self):
+        # Called after each status update. Marks the active print job as finished, once octoprint stops printing it
+        task = self.active_task
+        if task is None or task.state != 'printing':
+            return False
+        if self.status.connectionError:
+            return False
+        if not task.job_filename.split('/')[-1] == self.status.job.name:
+            # Printer was manually controlled, so, we lost job tracking
+            self.cancel_active_task(notify_octoprint=False)
+            return False
+        if self.status.printing or self.status.paused:
+            return False
+        return task.transition('awaiting_human' if task.human_intervention_required else 'done')
+
     def create_task(self, commands=None, file=None, slicejob=None, dependency=None):
         # Accepts a string, ContentFile, or slicejob instance
         return OctoprintTask.objects.create_task(self, commands=commands, file=file, slicejob=slicejob, dependency=dependency)
@@ -444,14 +649,9 @@ class OctoprintConnection(models.Model):
     def cancel_active_task(self, notify_octoprint=True):
         # Disable the printer
         self.status.printCancelled = True
-        self.status.save()
+        self.status.save(update_fields=['printCancelled'])
         if self.active_task is not None:
-            self.active_task.cancelled = True
-            self.active_task.save()
-            # If we have an active print job, we set the result
-            if hasattr(self.active_task, 'print_job'):
-                self.active_task.print_job.success = False
-                self.active_task.print_job.save()
+            self.active_task.cancel()
         # We cancel the job on octoprint
         if notify_octoprint:
            self._cancel_octoprint_task()
@@ -461,18 +661,16 @@ class OctoprintConnection(models.Model):
     def reset_connection(self):
         # If there is an ongoing task, we cancel it
         self.cancel_active_task()
-        fields = {'command': 'disconnect'}
-        r = self._get_connection_pool().request('POST', urljoin(self.url, 'api/connection'),
-                                                headers=self._get_connection_headers(),
-                                                body=json.dumps(fields).encode('utf-8'))
-        fields = {'command': 'connect'}
-        r = self._get_connection_pool().request('POST', urljoin(self.url, 'api/connection'),
-                                                headers=self._get_connection_headers(),
-                                                body=json.dumps(fields).encode('utf-8'))
+        self._reconnect()
+        self.reset_status()
+
+    def reset_status(self):
         # We reset the status for the printer
         self.status.printCancelled = False
         self.status.connectionError = False
-        self.status.save()
+        self.status.consecutive_failures = 0
+        self.status.retry_after = None
+        self.status.save(update_fields=['printCancelled', 'connectionError', 'consecutive_failures', 'retry_after'])
 
 
 
@@ -499,6 +697,26 @@ def create_octoprint_state(sender, instance, created, **kwargs):
                                     kwargs=json.dumps({'conn_id': instance.id}))
 
 
+class TelemetryChunk(models.Model):
+    # TELEMETRY_CHUNK_LENGTH samples of a printer, starting at start, one every resolution seconds (None: no sample)
+    connection = models.ForeignKey(OctoprintConnection, on_delete=models.CASCADE, related_name='telemetry_chunks')
+    start = models.DateTimeField(db_index=True)
+    resolution = models.IntegerField()
+    tool = ArrayField(models.FloatField(null=True))
+    bed = ArrayField(models.FloatField(null=True))
+    completion = ArrayField(models.FloatField(null=True))
+    print_time_left = ArrayField(models.IntegerField(null=True))
+
+    class Meta:
+        index_together = [('connection', 'start')]
+
+    def samples(self):
+        # (datetime, tool, bed, completion, print_time_left) tuples
+        for i, values in enumerate(zip(self.tool, self.bed, self.completion, self.print_time_left)):
+            if any(v is not None for v in values):
+                yield (self.start + timedelta(seconds=i * self.resolution),) + values
+
+
 '''
 Printers models definitions
 '''
@@ -553,13 +771,15 @@ Orders models definitions
 
 
 # Ready to print GCODE Model
-class Gcode(models.Model):
+class Gcode(TaskStatusMixin, models.Model):
     print_file = models.FileField(upload_to='gcode/')
     printer_type = models.ForeignKey('slaicer.PrinterProfile', on_delete=models.SET_NULL, null=True)
     material = models.ForeignKey(Material, on_delete=models.SET_NULL, null=True)
     build_time = models.FloatField(default=None, blank=True, null=True)
     weight = models.FloatField(default=None, blank=True, null=True)
     celery_id = models.CharField(max_length=200, null=True, blank=True)
+    # Decompressed print_file size (see gcode_storage)
+    gcode_size = models.BigIntegerField(null=True, blank=True)
 
     def __str__(self):
         if self.print_file is not None:
@@ -570,8 +790,19 @@ class Gcode(models.Model):
     def ready(self):
         if self.build_time is not None:
             return True
-        return False if not TaskResult.objects.filter(task_id=self.celery_id).exists() else TaskResult.objects.filter(
-            task_id=self.celery_id).first().status in states.READY_STATES
+        return task_ready(self)
+
+
+@receiver(pre_save, sender=Gcode)
+def compress_gcode_on_upload(sender, instance, update_fields, **kwargs):
+    # New uploads are stored compressed. Reading is transparent (see slaicer.tools.gcode_storage)
+    if not gcode_storage.compression_enabled() or not instance.print_file or instance.print_file._committed:
+        return None
+    if instance.print_file.name.endswith(gcode_storage.GZIP_EXTENSION):
+        return None
+    instance.print_file.seek(0)
+    instance.print_file = gcode_storage.compress_gcode(instance.print_file, instance.print_file.name)
+    instance.gcode_size = instance.print_file.gcode_size
 
 
 # Order Models
@@ -604,6 +835,9 @@ class Piece(models.Model):
     # Used to track slaicer results, filled automatically
     auto_print_profile = models.BooleanField(default=True)
     auto_support = models.BooleanField(default=True)
+    # Set it before creating the piece to skip its own quoting tasks, if it's going to be quoted with its order (see
+    # OrderQuote). It's not a field
+    defer_quoting = False
     # Used to indicate wether the piece was created by a woocommerce order o not
     #woocommerce_component = models.ForeignKey('wc_liaison.Component', on_delete=models.SET_NULL, null=True, blank=True)
 
@@ -624,6 +858,9 @@ class Piece(models.Model):
 
     def quote_ready(self):
         if self.stl is not None:
+            # Pieces quoted with their order (defer_quoting) don't have a quote until the order quoting starts
+            if self.quote is None:
+                return False
             if self.quote.ready():
                 # We try to access the build time
                 if self.quote.build_time is not None:
@@ -648,6 +885,20 @@ class Piece(models.Model):
         else:
             return self.gcode.build_time
 
+    def get_print_profiles(self):
+        # (PrinterProfile id, PrintProfile id) used to estimate the build time
+        if self.stl is not None:
+            profile = getattr(self.quote, 'profile', None)
+            return (profile.printer_id, profile.print_id) if profile is not None else (None, None)
+        else:
+            return self.gcode.printer_type_id, None
+
+    def get_corrected_build_time(self, corrections=None):
+        build_time = self.get_build_time()
+        if build_time is None:
+            return None
+        return PrintTimeCorrection.objects.correct(build_time, *self.get_print_profiles(), corrections=corrections)
+
     def get_weight(self):
         if not self.quote_ready():
             return None
@@ -656,6 +907,17 @@ class Piece(models.Model):
         else:
             return self.gcode.weight
 
+    def quoting_signature(self, wait_for_models=True):
+        # Quoting task of the piece, not launched yet. Its model must be analysed first (see OrderQuoteManager)
+        if self.stl is not None:
+            self.quote = SliceJob.objects.quote_object(self.stl, launch=False)
+            self.save(update_fields=['quote'])
+            return self.quote.task_signature(wait_for_models=wait_for_models)
+        signature = quote_gcode.si(self.id).set(task_id=uuid())
+        self.gcode.celery_id = signature.id
+        self.gcode.save(update_fields=['celery_id'])
+        return signature
+
     def check_for_filament_compatibility(self, filament):
         return filament.color in self.colors.all() and filament.material in self.materials.all()
 
@@ -681,7 +943,7 @@ def validate_piece(sender, instance, update_fields, **kwargs):
 @receiver(post_save, sender=Piece)
 def launch_piece_quoting_tasks(sender, instance, created, **kwargs):
     # We start quoting tasks
-    if created:
+    if created and not instance.defer_quoting:
         if instance.stl is not None:
             instance.stl.create_orientation_result()
             instance.stl.create_geometry_result()
@@ -692,6 +954,99 @@ def launch_piece_quoting_tasks(sender, instance, created, **kwargs):
             instance.gcode.save(update_fields=['celery_id'])
 
 
+'''
+Order quoting. Every piece of an order is quoted on a single celery workflow (a chord): the orientation and geometry
+analysis of each model run in parallel, and its pieces are sliced (in parallel too) as soon as both finish, so slicing
+tasks don't have to poll for them (ModelNotReady retries). Progress and per piece results are recorded on the order
+OrderQuote. Pieces whose analysis or quoting task raises are recorded as failed, by an error callback
+'''
+
+
+class OrderQuoteManager(models.Manager):
+    def quote_order(self, order, pieces=None):
+        pieces = list(order.pieces.filter(cancelled=False).select_related('stl', 'gcode') if pieces is None else pieces)
+        order_quote, created = self.update_or_create(order=order, defaults={
+            'pieces_count': len(pieces), 'quoted_count': 0, 'failed_count': 0, 'results': {}, 'failed': False,
+            'started': timezone.now(), 'finished': None})
+        workflows = []
+        # Pieces that share a model are sliced after a single analysis of it
+        pieces_by_model = collections.defaultdict(list)
+        for piece in pieces:
+            if piece.stl is not None:
+                pieces_by_model[piece.stl].append(piece)
+            else:
+                workflows.append(order_quote.piece_workflow(piece))
+        for model, model_pieces in pieces_by_model.items():
+            orientation, geometry = model.orientation_signature(), model.geometry_signature()
+            analysis = [s for s in (orientation, geometry) if s is not None]
+            # Results created before (i.e., by another order) might still be running. Only then, slicing polls for them
+            wait_for_models = (orientation is None and model.orientation_req and not model.orientation_result_ready) or \
+                              (geometry is None and model.geometry_req and not model.geometry_result_ready)
+            slicing = group([order_quote.piece_workflow(p, wait_for_models) for p in model_pieces])
+            for signature in analysis:
+                # If the analysis fails, its pieces are never sliced
+                for p in model_pieces:
+                    signature.link_error(record_piece_quote.si(False, order_quote.id, p.id))
+            workflows.append(group(analysis) | slicing if analysis else slicing)
+        if not workflows:
+            order_quote.finished = timezone.now()
+            order_quote.save(update_fields=['finished'])
+            return order_quote
+        callback = finish_order_quote.si(order_quote.id)
+        callback.on_error(finish_order_quote.si(order_quote.id, failed=True))
+        order_quote.celery_id = chord(workflows)(callback).id
+        order_quote.save(update_fields=['celery_id'])
+        return order_quote
+
+
+class OrderQuote(models.Model):
+    order = models.OneToOneField(Order, on_delete=models.CASCADE, related_name='quote')
+    celery_id = models.CharField(max_length=200, null=True, blank=True)
+    started = models.DateTimeField(default=timezone.now)
+    finished = models.DateTimeField(null=True, blank=True)
+    pieces_count = models.IntegerField(default=0)
+    quoted_count = models.IntegerField(default=0)
+    failed_count = models.IntegerField(default=0)
+    # Some task of the workflow raised an exception
+    failed = models.BooleanField(default=False)
+    # Build time and weight, by piece id
+    results = JSONField(default=dict, blank=True)
+
+    objects = OrderQuoteManager()
+
+    @property
+    def progress(self):
+        return (self.quoted_count + self.failed_count) / self.pieces_count if self.pieces_count else 1
+
+    def ready(self):
+        return self.finished is not None
+
+    def piece_workflow(self, piece, wait_for_models=True):
+        # Quoting task of the piece, and its result recording. If the task raises, the piece is recorded as failed
+        signature = piece.quoting_signature(wait_for_models)
+        signature.link_error(record_piece_quote.si(False, self.id, piece.id))
+        return signature | record_piece_quote.s(self.id, piece.id)
+
+    def record(self, piece, ok):
+        quote = piece.quote if piece.stl is not None else piece.gcode
+        ok = bool(ok) and quote is not None and quote.build_time is not None
+        with transaction.atomic():
+            # Pieces finish concurrently, so we lock the row
+            order_quote = OrderQuote.objects.select_for_update().get(id=self.id)
+            # Each piece is recorded once (i.e., both analysis tasks of its model might fail)
+            if str(piece.id) in order_quote.results:
+                return order_quote
+            order_quote.results[str(piece.id)] = {'ok': ok,
+                                                  'build_time': quote.build_time if ok else None,
+                                                  'weight': quote.weight if ok else None}
+            if ok:
+                order_quote.quoted_count += 1
+            else:
+                order_quote.failed_count += 1
+            order_quote.save(update_fields=['results', 'quoted_count', 'failed_count'])
+        return order_quote
+
+
 class UnitPiece(models.Model):
     piece = models.ForeignKey(Piece, on_delete=models.CASCADE, related_name='unit_pieces')
     job = models.ForeignKey('PrintJob', on_delete=models.CASCADE, related_name='unit_pieces')
@@ -721,7 +1076,7 @@ class PrintJob(models.Model):
 
     @property
     def awaiting_for_bed_removal(self):
-        return not self.printing and self.success is None
+        return self.task.state == 'awaiting_human'
 
     @property
     def pending(self):
@@ -731,16 +1086,84 @@ class PrintJob(models.Model):
         return self.task.connection.printer
 
 
+class PrintTimeCorrectionManager(models.Manager):
+    def fit(self):
+        """
+        Fits the print time correction of every (PrinterProfile, PrintProfile) from successful print jobs, plus a global
+        correction (printer_profile and print_profile are None), used when a combination doesn't have enough samples
+        """
+        rows = PrintJob.objects.filter(success=True, end_time__isnull=False).values_list(
+            'id', 'created', 'end_time', 'task__print_started', 'task__print_finished',
+            'unit_pieces__piece__quote__build_time', 'unit_pieces__piece__quote__profile__printer',
+            'unit_pieces__piece__quote__profile__print', 'unit_pieces__piece__gcode__build_time',
+            'unit_pieces__piece__gcode__printer_type', 'task__slicejob__build_time')
+        pieces = []
+        for id, created, end_time, started, finished, quote_time, printer, print, gcode_time, gcode_printer, \
+                plate_time in rows:
+            estimate = quote_time if quote_time is not None else gcode_time
+            # Jobs without print timestamps include the time waiting for the operator
+            actual = (finished - started) if started is not None and finished is not None else (end_time - created)
+            key = (printer, print) if quote_time is not None else (gcode_printer, None)
+            pieces.append((id, key, estimate, actual.total_seconds(), plate_time))
+        # Plates have a row per piece, but a single duration
+        samples = print_time_correction.job_samples(pieces)
+        # Every sample is used twice: on its own group, and on the global one. Samples without a printer profile (G-code
+        # pieces without printer_type) would have the global key, so they are only used on the global group
+        global_key = (None, None)
+        values = list(samples.values())
+        profiled = [s for s in values if s[0] != global_key]
+        keys = sorted(set(s[0] for s in profiled), key=str) + [global_key]
+        index = {k: i for i, k in enumerate(keys)}
+        groups = [index[s[0]] for s in profiled] + [index[global_key]] * len(values)
+        estimates = [s[1] for s in profiled + values]
+        actuals = [s[2] for s in profiled + values]
+        slope, intercept, count = print_time_correction.fit_groups(groups, estimates, actuals,
+                                                                   min_samples=settings.PRINT_TIME_CORRECTION_MIN_SAMPLES)
+        corrections = [PrintTimeCorrection(printer_profile_id=k[0], print_profile_id=k[1], slope=float(slope[i]),
+                                           intercept=float(intercept[i]), samples=int(count[i]))
+                       for k, i in index.items() if i < len(slope) and not math.isnan(slope[i])]
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create(corrections)
+        return len(corrections)
+
+    def as_dict(self):
+        return {(c.printer_profile_id, c.print_profile_id): c for c in self.all()}
+
+    def correct(self, build_time, printer_profile_id=None, print_profile_id=None, corrections=None):
+        # Pass corrections (as_dict) when correcting many estimations
+        if not settings.PRINT_TIME_CORRECTION:
+            return build_time
+        corrections = self.as_dict() if corrections is None else corrections
+        c = corrections.get((printer_profile_id, print_profile_id), corrections.get((None, None)))
+        return c.correct(build_time) if c is not None else build_time
+
+
+class PrintTimeCorrection(models.Model):
+    # actual print time = slope * estimated print time + intercept
+    printer_profile = models.ForeignKey('slaicer.PrinterProfile', on_delete=models.CASCADE, null=True, blank=True)
+    print_profile = models.ForeignKey('slaicer.PrintProfile', on_delete=models.CASCADE, null=True, blank=True)
+    slope = models.FloatField(default=1)
+    intercept = models.FloatField(default=0)
+    samples = models.IntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+    objects = PrintTimeCorrectionManager()
+
+    def correct(self, build_time):
+        return print_time_correction.correct(build_time, self.slope, self.intercept)
+
+
 @receiver(post_save, sender=PrintJob)
 def update_printer_printjob_on_confirmation(sender, update_fields, instance, created, **kwargs):
     if update_fields is None and instance.success is not None:
         instance.end_time = timezone.now()
         instance.save(update_fields=['end_time'])
+        instance.task.human_intervention_done()
 
 
 # Scheduler models
 
-class Schedule(models.Model):
+class Schedule(TaskStatusMixin, models.Model):
     created = models.DateTimeField(default=timezone.now)
     finished = models.DateTimeField(null=True)
     # We use ortools status definition
@@ -751,13 +1174,11 @@ class Schedule(models.Model):
 
     @property
     def schedule_ready(self):
-        return False if not TaskResult.objects.filter(task_id=self.celery_id).exists() else TaskResult.objects.filter(
-            task_id=self.celery_id).first().status in states.READY_STATES
+        return task_ready(self)
 
     @property
     def dispatcher_ready(self):
-        return False if not TaskResult.objects.filter(task_id=self.dispatcher_celery_id).exists() else TaskResult.objects.filter(
-            task_id=self.dispatcher_celery_id).first().status in states.READY_STATES
+        return task_ready(self, 'dispatcher_celery_id')
 
     def ready(self):
         if self.status is not None and self.status != 4:
@@ -793,3 +1214,13 @@ class ScheduleEntry(models.Model):
     start = models.DateTimeField()
     end = models.DateTimeField()
     deadline = models.DateTimeField()
+    # Plates (several copies printed together, see skynet/tools/plate_packing.py): one item per copy, as
+    # {'piece': Piece id, 'model': GeometryModel id, 'x': mm, 'y': mm, 'rotated': bool}. piece is the first one
+    plate = JSONField(null=True, blank=True)
+
+    def get_pieces(self):
+        # Pieces printed on this entry, one per copy
+        if not self.plate:
+            return [self.piece]
+        pieces = Piece.objects.in_bulk([p['piece'] for p in self.plate])
+        return [pieces[p['piece']] for p in self.plate]
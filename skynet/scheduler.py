@@ -9,6 +9,8 @@ import datetime
 import pytz
 from django.utils import timezone
 from slaicer.models import SliceJob, SliceConfiguration
+from slaicer.tools.task_results import resolve_task_status
+from skynet.tools import plate_packing
 import skynet.tasks as tareas
 import os
 
@@ -53,6 +55,47 @@ def print_piece_on_printer_check(piece, printer):
     return True
 
 
+def print_entry_on_printer_check(entry, printer):
+    # Every piece of a plate must be printable on the printer
+    return all([print_piece_on_printer_check(piece, printer) for piece in entry.get_pieces()])
+
+
+def plate_compatibility_key(piece):
+    # Pieces printed together share their print settings and filament
+    return (piece.print_settings_id, piece.stl.quality, piece.auto_print_profile, piece.auto_support,
+            frozenset([m.id for m in piece.materials.all()]), frozenset([c.id for c in piece.colors.all()]))
+
+
+def pack_plates(copies, bed_width, bed_depth):
+    '''
+    copies: list of (piece, build time, deadline), one per queued copy of an STL piece. Compatible copies are grouped, in
+    deadline order, on batches of up to PLATE_PACKING_MAX_BUILD_TIME, and each batch is packed on plates. Returns a list
+    of plates, each one a list of (copy, Placement). Copies that don't fit on a bed are returned alone, without placement
+    '''
+    groups = collections.defaultdict(list)
+    for c in copies:
+        groups[plate_compatibility_key(c[0])].append(c)
+    plates = []
+    for group in groups.values():
+        group.sort(key=lambda c: c[2])
+        batches = [[]]
+        for c in group:
+            if batches[-1] and sum([b[1] for b in batches[-1]]) + c[1] > settings.PLATE_PACKING_MAX_BUILD_TIME:
+                batches.append([])
+            batches[-1].append(c)
+        for batch in batches:
+            footprints = [(i, c[0].stl.orientation.size_x * c[0].stl.scale, c[0].stl.orientation.size_y * c[0].stl.scale)
+                          for i, c in enumerate(batch)]
+            packed = plate_packing.pack(footprints, bed_width, bed_depth, spacing=settings.PLATE_PACKING_SPACING,
+                                        max_items=settings.PLATE_PACKING_MAX_PIECES)
+            placed = set()
+            for placements in packed:
+                plates.append([(batch[p.key], p) for p in placements])
+                placed.update([p.key for p in placements])
+            plates += [[(c, None)] for i, c in enumerate(batch) if i not in placed]
+    return plates
+
+
 def get_formatted_forbidden_bounds(horizon):
     '''
     Scheduler uses relative times, so, we need to translate it
@@ -128,21 +171,52 @@ def poma_scheduler(self):
         # We run the dispatcher, to update previous tasks status
         tareas.octoprint_task_dispatcher()
 
-        # Data type definition used for scheduling
-        task_data_type = collections.namedtuple('task_data', 'piece_id processing_time deadline copy processing_on')
+        # Machines
+        available_machines = [p for p in skynet_models.Printer.objects.select_related('printer_type', 'connection', 'filament')
+                              .prefetch_related('printer_type__available_print_profiles') if p.printer_connection_enabled]
+        machines_count = len(available_machines)
+
+        # Data type definition used for scheduling. Plates (several copies printed together) are a single task, on its
+        # first piece
+        task_data_type = collections.namedtuple('task_data', 'piece_id processing_time deadline copy processing_on plate')
         tasks_data = []
 
-        # Pending pieces
-        for p in skynet_models.Piece.objects.all():
-            if p.quote_ready() and not p.cancelled:
+        # Pending pieces. We resolve their quoting tasks status at once
+        pieces = list(skynet_models.Piece.objects.filter(cancelled=False).select_related('quote', 'quote__profile', 'gcode',
+                                                                                         'stl', 'stl__orientation')
+                      .prefetch_related('materials', 'colors'))
+        resolve_task_status([p.quote for p in pieces])
+        resolve_task_status([p.gcode for p in pieces])
+        pieces_by_id = {p.id: p for p in pieces}
+        # Slicer estimations are corrected using historical print times
+        corrections = skynet_models.PrintTimeCorrection.objects.as_dict()
+        plate_copies = []
+        for p in pieces:
+            if p.quote_ready():
+                build_time = int(p.get_corrected_build_time(corrections))
+                deadline = max(int(p.get_deadline_from_now()), build_time)
                 for copy in range(0, p.queued_pieces):
-                    tasks_data.append(task_data_type(p.id, int(p.get_build_time()), max(int(p.get_deadline_from_now()), int(p.get_build_time())),
-                                                     copy, None))
-
-
-        # Machines
-        available_machines = [p for p in skynet_models.Printer.objects.all() if p.printer_connection_enabled]
-        machines_count = len(available_machines)
+                    if settings.PLATE_PACKING and p.stl is not None:
+                        plate_copies.append((p, build_time, deadline))
+                    else:
+                        tasks_data.append(task_data_type(p.id, build_time, deadline, copy, None, None))
+
+        # Plates are packed for the smallest bed, so they can be printed on any machine
+        if plate_copies and machines_count > 0:
+            bed_width = min([m.printer_type.bed_shape[0] for m in available_machines])
+            bed_depth = min([m.printer_type.bed_shape[1] for m in available_machines])
+            plates = pack_plates(plate_copies, bed_width, bed_depth)
+        else:
+            plates = [[(c, None)] for c in plate_copies]
+        for copy, plate in enumerate(plates):
+            build_time = sum([c[1] for c, placement in plate])
+            deadline = max(min([c[2] for c, placement in plate]), build_time)
+            if len(plate) > 1:
+                plate_data = [{'piece': c[0].id, 'model': c[0].stl_id, 'x': placement.x, 'y': placement.y,
+                               'rotated': placement.rotated} for c, placement in plate]
+            else:
+                plate_data = None
+            tasks_data.append(task_data_type(plate[0][0][0].id, build_time, deadline, copy, None, plate_data))
 
         # Create the model.
         model = cp_model.CpModel()
@@ -155,14 +229,44 @@ def poma_scheduler(self):
             machines_corresp_to_db[id] = m.id
 
         # Pieces in progress
+        active_tasks = {}
         for m in available_machines:
             if m.connection.active_task is not None:
                 at = m.connection.active_task
                 if not at.finished:
-                    tasks_data.append(task_data_type('OT{}'.format(at.id), int(at.time_left), int(at.time_left), 0, [x for x in machines_corresp_to_db.keys() if machines_corresp_to_db[x] == m.id][0]))
+                    active_tasks[at.id] = at
+                    tasks_data.append(task_data_type('OT{}'.format(at.id), int(at.time_left), int(at.time_left), 0, [x for x in machines_corresp_to_db.keys() if machines_corresp_to_db[x] == m.id][0], None))
+
+        # Processing time of possible tasks on each machine, including the filament change (setup) time when the piece
+        # can't be printed with the filament loaded on the machine
+        # The new filament is the one the dispatcher would load (see Piece.select_filament)
+        new_materials = {}
+
+        def setup_time(piece, printer):
+            if printer.filament is not None and piece.check_for_filament_compatibility(printer.filament):
+                return 0
+            if piece.id not in new_materials:
+                filament = piece.select_filament()
+                new_materials[piece.id] = filament.material_id if filament is not None else None
+            return int(skynet_models.FilamentChange.objects.mean_duration(
+                printer.id, printer.filament.material_id if printer.filament is not None else None,
+                new_materials[piece.id]))
+
+        tasks_durations = {}
+        for id, task in enumerate(tasks_data):
+            tasks_durations[id] = {}
+            if task.processing_on is None:
+                piece = pieces_by_id[task.piece_id]
+                plate_pieces = [pieces_by_id[p['piece']] for p in task.plate] if task.plate else [piece]
+                for m in machines_queue.keys():
+                    # Printer compatibility check
+                    if all([print_piece_on_printer_check(p, available_machines[m]) for p in plate_pieces]):
+                        tasks_durations[id][m] = task.processing_time + setup_time(piece, available_machines[m])
+                # Overdue pieces can't end before their processing time is over
+                tasks_data[id] = task._replace(deadline=max(task.deadline, min(tasks_durations[id].values(), default=0)))
 
         # Horizon definition
-        horizon = max(sum([t.processing_time for t in tasks_data]), 3600*24)
+        horizon = max(sum([max(tasks_durations[id].values(), default=t.processing_time) for id, t in enumerate(tasks_data)]), 3600*24)
         tasks_count = len(tasks_data)
 
         # Forbidden zones definition
@@ -176,9 +280,13 @@ def poma_scheduler(self):
         task_queue = {}
 
         for id, task in enumerate(tasks_data):
+            durations = tasks_durations[id]
+            min_duration = min(durations.values(), default=task.processing_time)
+            max_duration = max(durations.values(), default=task.processing_time)
             start_var = model.NewIntVar(0, horizon, 'start_{id}'.format(id=id))
             end_var = model.NewIntVar(0, horizon, 'end_{id}'.format(id=id))
-            interval = model.NewIntervalVar(start_var, task.processing_time, end_var, 'interval_{id}'.format(id=id))
+            duration_var = model.NewIntVar(min_duration, max_duration, 'duration_{id}'.format(id=id))
+            interval = model.NewIntervalVar(start_var, duration_var, end_var, 'interval_{id}'.format(id=id))
             machine_var = model.NewIntVar(0, machines_count, 'machine_{id}'.format(id=id))
             all_tasks.append(task_type(id=id, data=task, start=start_var, end=end_var, interval=interval, machine=machine_var))
             # We create a copy of each interval, on each machine, as an OptionalIntervalVar, if we can print it on it
@@ -187,19 +295,19 @@ def poma_scheduler(self):
                 # Consider possible tasks and present tasks
                 ## Possible tasks
                 if task.processing_on is None:
-                    # Printer compatibility check
-                    if print_piece_on_printer_check(skynet_models.Piece.objects.get(id=task.piece_id), skynet_models.Printer.objects.get(id=machines_corresp_to_db[m])):
+                    if m in durations:
                         start_var_o = model.NewIntVar(0, horizon, 'start_{id}_on_{machine}'.format(id=id, machine=m))
                         end_var_o = model.NewIntVar(0, horizon, 'end_{id}_on_{machine}'.format(id=id, machine=m))
                         flag = model.NewBoolVar('perform_{id}_on_{machine}'.format(id=id, machine=m))
                         task_queue[id].append(flag)
-                        interval_o = model.NewOptionalIntervalVar(start_var_o, task.processing_time, end_var_o, flag,
+                        interval_o = model.NewOptionalIntervalVar(start_var_o, durations[m], end_var_o, flag,
                                                                   'interval_{id}_on_{machine}'.format(id=id, machine=m))
                         machines_queue[m].append(task_optional_type(id=id, start=start_var_o, end=end_var_o,
                                                                     interval=interval_o, machine=m, flag=flag))
 
                         ## We only propagate the constraint if the task is performed on the machine
                         model.Add(start_var == start_var_o).OnlyEnforceIf(flag)
+                        model.Add(duration_var == durations[m]).OnlyEnforceIf(flag)
                         model.Add(machine_var == m).OnlyEnforceIf(flag)
                 ## Present tasks
                 else:
@@ -283,16 +391,17 @@ def poma_scheduler(self):
                                                                                             end=round(float(solver.Value(t.end))/3600,2),
                                                                                             deadline=round(float(t.data.deadline)/3600,2)))
         for task in all_tasks:
-            o = skynet_models.ScheduleEntry.objects.create(schedule=schedule,
-                                                           printer=skynet_models.Printer.objects.get(id=machines_corresp_to_db[solver.Value(task.machine)]),
-                                                           start=relative_to_absolute_date(solver.Value(task.start)),
-                                                           end=relative_to_absolute_date(solver.Value(task.end)),
-                                                           deadline=relative_to_absolute_date(task.data.deadline))
+            o = skynet_models.ScheduleEntry(schedule=schedule,
+                                            printer=available_machines[solver.Value(task.machine)],
+                                            start=relative_to_absolute_date(solver.Value(task.start)),
+                                            end=relative_to_absolute_date(solver.Value(task.end)),
+                                            deadline=relative_to_absolute_date(task.data.deadline))
 
             if 'OT' in str(task.data.piece_id):
-                o.task = skynet_models.OctoprintTask.objects.get(id=task.data.piece_id[2:])
+                o.task = active_tasks[int(task.data.piece_id[2:])]
             else:
-                o.piece = skynet_models.Piece.objects.get(id=task.data.piece_id)
+                o.piece = pieces_by_id[task.data.piece_id]
+                o.plate = task.data.plate
             o.save()
 
         return schedule.id
@@ -328,7 +437,7 @@ def poma_dispatcher(self, sid):
                     pass
                 else:
                     # We check if we can swap the schedules
-                    swap_possible = print_piece_on_printer_check(entry.piece, target_printer) and print_piece_on_printer_check(target_entry.piece, entry.printer)
+                    swap_possible = print_entry_on_printer_check(entry, target_printer) and print_entry_on_printer_check(target_entry, entry.printer)
                     target_with_correct_filament = target_entry.piece.check_for_filament_compatibility(target_printer.filament)
                     if swap_possible and not target_with_correct_filament:
                         entry_old_printer_id = entry.printer.id
@@ -355,8 +464,11 @@ def poma_dispatcher(self, sid):
                                                         print=piece.print_settings,
                                                         auto_print_profile=piece.auto_print_profile,
                                                         auto_support=piece.auto_support)
-            slicejob = SliceJob.objects.create(save_gcode=True)
-            slicejob.geometry_models.add(piece.stl)
+            # Plates: every model, placed as packed
+            slicejob = SliceJob.objects.create(save_gcode=True,
+                                               placements=[{k: p[k] for k in ('model', 'x', 'y', 'rotated')}
+                                                           for p in entry.plate] if entry.plate else None)
+            slicejob.geometry_models.add(*set([p.stl for p in entry.get_pieces()]))
             profile.job = slicejob
             profile.save()
             slicejob.launch_task()
@@ -369,18 +481,19 @@ def poma_dispatcher(self, sid):
 
         # Prepare filament and send task
         if filament == printer.filament:
-            task = printer.connection.create_task(slicejob=slicejob, file=ContentFile(gcode.print_file.read()) if gcode is not None else None)
+            task = printer.connection.create_task(slicejob=slicejob, file=gcode.print_file if gcode is not None else None)
         else:
             fc = skynet_models.FilamentChange.objects.issue_change_and_start_task(new_filament=filament,
                                                                              connection=printer.connection,
                                                                              slicejob=slicejob,
-                                                                             file=ContentFile(gcode.print_file.read()) if gcode is not None else None)
+                                                                             file=gcode.print_file if gcode is not None else None)
             task = fc.task.dependencies.first()
         # All set, we save the launched task in the schedule
         schedule.launched_tasks.add(task)
         # We create the associated PrintJob
         print_job = skynet_models.PrintJob.objects.create(task=task, filament=filament, estimated_end_time=entry.end)
-        skynet_models.UnitPiece.objects.create(piece=piece, job=print_job)
+        for p in entry.get_pieces():
+            skynet_models.UnitPiece.objects.create(piece=p, job=print_job)
 
 
 def scheduler_dispatcher_chain():
@@ -3,6 +3,7 @@ from django.db import models
 from skynet.models import *
 from slaicer.models import PrintProfile
 import datetime
+from slaicer.tools.task_results import resolve_lookups
 
 class PrinterTypeSimplifiedSerializer(serializers.ModelSerializer):
     class Meta:
@@ -24,6 +25,14 @@ class OctoprintConnectionSerializer(serializers.ModelSerializer):
         fields = ('id', 'url', 'locked', 'active_task', 'status')
 
 
+class ResolveTaskStatusListSerializer(serializers.ListSerializer):
+    # Resolves the celery status of every listed object at once. Lookups are taken from the child Meta
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        items = resolve_lookups(iterable, getattr(self.child.Meta, 'task_status_lookups', ()))
+        return super().to_representation(items)
+
+
 class PrinterSerializer(serializers.ModelSerializer):
     printer_type = PrinterTypeSimplifiedSerializer()
     filament = FilamentSimplifiedSerializer()
@@ -46,6 +55,8 @@ class PrinterSerializer(serializers.ModelSerializer):
         model = Printer
         fields = '__all__'
         depth = 3
+        list_serializer_class = ResolveTaskStatusListSerializer
+        task_status_lookups = (('connection.active_task.slicejob', 'celery_id'),)
 
 class PrinterSimplifiedSerializer(serializers.ModelSerializer):
     class Meta:
@@ -53,6 +64,13 @@ class PrinterSimplifiedSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class FleetOperationResultSerializer(serializers.Serializer):
+    printer = serializers.IntegerField(source='connection.printer.id')
+    name = serializers.CharField(source='connection.printer.name')
+    ok = serializers.BooleanField()
+    error = serializers.CharField(allow_null=True)
+
+
 class FilamentChangeSerializer(serializers.ModelSerializer):
     class Meta:
         model = FilamentChange
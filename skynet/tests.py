@@ -1,3 +1,89 @@
-from django.test import TestCase
+import numpy as np
+from django.test import SimpleTestCase
+from skynet.tools import plate_packing, print_time_correction
 
-# Create your tests here.
+
+class JobSamplesTestCase(SimpleTestCase):
+    def test_single_piece_jobs(self):
+        samples = print_time_correction.job_samples([(1, ('a', 'b'), 3600, 4000, 3500),
+                                                     (2, ('a', None), 1800, 2000, None)])
+        self.assertEqual(samples, {1: (('a', 'b'), 3600, 4000), 2: (('a', None), 1800, 2000)})
+
+    def test_plate_uses_its_slicing_estimate(self):
+        # A job with three unit pieces, and a single actual duration
+        rows = [(1, ('a', 'b'), 3600, 9000, 10000), (1, ('a', 'b'), 3000, 9000, 10000),
+                (1, ('a', 'b'), 2400, 9000, 10000)]
+        self.assertEqual(print_time_correction.job_samples(rows), {1: (('a', 'b'), 10000, 9000)})
+
+    def test_plate_without_slicing_estimate_sums_its_pieces(self):
+        rows = [(1, ('a', 'b'), 3600, 9000, None), (1, ('a', 'b'), 3000, 9000, None)]
+        self.assertEqual(print_time_correction.job_samples(rows), {1: (('a', 'b'), 6600, 9000)})
+
+    def test_missing_estimates_are_left_out(self):
+        rows = [(1, ('a', 'b'), None, 9000, None), (1, ('a', 'b'), 3000, 9000, None), (2, ('a', 'b'), 0, 100, None)]
+        self.assertEqual(print_time_correction.job_samples(rows), {})
+
+
+class PlatePackingTestCase(SimpleTestCase):
+    def assertValidPlate(self, placements, bed_width, bed_depth, spacing):
+        for p in placements:
+            self.assertGreaterEqual(p.x, 0)
+            self.assertGreaterEqual(p.y, 0)
+            self.assertLessEqual(p.x + p.width, bed_width)
+            self.assertLessEqual(p.y + p.depth, bed_depth)
+        # Footprints (plus spacing) don't overlap
+        for i, a in enumerate(placements):
+            for b in placements[i + 1:]:
+                apart = a.x + a.width + spacing <= b.x or b.x + b.width + spacing <= a.x or \
+                        a.y + a.depth + spacing <= b.y or b.y + b.depth + spacing <= a.y
+                self.assertTrue(apart, '{} overlaps {}'.format(a, b))
+
+    def test_pieces_share_a_plate(self):
+        plates = plate_packing.pack([(i, 40, 30) for i in range(6)], 200, 200, spacing=10)
+        self.assertEqual(len(plates), 1)
+        self.assertEqual(sorted(p.key for p in plates[0]), list(range(6)))
+        self.assertValidPlate(plates[0], 200, 200, 10)
+
+    def test_plates_are_valid(self):
+        footprints = [(i, 10 + (i * 37) % 90, 10 + (i * 53) % 70) for i in range(60)]
+        plates = plate_packing.pack(footprints, 200, 180, spacing=5)
+        self.assertEqual(sorted(p.key for plate in plates for p in plate), list(range(60)))
+        for plate in plates:
+            self.assertValidPlate(plate, 200, 180, 5)
+
+    def test_max_items(self):
+        plates = plate_packing.pack([(i, 10, 10) for i in range(20)], 200, 200, max_items=8)
+        self.assertEqual([len(plate) for plate in plates], [8, 8, 4])
+
+    def test_rotated_to_fit(self):
+        # Only fits with its longest side along the bed depth
+        placement, = plate_packing.pack([('a', 150, 50)], 100, 200)[0]
+        self.assertTrue(placement.rotated)
+        self.assertEqual((placement.width, placement.depth), (50, 150))
+
+    def test_oversized_pieces_are_left_out(self):
+        plates = plate_packing.pack([('big', 300, 50), ('small', 20, 20)], 200, 200)
+        self.assertEqual([[p.key for p in plate] for plate in plates], [['small']])
+
+
+class PrintTimeCorrectionTestCase(SimpleTestCase):
+    def test_fit_groups(self):
+        # Group 0: actual = 1.2 * estimate + 300. Group 1: not enough samples
+        estimates = [1000, 2000, 3000, 4000, 5000, 1000, 2000]
+        actuals = [1500, 2700, 3900, 5100, 6300, 1000, 2000]
+        slope, intercept, count = print_time_correction.fit_groups([0] * 5 + [1] * 2, estimates, actuals, min_samples=5)
+        self.assertAlmostEqual(slope[0], 1.2)
+        self.assertAlmostEqual(intercept[0], 300)
+        self.assertTrue(np.isnan(slope[1]) and np.isnan(intercept[1]))
+        self.assertEqual(list(count), [5, 2])
+
+    def test_same_estimates_are_scaled(self):
+        slope, intercept, count = print_time_correction.fit_groups([0] * 3, [1000] * 3, [1100, 1200, 1300],
+                                                                   min_samples=1)
+        self.assertAlmostEqual(slope[0], 1.2)
+        self.assertEqual(intercept[0], 0)
+
+    def test_correct(self):
+        self.assertEqual(print_time_correction.correct(1000, 1.2, 300), 1500)
+        # Never shorter than half the estimate
+        self.assertEqual(print_time_correction.correct(1000, 0.1, 0), 500)
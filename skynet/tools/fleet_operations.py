@@ -0,0 +1,82 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+import skynet.models as skynet_models
+
+'''
+Fleet operations. Sends the same command to a set of printers concurrently, so an emergency "pause all" or
+"cancel all" takes about one round trip instead of one per printer.
+Only the HTTP requests run on the thread pool. DB bookkeeping (cancelled tasks, statuses) is done on the calling
+thread, so worker threads never open database connections.
+'''
+
+FleetResult = collections.namedtuple('FleetResult', 'connection ok error')
+
+
+def _connections(connections):
+    if connections is None:
+        return list(skynet_models.OctoprintConnection.objects.all())
+    return list(connections)
+
+
+def _run(connection, operation, timeout):
+    try:
+        return FleetResult(connection, bool(operation(connection, timeout)), None)
+    except Exception as e:
+        return FleetResult(connection, False, str(e))
+
+
+def broadcast(connections, operation, timeout=None, max_workers=None):
+    """
+    Executes operation(connection, timeout) on every connection concurrently. operation must only do HTTP requests.
+    Returns a list of FleetResult, in the same order as connections
+    """
+    connections = _connections(connections)
+    if not connections:
+        return []
+    timeout = settings.FLEET_OPERATION_TIMEOUT if timeout is None else timeout
+    max_workers = min(max_workers or settings.FLEET_OPERATION_WORKERS, len(connections))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_run, c, operation, timeout) for c in connections]
+        return [f.result() for f in futures]
+
+
+def issue_command(commands, connections=None, **kwargs):
+    return broadcast(connections, lambda c, t: c._issue_command(commands, timeout=t), **kwargs)
+
+
+def beep(connections=None, **kwargs):
+    return issue_command("M300 S440 P400", connections, **kwargs)
+
+
+def pause_all(connections=None, **kwargs):
+    return broadcast(connections, lambda c, t: c._pause_octoprint_task('pause', timeout=t), **kwargs)
+
+
+def resume_all(connections=None, **kwargs):
+    return broadcast(connections, lambda c, t: c._pause_octoprint_task('resume', timeout=t), **kwargs)
+
+
+def cancel_all(connections=None, **kwargs):
+    connections = _connections(connections)
+    # Same as OctoprintConnection.cancel_active_task, but octoprint is notified concurrently
+    for conn in connections:
+        conn.cancel_active_task(notify_octoprint=False)
+    return broadcast(connections, lambda c, t: c._cancel_octoprint_task(timeout=t), **kwargs)
+
+
+def _reset(connection, timeout):
+    # There may be no job to cancel, so only the reconnection result matters
+    connection._cancel_octoprint_task(timeout=timeout)
+    return connection._reconnect(timeout=timeout)
+
+
+def reset_all(connections=None, **kwargs):
+    connections = _connections(connections)
+    for conn in connections:
+        conn.cancel_active_task(notify_octoprint=False)
+    results = broadcast(connections, _reset, **kwargs)
+    for r in results:
+        if r.error is None:
+            r.connection.reset_status()
+    return results
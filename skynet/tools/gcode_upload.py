@@ -0,0 +1,94 @@
+import io
+import uuid
+from slaicer.tools import gcode_storage
+
+'''
+Helpers to upload G-code files to octoprint without loading them into memory.
+Octoprint expects a multipart/form-data POST on api/files/local. Instead of building the whole body in memory (as
+urllib3 does with the fields argument), MultipartGcodeStream is a file-like object that reads the G-code in chunks,
+while the request is being sent. Compressed G-code is decompressed on the fly.
+'''
+
+# We add a M400 command at the end of the file, so, we avoid problems due marlin gcode cache
+GCODE_TRAILER = b'\nM400 \nM115'
+CHUNK_SIZE = 64 * 1024
+
+
+class MultipartGcodeStream:
+    def __init__(self, file, file_name, fields=None, trailer=GCODE_TRAILER, chunk_size=CHUNK_SIZE, gcode_size=None):
+        # Accepts Django File, FieldFile or ContentFile. gcode_size: decompressed file size, if it's known
+        self.file = file
+        self.gcode_size = gcode_size
+        self.chunk_size = chunk_size
+        self.boundary = uuid.uuid4().hex
+        head = b''
+        for name, value in (fields or {}).items():
+            head += self._part_header('Content-Disposition: form-data; name="{}"'.format(name))
+            head += str(value).encode('utf-8') + b'\r\n'
+        head += self._part_header('Content-Disposition: form-data; name="file"; filename="{}"'.format(file_name),
+                                  'Content-Type: application/octet-stream')
+        self.head = head
+        self.tail = trailer + '\r\n--{}--\r\n'.format(self.boundary).encode('utf-8')
+        self.content_length = len(self.head) + self.file_size() + len(self.tail)
+        self._reset()
+
+    def _part_header(self, *lines):
+        return '--{boundary}\r\n{lines}\r\n\r\n'.format(boundary=self.boundary, lines='\r\n'.join(lines)).encode('utf-8')
+
+    def file_size(self):
+        return gcode_storage.gcode_size(self.file, self.gcode_size)
+
+    def open_file(self):
+        return gcode_storage.open_gcode(self.file)
+
+    def _chunks(self):
+        yield self.head
+        with self.open_file() as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                # ContentFile might be created from a string
+                yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+        yield self.tail
+
+    def _reset(self):
+        self._iterator = self._chunks()
+        self._buffer = bytearray()
+        self._position = 0
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    @property
+    def headers(self):
+        return {'Content-Type': self.content_type, 'Content-Length': str(self.content_length)}
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._iterator)
+            except StopIteration:
+                break
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._position += len(data)
+        return data
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # urllib3 rewinds the body before retrying a request. We only support going back to the beginning
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("MultipartGcodeStream can only be rewinded")
+        self.close()
+        self._reset()
+        return 0
+
+    def close(self):
+        # Closing the generator closes the underlying file
+        self._iterator.close()
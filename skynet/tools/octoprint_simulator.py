@@ -0,0 +1,362 @@
+import argparse
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+
+'''
+Fake octoprint fleet, used for load and latency testing (see benchmark_fleet.py). A single asyncio HTTP server emulates
+hundreds of octoprint instances. Each virtual printer lives under its own prefix, so an OctoprintConnection url looks
+like http://127.0.0.1:5050/printer/17/
+Emulated endpoints: api/version, api/connection, api/printer, api/job, api/files/local and api/printer/command.
+It doesn't depend on Django, so it can run on a different host than PoMa:
+    python -m skynet.tools.octoprint_simulator --printers 300 --port 5050
+'''
+
+ROUTE = re.compile(r'^/printer/(?P<id>\d+)/(?P<endpoint>api/[\w/]+?)/?(\?.*)?$')
+UPLOAD_HEAD_SIZE = 64 * 1024
+READ_SIZE = 256 * 1024
+
+STATUS_TEXT = {200: 'OK', 201: 'Created', 204: 'No Content', 400: 'Bad Request', 403: 'Forbidden',
+               404: 'Not Found', 409: 'Conflict', 500: 'Internal Server Error'}
+
+
+class VirtualPrinter:
+    def __init__(self, id, apikey=None, print_duration=60, seconds_per_mb=0, failure_rate=0.0, print_failure_rate=0.0,
+                 latency=0.0, offline=False):
+        self.id = id
+        self.apikey = apikey
+        # Print duration: fixed part, plus a part proportional to the uploaded file size
+        self.print_duration = print_duration
+        self.seconds_per_mb = seconds_per_mb
+        # Probability of answering a request with a 500 error, and of a print ending with a printer error
+        self.failure_rate = failure_rate
+        self.print_failure_rate = print_failure_rate
+        # Extra response delay (seconds). Offline printers never answer
+        self.latency = latency
+        self.offline = offline
+        self.connected = True
+        self.error = False
+        self.paused = False
+        self.job_name = None
+        self.job_duration = None
+        self.job_started = None
+        self.job_will_fail = False
+        self.paused_at = None
+        self.tool_temperature = 25.0
+        self.bed_temperature = 25.0
+        self.received_commands = 0
+        self.uploads = 0
+
+    # Printer state
+    def update(self):
+        if self.printing and self.progress_time() >= self.job_duration:
+            if self.job_will_fail:
+                self.error = True
+            self.job_started = None
+        target_tool, target_bed = (210.0, 60.0) if self.printing else (25.0, 25.0)
+        self.tool_temperature = target_tool + random.uniform(-1, 1)
+        self.bed_temperature = target_bed + random.uniform(-0.5, 0.5)
+
+    @property
+    def printing(self):
+        return self.job_started is not None and not self.paused
+
+    def progress_time(self):
+        if self.job_started is None:
+            return 0
+        end = self.paused_at if self.paused else time.time()
+        return end - self.job_started
+
+    def start_job(self, name, size):
+        self.job_name = name
+        self.job_duration = self.print_duration + self.seconds_per_mb * size / 2 ** 20
+        self.job_started = time.time()
+        self.job_will_fail = random.random() < self.print_failure_rate
+        self.paused = False
+        self.error = False
+        self.uploads += 1
+
+    def cancel_job(self):
+        self.job_started = None
+        self.paused = False
+
+    def state_text(self):
+        if not self.connected:
+            return 'Closed'
+        if self.error:
+            return 'Error'
+        if self.paused:
+            return 'Paused'
+        return 'Printing' if self.printing else 'Operational'
+
+    def flags(self):
+        # Same flags as OctoprintStatus
+        operational = self.connected and not self.error
+        return {'cancelling': False,
+                'closedOrError': not operational,
+                'error': self.error,
+                'finishing': False,
+                'operational': operational,
+                'paused': self.paused,
+                'pausing': False,
+                'printing': self.printing,
+                'ready': operational and not self.printing and not self.paused,
+                'resuming': False,
+                'sdReady': False}
+
+    # API endpoints. Returns (status, payload)
+    def api_version(self, method, body):
+        return 200, {'api': '0.1', 'server': '1.3.10', 'text': 'OctoPrint 1.3.10 (simulated #{})'.format(self.id)}
+
+    def api_connection(self, method, body):
+        if method == 'POST':
+            command = json.loads(body or b'{}').get('command')
+            if command == 'connect':
+                self.connected = True
+                self.error = False
+            elif command == 'disconnect':
+                self.connected = False
+                self.cancel_job()
+            else:
+                return 400, None
+            return 204, None
+        return 200, {'current': {'state': self.state_text(), 'port': '/dev/ttyACM0', 'baudrate': 115200,
+                                 'printerProfile': '_default'},
+                     'options': {}}
+
+    def api_printer(self, method, body):
+        if not self.connected:
+            return 409, None
+        return 200, {'state': {'text': self.state_text(), 'flags': self.flags()},
+                     'temperature': {'tool0': {'actual': round(self.tool_temperature, 2), 'target': None},
+                                     'bed': {'actual': round(self.bed_temperature, 2), 'target': None}}}
+
+    def api_printer_command(self, method, body):
+        commands = json.loads(body or b'{}').get('commands', [])
+        self.received_commands += len(commands)
+        return 204, None
+
+    def api_job(self, method, body):
+        if method == 'POST':
+            command = json.loads(body or b'{}').get('command')
+            if command == 'cancel':
+                self.cancel_job()
+            elif command == 'pause' and self.job_started is not None:
+                if self.paused:
+                    self.job_started += time.time() - self.paused_at
+                    self.paused = False
+                else:
+                    self.paused = True
+                    self.paused_at = time.time()
+            elif command != 'pause':
+                return 400, None
+            return 204, None
+        active = self.job_started is not None
+        print_time = self.progress_time()
+        return 200, {'job': {'file': {'name': self.job_name, 'origin': 'local'},
+                             'estimatedPrintTime': self.job_duration},
+                     'progress': {'completion': 100 * print_time / self.job_duration if active else None,
+                                  'printTime': int(print_time) if active else None,
+                                  'printTimeLeft': int(max(self.job_duration - print_time, 0)) if active else None},
+                     'state': self.state_text()}
+
+    def api_files_local(self, method, body, upload=None):
+        if method != 'POST' or upload is None or upload['filename'] is None:
+            return 400, None
+        if upload['print']:
+            if self.printing or not self.connected:
+                return 409, None
+            self.start_job(upload['filename'], upload['size'])
+        return 201, {'done': True, 'files': {'local': {'name': upload['filename'], 'origin': 'local'}}}
+
+
+class OctoprintSimulator:
+    def __init__(self, printers, host='127.0.0.1', port=5050):
+        self.printers = {p.id: p for p in printers}
+        self.host = host
+        self.port = port
+        self.requests_count = 0
+        self.server = None
+        self.loop = None
+
+    @classmethod
+    def create_fleet(cls, count, host='127.0.0.1', port=5050, **printer_kwargs):
+        return cls([VirtualPrinter(i, **printer_kwargs) for i in range(count)], host=host, port=port)
+
+    def printer_url(self, printer_id):
+        return 'http://{host}:{port}/printer/{id}/'.format(host=self.host, port=self.port, id=printer_id)
+
+    @property
+    def urls(self):
+        return [self.printer_url(i) for i in self.printers.keys()]
+
+    async def _read_headers(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None, None, None
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, value = line.decode('latin-1').split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+        return method, path, headers
+
+    async def _read_body(self, reader, headers, keep=None):
+        # Reads the body in blocks. Only the first 'keep' bytes are kept, so big uploads don't use memory
+        body = bytearray()
+        size = 0
+
+        def consume(chunk):
+            nonlocal size
+            if keep is None or len(body) < keep:
+                body.extend(chunk if keep is None else chunk[:keep - len(body)])
+            size += len(chunk)
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                chunk_size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if chunk_size == 0:
+                    await reader.readline()
+                    break
+                remaining = chunk_size
+                while remaining:
+                    chunk = await reader.read(min(remaining, READ_SIZE))
+                    remaining -= len(chunk)
+                    consume(chunk)
+                await reader.readline()
+        else:
+            remaining = int(headers.get('content-length', 0))
+            while remaining:
+                chunk = await reader.read(min(remaining, READ_SIZE))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                consume(chunk)
+        return bytes(body), size
+
+    @staticmethod
+    def _parse_upload(head, size, content_type):
+        # We only need the file name and the print flag, the G-code itself is discarded
+        boundary = re.search(r'boundary="?([^";]+)"?', content_type or '')
+        upload = {'filename': None, 'print': False, 'size': size}
+        if boundary is None:
+            return upload
+        for part in head.split(b'--' + boundary.group(1).encode('latin-1')):
+            disposition = re.search(rb'name="(?P<name>[^"]+)"(; filename="(?P<filename>[^"]*)")?', part)
+            if disposition is None:
+                continue
+            if disposition.group('filename') is not None:
+                upload['filename'] = disposition.group('filename').decode('utf-8')
+            elif disposition.group('name') == b'print':
+                value = part.split(b'\r\n\r\n', 1)[-1].strip().lower()
+                upload['print'] = value in (b'true', b'yes', b'y', b'1')
+        return upload
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                method, path, headers = await self._read_headers(reader)
+                if method is None:
+                    break
+                self.requests_count += 1
+                match = ROUTE.match(path)
+                printer = self.printers.get(int(match.group('id'))) if match else None
+                endpoint = match.group('endpoint').rstrip('/') if match else None
+                is_upload = endpoint == 'api/files/local'
+                body, size = await self._read_body(reader, headers, keep=UPLOAD_HEAD_SIZE if is_upload else None)
+                if printer is not None and printer.offline:
+                    # The host is down, we never answer
+                    await asyncio.sleep(3600)
+                    break
+                if printer is not None and printer.latency:
+                    await asyncio.sleep(printer.latency)
+                status, payload = self._dispatch(printer, endpoint, method, headers, body, size)
+                data = json.dumps(payload).encode('utf-8') if payload is not None else b''
+                writer.write('HTTP/1.1 {status} {text}\r\nContent-Type: application/json\r\n'
+                             'Content-Length: {length}\r\nConnection: keep-alive\r\n\r\n'.format(
+                                 status=status, text=STATUS_TEXT.get(status, ''), length=len(data)).encode('latin-1'))
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _dispatch(self, printer, endpoint, method, headers, body, size):
+        if printer is None:
+            return 404, None
+        if printer.apikey is not None and headers.get('x-api-key') != printer.apikey:
+            return 403, None
+        if random.random() < printer.failure_rate:
+            return 500, None
+        printer.update()
+        handler = getattr(printer, endpoint.replace('/', '_'), None)
+        if handler is None:
+            return 404, None
+        if endpoint == 'api/files/local':
+            return handler(method, body, upload=self._parse_upload(body, size, headers.get('content-type')))
+        return handler(method, body)
+
+    async def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.server = await asyncio.start_server(self._handle, self.host, self.port, backlog=1024)
+        return self.server
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def start_in_thread(self):
+        # Runs the simulator on a background (daemon) thread. Returns once the server is listening
+        started = threading.Event()
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start())
+            started.set()
+            loop.run_forever()
+
+        thread = threading.Thread(target=run, name='octoprint-simulator', daemon=True)
+        thread.start()
+        started.wait()
+        return thread
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake octoprint fleet')
+    parser.add_argument('--printers', type=int, default=100)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--apikey', default=None)
+    parser.add_argument('--print-duration', type=float, default=60, help='Seconds per print')
+    parser.add_argument('--seconds-per-mb', type=float, default=0, help='Extra print seconds per MB of G-code')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Probability of a 500 reply')
+    parser.add_argument('--print-failure-rate', type=float, default=0.0, help='Probability of a failed print')
+    parser.add_argument('--latency', type=float, default=0.0, help='Response delay, in seconds')
+    parser.add_argument('--offline', type=int, default=0, help='Number of printers that never answer')
+    args = parser.parse_args()
+    simulator = OctoprintSimulator.create_fleet(args.printers, host=args.host, port=args.port, apikey=args.apikey,
+                                                print_duration=args.print_duration,
+                                                seconds_per_mb=args.seconds_per_mb, failure_rate=args.failure_rate,
+                                                print_failure_rate=args.print_failure_rate, latency=args.latency)
+    for printer in list(simulator.printers.values())[:args.offline]:
+        printer.offline = True
+    print('Simulating {} octoprint instances on {}'.format(args.printers, simulator.printer_url('<id>')))
+    asyncio.run(simulator.serve_forever())
+
+
+if __name__ == '__main__':
+    main()
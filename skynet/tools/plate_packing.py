@@ -0,0 +1,77 @@
+import collections
+
+'''
+Plate packing. Small pieces are printed together, on the same bed, as a single job (one heat-up and one bed removal for
+all of them). Footprints (the piece bounding box, as it's printed) are packed with a shelf algorithm (first fit,
+decreasing depth): pieces are placed left to right on shelves, and shelves are stacked along the bed depth. Every piece
+is laid with its longest side along the bed width, unless it only fits the other way.
+'''
+
+Placement = collections.namedtuple('Placement', 'key x y width depth rotated')
+
+
+class Shelf:
+    def __init__(self, y, depth):
+        self.y = y
+        self.depth = depth
+        self.used = 0
+
+
+class Plate:
+    def __init__(self):
+        self.shelves = []
+        self.placements = []
+
+    @property
+    def used_depth(self):
+        return self.shelves[-1].y + self.shelves[-1].depth if self.shelves else 0
+
+
+def fits(width, depth, bed_width, bed_depth):
+    return (width <= bed_width and depth <= bed_depth) or (depth <= bed_width and width <= bed_depth)
+
+
+def _lay(width, depth, bed_width, bed_depth):
+    # Longest side along the bed width, if it fits. Returns width, depth, rotated
+    if max(width, depth) <= bed_width and min(width, depth) <= bed_depth:
+        return max(width, depth), min(width, depth), width < depth
+    return min(width, depth), max(width, depth), width > depth
+
+
+def pack(footprints, bed_width, bed_depth, spacing=0, max_items=None):
+    """
+    footprints: list of (key, width, depth), in mm. Returns a list of plates, each one a list of Placement (x, y: lower
+    left corner of the footprint, rotated: the piece is turned 90 degrees around z). Footprints are separated by
+    spacing. Footprints that don't fit on an empty bed are left out
+    """
+    items = []
+    for key, width, depth in footprints:
+        if fits(width, depth, bed_width, bed_depth):
+            items.append((key, *_lay(width, depth, bed_width, bed_depth)))
+    items.sort(key=lambda i: i[2], reverse=True)
+
+    plates = []
+    for key, width, depth, rotated in items:
+        placed = False
+        for plate in plates:
+            if max_items is not None and len(plate.placements) >= max_items:
+                continue
+            # First shelf with room for it. Otherwise, a new shelf on this plate
+            shelf = next((s for s in plate.shelves if depth <= s.depth and
+                          s.used + (spacing if s.used else 0) + width <= bed_width), None)
+            if shelf is None and plate.used_depth + (spacing if plate.shelves else 0) + depth <= bed_depth:
+                shelf = Shelf(plate.used_depth + (spacing if plate.shelves else 0), depth)
+                plate.shelves.append(shelf)
+            if shelf is not None:
+                x = shelf.used + (spacing if shelf.used else 0)
+                plate.placements.append(Placement(key, x, shelf.y, width, depth, rotated))
+                shelf.used = x + width
+                placed = True
+                break
+        if not placed:
+            plate = Plate()
+            plate.shelves.append(Shelf(0, depth))
+            plate.shelves[0].used = width
+            plate.placements.append(Placement(key, 0, 0, width, depth, rotated))
+            plates.append(plate)
+    return [plate.placements for plate in plates]
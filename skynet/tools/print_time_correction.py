@@ -0,0 +1,62 @@
+import collections
+import numpy as np
+
+'''
+Print time correction. Slicer estimates are corrected with a linear model (actual = slope * estimate + intercept),
+fitted by least squares for every group (i.e., a PrinterProfile and PrintProfile combination) at once.
+'''
+
+
+def job_samples(rows):
+    """
+    One sample per print job. rows: (job id, group, estimate, actual, plate estimate), one per unit piece of the job.
+    Jobs with several pieces (plates, see ScheduleEntry.plate) use the estimate of the plate slicing if there is one, or
+    the sum of their pieces estimates. Jobs with a missing estimate are left out. Returns {job id: (group, estimate,
+    actual)}
+    """
+    jobs = collections.OrderedDict()
+    for job, group, estimate, actual, plate_estimate in rows:
+        jobs.setdefault(job, (group, [], actual, plate_estimate))[1].append(estimate)
+    samples = collections.OrderedDict()
+    for job, (group, estimates, actual, plate_estimate) in jobs.items():
+        if len(estimates) > 1 and plate_estimate is not None and plate_estimate > 0:
+            samples[job] = (group, plate_estimate, actual)
+        elif all([e is not None and e > 0 for e in estimates]):
+            samples[job] = (group, sum(estimates), actual)
+    return samples
+
+
+def fit_groups(groups, estimates, actuals, min_samples=5):
+    """
+    groups: integer group index of each sample (0..n_groups-1). estimates, actuals: durations, in seconds.
+    Returns slope, intercept and samples count arrays, indexed by group. Groups with less than min_samples samples get
+    a NaN slope and intercept
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    x = np.asarray(estimates, dtype=np.float64)
+    y = np.asarray(actuals, dtype=np.float64)
+    n_groups = groups.max() + 1 if len(groups) else 0
+    n = np.bincount(groups, minlength=n_groups).astype(np.float64)
+    sx = np.bincount(groups, weights=x, minlength=n_groups)
+    sy = np.bincount(groups, weights=y, minlength=n_groups)
+    sxx = np.bincount(groups, weights=x * x, minlength=n_groups)
+    sxy = np.bincount(groups, weights=x * y, minlength=n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Centered sums: n * var(x) and n * cov(x, y)
+        vxx = sxx - sx * sx / n
+        vxy = sxy - sx * sy / n
+        slope = vxy / vxx
+        intercept = (sy - slope * sx) / n
+        # If all the estimates are (almost) the same, or the fit doesn't make sense, we just scale them
+        degenerate = ~(vxx > 1e-9 * sxx) | ~(slope > 0)
+        slope = np.where(degenerate, sy / sx, slope)
+        intercept = np.where(degenerate, 0, intercept)
+    enough = n >= min_samples
+    slope = np.where(enough, slope, np.nan)
+    intercept = np.where(enough, intercept, np.nan)
+    return slope, intercept, n.astype(np.int64)
+
+
+def correct(estimate, slope, intercept):
+    # Corrected estimates are never shorter than half the slicer estimate
+    return max(slope * estimate + intercept, estimate / 2)
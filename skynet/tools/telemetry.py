@@ -0,0 +1,53 @@
+import datetime
+import pytz
+
+'''
+Printer telemetry helpers. Samples are downsampled to a fixed resolution (one sample per TELEMETRY_RESOLUTION seconds,
+the first poll of each interval wins), and kept on a small buffer on OctoprintStatus. Once the buffer spans
+TELEMETRY_CHUNK_LENGTH intervals, it's written to the database as a single TelemetryChunk row (one array per field).
+A sample is a list: [slot, tool, bed, completion, print_time_left], where slot is the interval index since epoch.
+'''
+
+FIELDS = ('tool', 'bed', 'completion', 'print_time_left')
+
+
+def slot(when, resolution):
+    return int(when.timestamp() // resolution)
+
+
+def slot_datetime(s, resolution):
+    return datetime.datetime.fromtimestamp(s * resolution, tz=pytz.utc)
+
+
+def append_sample(buffer, when, values, resolution):
+    """
+    Appends a sample to the buffer, unless there is one already for the current slot.
+    Returns True if the buffer was modified
+    """
+    s = slot(when, resolution)
+    if buffer and buffer[-1][0] >= s:
+        return False
+    buffer.append([s] + [values.get(f) for f in FIELDS])
+    return True
+
+
+def pop_chunk(buffer, chunk_length):
+    """
+    If the buffer spans chunk_length slots, returns the first slot of the chunk and an array per field (missing slots
+    are None), and removes those samples from the buffer. Otherwise, returns None
+    """
+    if not buffer or buffer[-1][0] - buffer[0][0] < chunk_length:
+        return None
+    start = buffer[0][0]
+    arrays = {f: [None] * chunk_length for f in FIELDS}
+    while buffer and buffer[0][0] < start + chunk_length:
+        sample = buffer.pop(0)
+        for i, f in enumerate(FIELDS):
+            arrays[f][sample[0] - start] = sample[i + 1]
+    return start, arrays
+
+
+def buffer_series(buffer, resolution):
+    # Same format as TelemetryChunk.samples
+    for sample in buffer:
+        yield (slot_datetime(sample[0], resolution),) + tuple(sample[1:])
@@ -21,3 +21,12 @@ urlpatterns += [
     path('operations/reset_printer/<int:id>/', views.ResetConnectionOnPrinter.as_view()),
     path('operations/toggle_printer_en_dis/<int:id>/', views.TogglePrinterEnableDisabled.as_view()),
 ]
+
+# Fleet operations views
+urlpatterns += [
+    path('operations/fleet/pause/', views.PauseAllPrinters.as_view()),
+    path('operations/fleet/resume/', views.ResumeAllPrinters.as_view()),
+    path('operations/fleet/cancel/', views.CancelAllPrinters.as_view()),
+    path('operations/fleet/reset/', views.ResetAllPrinters.as_view()),
+    path('operations/fleet/beep/', views.BeepAllPrinters.as_view()),
+]
@@ -5,6 +5,7 @@ from rest_framework import generics, status, pagination, serializers
 from rest_framework.views import APIView
 from django.http import Http404
 from rest_framework.response import Response
+from skynet.tools import fleet_operations
 
 
 '''
@@ -29,7 +30,7 @@ class ListAllPendingPrintJobs(generics.ListAPIView):
     serializer_class = PrintJobSerializer
 
     def get_queryset(self):
-        return [p for p in PrintJob.objects.filter(success=None) if p.awaiting_for_bed_removal]
+        return PrintJob.objects.filter(success=None, task__state='awaiting_human')
 
 
 '''
@@ -113,4 +114,39 @@ class TogglePrinterEnableDisabled(generics.RetrieveAPIView):
             obj.toggle_enabled_disabled()
         except Printer.DoesNotExist:
              raise Http404
-        return obj
\ No newline at end of file
+        return obj
+
+
+class FleetOperation(APIView):
+    # Sends a command to every printer (or the ones listed on ?printers=1,2,3) concurrently
+    operation = None
+
+    def get(self, request, *args, **kwargs):
+        printers = Printer.objects.select_related('connection')
+        if request.query_params.get('printers'):
+            try:
+                printers = printers.filter(id__in=[int(i) for i in request.query_params['printers'].split(',')])
+            except ValueError:
+                return Response({'printers': 'Invalid printer list'}, status=status.HTTP_400_BAD_REQUEST)
+        results = self.operation([p.connection for p in printers])
+        return Response(FleetOperationResultSerializer(results, many=True).data)
+
+
+class PauseAllPrinters(FleetOperation):
+    operation = staticmethod(fleet_operations.pause_all)
+
+
+class ResumeAllPrinters(FleetOperation):
+    operation = staticmethod(fleet_operations.resume_all)
+
+
+class CancelAllPrinters(FleetOperation):
+    operation = staticmethod(fleet_operations.cancel_all)
+
+
+class ResetAllPrinters(FleetOperation):
+    operation = staticmethod(fleet_operations.reset_all)
+
+
+class BeepAllPrinters(FleetOperation):
+    operation = staticmethod(fleet_operations.beep)
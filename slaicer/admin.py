@@ -3,6 +3,7 @@ from .models import *
 from django.utils.html import format_html_join, format_html
 from django.contrib.postgres.fields import JSONField
 from prettyjson import PrettyJSONWidget
+from .tools.task_results import ResolveTaskStatusAdminMixin
 
 @admin.register(PrinterProfile)
 class PrinterProfileAdmin(admin.ModelAdmin):
@@ -97,8 +98,10 @@ class TweakerResultInline(admin.StackedInline):
 
 
 @admin.register(GeometryModel)
-class GeometryModelAdmin(admin.ModelAdmin):
+class GeometryModelAdmin(ResolveTaskStatusAdminMixin, admin.ModelAdmin):
     list_display = ('id', 'file','orientation_result_ready', 'geometry_result_ready')
+    list_select_related = ('orientation', 'geometry')
+    task_status_lookups = (('orientation', 'celery_id'), ('geometry', 'celery_id'))
     inlines = [GeometryResultInline, TweakerResultInline]
 
     def save_model(self, request, obj, form, change):
@@ -121,8 +124,9 @@ class SliceConfigurationInline(admin.StackedInline):
 
 
 @admin.register(SliceJob)
-class SliceJobAdmin(admin.ModelAdmin):
+class SliceJobAdmin(ResolveTaskStatusAdminMixin, admin.ModelAdmin):
     list_display = ('id', 'created', 'build_time', 'celery_id', 'result_ready')
+    task_status_lookups = (('', 'celery_id'),)
     inlines = [SliceConfigurationInline,]
     actions = ['launch_tasks']
 
@@ -5,6 +5,10 @@ from django.contrib.postgres.fields import JSONField, ArrayField
 from django.contrib.sites.models import Site
 from django.conf import settings
 from .tools import slicer_profiles_helper
+from .tools.task_results import task_ready, TaskStatusMixin
+from .tools import mesh_artifact as mesh_artifacts
+from .tools import model_cache, gcode_analyzer
+import logging
 from . import tasks
 import os
 import string
@@ -19,6 +23,7 @@ from django.forms.models import model_to_dict
 from django.apps import apps
 from django_celery_results.models import TaskResult
 from celery import states
+from celery.utils import uuid
 
 '''
 Los siguientes modelos, corresponden a un los 3 settings requeridos por Slic3r para hacer un trabajo. A saber, parametros
@@ -93,6 +98,17 @@ class MaterialProfile(models.Model):
     def __str__(self):
         return self.config_name
 
+    def filament_weight(self, length):
+        # Weight (g) of length mm of filament, with the density and diameter of the slicer configuration. Multiple
+        # extruders are configured as comma separated lists, we use the first one
+        def first_value(key, default):
+            try:
+                return float(str((self.config or {}).get(key, default)).split(',')[0])
+            except ValueError:
+                return default
+        return gcode_analyzer.filament_weight(length, first_value('filament_density', 0),
+                                              first_value('filament_diameter', 1.75))
+
     def get_dict(self):
         return {**self.config,
                 'bed_temperature': self.bed_temperature,
@@ -136,7 +152,7 @@ Un archivo STL es la entrada requerida por el Slic3r. Consta de informacion de s
 '''
 
 
-class TweakerResult(models.Model):
+class TweakerResult(TaskStatusMixin, models.Model):
     unprintability_factor = models.FloatField(default=0, null=True)
     rotation_matrix = ArrayField(ArrayField(models.FloatField(), size=3), size=3, null=True)
     size_x = models.FloatField(blank=True, default=0, null=True)
@@ -151,14 +167,14 @@ class TweakerResult(models.Model):
     def ready(self):
         if self.rotation_matrix is not None:
             return True
-        return False if not TaskResult.objects.filter(task_id=self.celery_id).exists() else TaskResult.objects.filter(task_id=self.celery_id).first().status in states.READY_STATES
+        return task_ready(self)
 
     @property
     def support_needed(self):
         return True if self.unprintability_factor > 5 else False
 
 
-class GeometryResult(models.Model):
+class GeometryResult(TaskStatusMixin, models.Model):
     mean_layer_height = models.FloatField(default=0.15, null=True)
     plot = models.ImageField(upload_to='slaicer/plots/', null=True)
     celery_id = models.CharField(max_length=50, null=True)
@@ -170,12 +186,13 @@ class GeometryResult(models.Model):
     def ready(self):
         if self.mean_layer_height is not None:
             return True
-        return False if not TaskResult.objects.filter(task_id=self.celery_id).exists() else TaskResult.objects.filter(task_id=self.celery_id).first().status in states.READY_STATES
+        return task_ready(self)
 
 
 class GeometryModelManager(models.Manager):
-    def create_object(self, file, orientation_req=True, geometry_req=True, scale=1):
-        o = self.create(file=file, orientation_req=orientation_req, geometry_req=geometry_req, scale=scale)
+    def create_object(self, file, orientation_req=True, geometry_req=True, scale=1, orientation_mode='full'):
+        o = self.create(file=file, orientation_req=orientation_req, geometry_req=geometry_req, scale=scale,
+                        orientation_mode=orientation_mode)
         o.create_orientation_result()
         o.create_geometry_result()
         return o
@@ -183,7 +200,15 @@ class GeometryModelManager(models.Manager):
 
 class GeometryModel(models.Model):
     file = models.FileField(upload_to='slaicer/geometry/')
+    # Parsed mesh (see tools/mesh_artifact.py). It's created on upload
+    mesh_artifact = models.FileField(upload_to='slaicer/meshes/', null=True, blank=True)
     orientation_req = models.BooleanField(default=True)
+    # Multi-resolution: the orientation search runs on a simplified mesh (see tools/orientation_optimization.py)
+    orientation_mode_options = (
+        ('full', 'Full resolution'),
+        ('multires', 'Multi-resolution')
+    )
+    orientation_mode = models.CharField(choices=orientation_mode_options, default='full', max_length=10)
     geometry_req = models.BooleanField(default=True)
     # We use the quality field, to limit the range of values that mean_layer_height can take
     quality_options = (
@@ -200,46 +225,61 @@ class GeometryModel(models.Model):
 
     # The worker may be running on a different server, so, we might need to fetch the model from the database server
     def get_model_path(self):
-        print(self.file.path)
-        if os.path.exists(self.file.path):
-            return self.file.path
+        return self._get_local_path(self.file)
+
+    def _get_local_path(self, field):
+        if os.path.exists(field.path):
+            return field.path
         else:
-            # We need to download the file
-            http = get_connection_pool()
+            # We need to download the file. Downloads are cached on the worker (see tools/model_cache.py)
             url = "{protocol}://{domain}{url}".format(**{'protocol': settings.CURRENT_PROTOCOL,
                                                          'domain': Site.objects.get_current().domain,
-                                                         'url': self.file.url})
-            path = "{base_dir}/tmp/{id}-{rand_string}.{extension}".format(**{'base_dir': settings.BASE_DIR,
-                                                                             'id': self.id,
-                                                                             'rand_string': ''.join(
-                                                                                 random.choice(string.ascii_letters) for
-                                                                                 m in range(10)),
-                                                                             'extension': self.file.name.split('.')[
-                                                                                 -1]})
-
-        with open(path, 'wb') as file:
-            file.write(http.request('GET', url).data)
-        return path
-
-    def create_orientation_result(self):
+                                                         'url': field.url})
+            return model_cache.fetch(get_connection_pool(), url, field.name)
+
+    def build_mesh_artifact(self):
+        triangles = mesh_artifacts.parse_triangles(self.get_model_path())
+        self.mesh_artifact.save('{}{}'.format(self.id, mesh_artifacts.EXTENSION), mesh_artifacts.to_file(triangles),
+                                save=False)
+        GeometryModel.objects.filter(pk=self.pk).update(mesh_artifact=self.mesh_artifact.name)
+
+    def get_triangles(self, mmap=True):
+        # Triangles array (faces, 3, 3), memory-mapped. Models uploaded before the artifacts existed get it now
+        if not self.mesh_artifact:
+            self.build_mesh_artifact()
+        return mesh_artifacts.load(self._get_local_path(self.mesh_artifact), mmap=mmap)
+
+    def orientation_signature(self):
         # Does the instance exists already?
         if hasattr(self, 'orientation') or not self.orientation_req:
             return None
-        # Ok, no, lets create the task
-        task = tasks.fill_tweaker_result.s(self.id).apply_async()
-        TweakerResult.objects.create(geometry_model=self, celery_id=task.id)
+        # Ok, no, lets create the result. The task id is set beforehand, so it can be launched later (i.e., on a chord)
+        signature = tasks.fill_tweaker_result.si(self.id).set(task_id=uuid())
+        TweakerResult.objects.create(geometry_model=self, celery_id=signature.id)
+        return signature
+
+    def create_orientation_result(self):
+        signature = self.orientation_signature()
+        if signature is not None:
+            signature.apply_async()
 
     @property
     def orientation_result_ready(self):
         return False if not hasattr(self, 'orientation') else self.orientation.ready()
 
-    def create_geometry_result(self):
+    def geometry_signature(self):
         # Does the instance exists already?
         if hasattr(self, 'geometry') or not self.geometry_req:
             return None
-        # Ok, no, lets create the task
-        task = tasks.fill_geometry_result.s(self.id).apply_async()
-        GeometryResult.objects.create(geometry_model=self, celery_id=task.id)
+        # Ok, no, lets create the result (see orientation_signature)
+        signature = tasks.fill_geometry_result.si(self.id).set(task_id=uuid())
+        GeometryResult.objects.create(geometry_model=self, celery_id=signature.id)
+        return signature
+
+    def create_geometry_result(self):
+        signature = self.geometry_signature()
+        if signature is not None:
+            signature.apply_async()
 
     @property
     def geometry_result_ready(self):
@@ -254,6 +294,16 @@ class GeometryModel(models.Model):
         return float(self.quality.split(',')[1]) if self.quality is not None else None
 
 
+@receiver(post_save, sender=GeometryModel)
+def create_mesh_artifact(sender, instance, created, **kwargs):
+    if created and not instance.mesh_artifact:
+        try:
+            instance.build_mesh_artifact()
+        except Exception:
+            # It's built again (or the error raised) when a task needs it
+            logging.warning("Couldn't parse GeometryModel {} file".format(instance.id))
+
+
 '''
 SliceConfiguration nuclea las instancias de los modelos anteriores, y se utiliza principalmente para definir los atributos
 que desprenden de este.
@@ -298,7 +348,7 @@ Trabajo de sliceo. Acepta multiples STLs
 '''
 
 class SliceJobManager(models.Manager):
-    def quote_object(self, model):
+    def quote_object(self, model, launch=True):
         # It's a quoting slicejob? We specify the quoting profile
         if not SliceConfiguration.objects.filter(quoting_profile=True).exists():
             raise ValidationError("Quoting profile incorrectly configured. Please set one")
@@ -312,11 +362,12 @@ class SliceJobManager(models.Manager):
         o.geometry_models.add(model)
         profile.job = o
         profile.save()
-        o.launch_task()
+        if launch:
+            o.launch_task()
         return o
 
 
-class SliceJob(models.Model):
+class SliceJob(TaskStatusMixin, models.Model):
     # Parametros de trabajo
     geometry_models = models.ManyToManyField(GeometryModel)
     save_gcode = models.BooleanField(default=False)
@@ -328,9 +379,14 @@ class SliceJob(models.Model):
     weight = models.FloatField(null=True, blank=True)
     build_time = models.FloatField(null=True, blank=True)
     gcode = models.FileField(upload_to='slaicer/gcode/', null=True, blank=True)
+    # Decompressed gcode size (see gcode_storage)
+    gcode_size = models.BigIntegerField(null=True, blank=True)
     # El perfil se especifica mediante el O2O de SliceConfiguration
     # TODO: Tener en cuenta bed_shape al slicear en quote
     quote = models.BooleanField(default=False)
+    # Plates (several pieces on the same bed, see skynet/tools/plate_packing.py): position of each copy on the bed, as
+    # {'model': GeometryModel id, 'x': mm, 'y': mm, 'rotated': bool}. Without it, the slicer arranges the models
+    placements = JSONField(null=True, blank=True)
 
     objects = SliceJobManager()
 
@@ -341,13 +397,22 @@ class SliceJob(models.Model):
     def ready(self):
         if self.build_time is not None:
             return True
-        return False if not TaskResult.objects.filter(task_id=self.celery_id).exists() else TaskResult.objects.filter(task_id=self.celery_id).first().status in states.READY_STATES
+        return task_ready(self)
 
-    def launch_task(self):
+    def task_signature(self, wait_for_models=True):
+        '''
+        Slicing task, with its id already saved. Used to launch it after other tasks (see OrderQuote). wait_for_models:
+        the task retries until its models analysis is ready. Not needed if it runs after the analysis tasks
+        '''
         if not hasattr(self, 'profile'):
             raise ValidationError("Profile not specified")
-        self.celery_id = tasks.slice_model.s(self.id).apply_async(countdown=1)
+        signature = tasks.slice_model.si(self.id, wait_for_models=wait_for_models).set(task_id=uuid())
+        self.celery_id = signature.id
         self.save(update_fields=['celery_id'])
+        return signature
+
+    def launch_task(self):
+        self.task_signature().apply_async(countdown=1)
 
     # Sometimes we need the build_time, while we are slicing the model
     def get_estimated_build_time(self):
@@ -1,22 +1,35 @@
 from __future__ import absolute_import, unicode_literals
 from celery import shared_task
+from celery.signals import worker_process_init
 from django.conf import settings
 from . import models as modelos
 import numpy as np
 import trimesh
-from .tools.orientation_optimization import generate_tweaker_result
+from .tools.orientation_optimization import generate_tweaker_result, load_tweaker_modules
 from .tools.layer_height_optimization import LayerHeightOptimizer
+from .tools import gcode_storage, gcode_metadata, gcode_analyzer, mesh_artifact, slicer_backends
 import os
+import time
+import tempfile
 from django.core.files import File
-import random, string
 from django.urls import reverse
 from django.contrib.sites.models import Site
 import requests
 import csv
-import subprocess
-import re
+import logging
 from django.core.files.base import ContentFile
 
+@worker_process_init.connect
+def preload_tweaker(**kwargs):
+    # Tweaker-3 modules are loaded once per worker process, before the first orientation task
+    if not settings.TWEAKER_PRELOAD:
+        return
+    try:
+        load_tweaker_modules()
+    except Exception:
+        logging.warning("Couldn't preload Tweaker-3. Is slaicer/lib configured?")
+
+
 class ModelNotReady(Exception):
     """Model not ready exception, used for celery autoretry"""
     pass
@@ -29,15 +42,18 @@ def fill_tweaker_result(geometrymodel_id):
         raise ModelNotReady
     # Returns a Tweak instance
     tweaker_result = generate_tweaker_result(geometrymodel)
-    mesh = trimesh.load_mesh(geometrymodel.get_model_path())
+    # Model size, as it's printed (i.e., its footprint is used to pack plates)
+    rotation = np.eye(4)
+    rotation[:3, :3] = tweaker_result.matrix
+    extents = mesh_artifact.extents(mesh_artifact.transform(geometrymodel.get_triangles(), rotation))
     tr = geometrymodel.orientation
 
     # Tenemos lo necesario, guardamos
     tr.unprintability = tweaker_result.unprintability
     tr.rotation_matrix = tweaker_result.matrix.tolist()
-    tr.size_x = mesh.bounding_box.primitive.extents[0]
-    tr.size_y = mesh.bounding_box.primitive.extents[1]
-    tr.size_z = mesh.bounding_box.primitive.extents[2]
+    tr.size_x = extents[0]
+    tr.size_y = extents[1]
+    tr.size_z = extents[2]
     tr.save()
 
 
@@ -49,8 +65,9 @@ def fill_geometry_result(geometrymodel_id):
         raise ModelNotReady
 
     # Returns a LayerHeightOptimizer instance
-    lho = LayerHeightOptimizer.import_from_geometrymodel(geometrymodel)
-    lho.create_layer_profile()
+    lho = LayerHeightOptimizer.import_from_geometrymodel(geometrymodel, workers=settings.GEOMETRY_ANALYSIS_WORKERS,
+                                                         chunk_size=settings.GEOMETRY_ANALYSIS_CHUNK_SIZE)
+    lho.create_layer_profile(workers=settings.GEOMETRY_ANALYSIS_WORKERS, chunk_size=settings.GEOMETRY_ANALYSIS_CHUNK_SIZE)
     geometrymodel.geometry.mean_layer_height = lho.calculate_layer_height()
     geometrymodel.geometry.save()
 
@@ -67,62 +84,21 @@ def fill_geometry_result(geometrymodel_id):
         requests.post(url, files={'plot': lho.plot_layers_profile().open('rb')})
 
 
-def parse_weight(line):
-    return float(re.split('= ', line)[1])
-
-
-def parse_build_time(line):
-    line = re.split('=', line)[1]
-    if 'd' in line:
-        output_slic3r = re.split('[dhms]', line)
-        # Time to seconds conversion
-        printing_time_s = int(output_slic3r[0]) * 24 * 60 ** 2 + int(output_slic3r[1]) * 60 ** 2 + int(
-            output_slic3r[2]) * 60 + int(output_slic3r[3])
-    elif 'h' in line:
-        output_slic3r = re.split('[hms]', line)
-        printing_time_s = int(output_slic3r[0]) * 60 ** 2 + int(output_slic3r[1]) * 60 + int(output_slic3r[2])
-    elif 'm ' in line:
-        output_slic3r = re.split('[ms]', line)
-        printing_time_s = int(output_slic3r[0]) * 60 + int(output_slic3r[1])
-    else:
-        output_slic3r = re.split('s', line)
-        printing_time_s = int(output_slic3r[0])
-    return printing_time_s
-
-
-
-
-@shared_task(queue='celery', autoretry_for=(ModelNotReady,), max_retries=60, default_retry_delay=2)
-def slice_model(slicejob_id):
+@shared_task(bind=True, queue='slicer', autoretry_for=(ModelNotReady,), max_retries=60, default_retry_delay=2)
+def slice_model(self, slicejob_id, wait_for_models=True):
     try:
         slicejob = modelos.SliceJob.objects.get(id=slicejob_id)
     except modelos.SliceJob.DoesNotExist:
         raise ModelNotReady
     models = slicejob.geometry_models.all()
 
-    # Are all the models ready?
-    for obj in models:
-        if obj.orientation_req and not obj.orientation_result_ready:
-            raise ModelNotReady
-        if obj.geometry_req and not obj.geometry_result_ready:
-            raise ModelNotReady
-
-    # Model orientation
-    models_path = []
-    for obj in models:
-        mesh = trimesh.load(obj.get_model_path())
-        euler_angles = trimesh.transformations.euler_from_matrix(np.array(obj.orientation.rotation_matrix), 'rxyz')
-        rotation_matrix = trimesh.transformations.euler_matrix(*euler_angles, 'rxyz')
-        mesh.apply_transform(rotation_matrix)
-        # Do we need to rescale the model?
-        if obj.scale != 1.0:
-            mesh.apply_transform(trimesh.transformations.scale_matrix(obj.scale, [0, 0, 0]))
-        # Save rotated model
-        rand_str = ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
-        path = os.path.join(settings.BASE_DIR, 'tmp', rand_str + '.stl')
-        with open(path, 'wb') as f:
-            f.write(trimesh.exchange.stl.export_stl(mesh))
-        models_path.append(path)
+    # Are all the models ready? Tasks launched after the analysis (see OrderQuoteManager) don't need to check it
+    if wait_for_models:
+        for obj in models:
+            if obj.orientation_req and not obj.orientation_result_ready:
+                raise ModelNotReady
+            if obj.geometry_req and not obj.geometry_result_ready:
+                raise ModelNotReady
 
     # Profile configuration
     if slicejob.profile.auto_print_profile:
@@ -148,47 +124,81 @@ def slice_model(slicejob_id):
 
     slicejob.profile.save()
 
-    # All set, we write the configuration to a ini file
-    rand_str = ''.join(random.choice(string.ascii_letters) for m in range(10))
-    ini_path = os.path.join(settings.BASE_DIR, 'tmp/', rand_str + '.ini')
-    output_path = os.path.join(settings.BASE_DIR, 'tmp/', rand_str + '.gcode')
-    full_config = {**slicejob.profile.print.get_dict(), **slicejob.profile.printer.get_dict(),
-                   **slicejob.profile.material.get_dict()}
-    with open(ini_path, 'w') as f:
-        writer = csv.writer(f, delimiter='=', )
-        for key, value in full_config.items():
-            writer.writerow([key, value])
-
-    # We launch Slic3r using subprocess
-    slic3r_bin_dir = os.path.join(settings.BASE_DIR, 'slaicer/lib/Slic3r/slic3r.pl')
-    if not os.path.exists(slic3r_bin_dir):
-        raise modelos.LibrariesNotConfigured
-    print([slic3r_bin_dir, '--load', ini_path, '-m', '-o', output_path, *models_path])
-    proc = subprocess.run([slic3r_bin_dir, '--load', ini_path, '-o', output_path, *models_path],
-                          universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    for line in proc.stdout.splitlines():
-        if 'Done' in line:
-            # We search for print time in the output
-            proc = subprocess.run(['tail', output_path, '-n', '500'], universal_newlines=True, stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE)
-            for line in proc.stdout.splitlines():
-                if 'estimated printing time (normal mode)' in line:
-                    slicejob.build_time = parse_build_time(line)
-                elif 'filament used' in line and 'cm' not in line:
-                    slicejob.weight = parse_weight(line)
+    # All set. Rotated models, configuration and output are written to a temporary directory, removed when we finish
+    tmp_dir = os.path.join(settings.BASE_DIR, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as workdir:
+        # Model orientation
+        transformations = {}
+        for obj in models:
+            euler_angles = trimesh.transformations.euler_from_matrix(np.array(obj.orientation.rotation_matrix), 'rxyz')
+            transformations[obj.id] = trimesh.transformations.euler_matrix(*euler_angles, 'rxyz')
+            # Do we need to rescale the model?
+            if obj.scale != 1.0:
+                transformations[obj.id] = trimesh.transformations.scale_matrix(obj.scale, [0, 0, 0]) @ \
+                                          transformations[obj.id]
+        # Save rotated models. Plates have a copy of each model on every placement
+        if slicejob.placements:
+            copies = [(p['model'], p) for p in slicejob.placements]
+        else:
+            copies = [(obj.id, None) for obj in models]
+        triangles = {obj.id: obj.get_triangles() for obj in models}
+        models_path = []
+        for i, (model_id, placement) in enumerate(copies):
+            model_triangles = mesh_artifact.transform(triangles[model_id], transformations[model_id])
+            if placement is not None:
+                model_triangles = mesh_artifact.place(model_triangles, placement['x'], placement['y'],
+                                                      placement['rotated'])
+            path = os.path.join(workdir, 'model_{}.stl'.format(i))
+            mesh_artifact.write_stl(path, model_triangles)
+            models_path.append(path)
+
+        # Slicer configuration
+        ini_path = os.path.join(workdir, 'config.ini')
+        output_path = os.path.join(workdir, 'model.gcode')
+        full_config = {**slicejob.profile.print.get_dict(), **slicejob.profile.printer.get_dict(),
+                       **slicejob.profile.material.get_dict()}
+        with open(ini_path, 'w') as f:
+            writer = csv.writer(f, delimiter='=', )
+            for key, value in full_config.items():
+                writer.writerow([key, value])
+
+        # We launch the slicer. Its output is streamed to the task state, as progress. The state is stored on the
+        # results backend (a database write), so it's updated at most once every SLICER_PROGRESS_INTERVAL seconds
+        last_report = [0.]
+
+        def report_progress(line):
+            if self.request.id is not None and line and \
+                    time.monotonic() - last_report[0] >= settings.SLICER_PROGRESS_INTERVAL:
+                last_report[0] = time.monotonic()
+                self.update_state(state='PROGRESS', meta={'output': line})
+
+        run = slicer_backends.get_backend().run(ini_path, output_path, models_path, arranged=bool(slicejob.placements),
+                                                on_line=report_progress)
+        if run.ok:
+            # We read print time and weight from the output comments
+            metadata = gcode_metadata.read_path(output_path)
+            build_time, filament_length = metadata.build_time, metadata.filament_length
+            if build_time is None or (metadata.filament_weight is None and filament_length is None):
+                # The slicer doesn't write its estimations, so we estimate them from the moves
+                analysis = gcode_analyzer.analyze_path(output_path)
+                build_time = analysis.build_time if build_time is None else build_time
+                filament_length = analysis.filament_length if filament_length is None else filament_length
+            slicejob.build_time = build_time
+            slicejob.weight = metadata.filament_weight
+            if slicejob.weight is None:
+                # From the filament used, as quote_gcode does
+                slicejob.weight = slicejob.profile.material.filament_weight(filament_length)
             slicejob.save(update_fields=['build_time', 'weight'])
             # We save the gcode
             if slicejob.save_gcode:
                 with open(output_path, 'rb') as f:
-                    slicejob.gcode.save('model.gcode', ContentFile(f.read()))
-            # Temp files cleaning
-            os.remove(ini_path)
-            os.remove(output_path)
+                    slicejob.gcode_size = gcode_storage.save_gcode(slicejob.gcode, 'model.gcode', f, save=False)
+                slicejob.save(update_fields=['gcode', 'gcode_size'])
             return True
-    # Slicer didn't finish correctly
-    else:
-        slicejob.error_log = proc.stderr
-        print(proc.stderr)
-        print(proc.stdout)
-        slicejob.save(update_fields=['error_log'])
-        return False
+        # Slicer didn't finish correctly
+        else:
+            slicejob.error_log = run.output
+            logging.error(run.output)
+            slicejob.save(update_fields=['error_log'])
+            return False
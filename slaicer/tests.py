@@ -1,3 +1,402 @@
-from django.test import TestCase
+import gzip
+import io
+import os
+import tempfile
+from unittest import mock
+import numpy as np
+import trimesh
+from django.core.files import File
+from django.test import SimpleTestCase, override_settings
+from slaicer.tools import gcode_analyzer, gcode_metadata, gcode_storage, model_cache, task_results
+from slaicer.tools import layer_height_optimization, parallel_geometry
 
-# Create your tests here.
+
+@override_settings(GCODE_ANALYZER_ACCELERATION=1000, GCODE_ANALYZER_JERK=10)
+class GcodeAnalyzerTestCase(SimpleTestCase):
+    def analyze(self, gcode, **kwargs):
+        return gcode_analyzer.analyze_stream(io.BytesIO(gcode), **kwargs)
+
+    def test_trapezoid(self):
+        # 100 mm at 100 mm/s, from and to the jerk speed (10 mm/s): 4.95 mm accelerating, 4.95 mm decelerating
+        analysis = self.analyze(b'G1 X100 F6000\n')
+        self.assertAlmostEqual(analysis.build_time, 2 * (100 - 10) / 1000 + (100 - 2 * 4.95) / 100)
+        self.assertEqual(analysis.moves, 1)
+
+    def test_triangle(self):
+        # Too short to reach the nominal speed
+        durations = gcode_analyzer.move_durations(np.array([1.]), np.array([[1., 0, 0]]), np.array([100.]), 1000, 10)
+        peak = np.sqrt(1000 * 1 + 10 ** 2)
+        self.assertAlmostEqual(durations[0], 2 * (peak - 10) / 1000)
+
+    def test_filament_length(self):
+        gcode = b'G90\nM82\nG1 X10 E5 F1200\nG1 X20 E8\nG92 E0\nG1 X30 E2\nM83\nG1 X40 E1.5\nG1 E-1\n'
+        self.assertAlmostEqual(self.analyze(gcode).filament_length, 8 + 2 + 1.5 - 1)
+
+    def test_relative_moves(self):
+        absolute = self.analyze(b'G1 X10 Y10 F3000\nG1 X20 Y20\nG1 X30 Y30\n')
+        relative = self.analyze(b'G91\nG1 X10 Y10 F3000\nG1 X10 Y10\nG1 X10 Y10\n')
+        self.assertAlmostEqual(absolute.build_time, relative.build_time)
+
+    def test_dwell(self):
+        base = self.analyze(b'G1 X10 F3000\n').build_time
+        self.assertAlmostEqual(self.analyze(b'G1 X10 F3000\nG4 P1500\nG4 S2\n').build_time, base + 3.5)
+
+    def test_acceleration(self):
+        slow = self.analyze(b'M204 P500\nG1 X100 F6000\n').build_time
+        self.assertAlmostEqual(slow, self.analyze(b'G1 X100 F6000\n', acceleration=500).build_time)
+
+    def test_line_numbers_and_checksums(self):
+        plain = self.analyze(b'G1 X10 Y0 F1200\nG1 X10 Y10 E5\nG92 E0\nG1 X20 E2\n')
+        numbered = self.analyze(b'N0 M110 N0*125\nN1 G1 X10 Y0 F1200*45\nN2 G1 X10 Y10 E5*33\nN3 G92 E0*12\n'
+                                b'N4 G1 X20 E2*1\n')
+        self.assertEqual(numbered, plain)
+        self.assertEqual(numbered.moves, 3)
+
+    def test_state_commands_dont_stop(self):
+        joined = self.analyze(b'G1 X100 F6000\nG1 X200\n')
+        self.assertEqual(self.analyze(b'G1 X100 F6000\nG92 E0\nG1 X200\n'), joined)
+        self.assertGreater(self.analyze(b'G1 X100 F6000\nG4 P0\nG1 X200\n').build_time, joined.build_time)
+
+    def test_packed_words(self):
+        self.assertEqual(self.analyze(b'G1X10Y10F1200\nG1X20E2\n'), self.analyze(b'G1 X10 Y10 F1200\nG1 X20 E2\n'))
+
+    def test_comments(self):
+        self.assertEqual(self.analyze(b'; G1 X100\nG1 X10 F1200 ; G1 X100\n'), self.analyze(b'G1 X10 F1200\n'))
+
+    def test_batches_and_blocks(self):
+        gcode = b''.join(b'G1 X%d Y%d E%d F1800\n' % (i % 100, i % 37, i) for i in range(5000))
+        expected = self.analyze(gcode)
+        with mock.patch.object(gcode_analyzer, 'BATCH_SIZE', 7), mock.patch.object(gcode_analyzer, 'BLOCK_SIZE', 1000):
+            analysis = self.analyze(gcode)
+        self.assertAlmostEqual(analysis.build_time, expected.build_time)
+        self.assertAlmostEqual(analysis.filament_length, expected.filament_length)
+        self.assertEqual(analysis.moves, expected.moves)
+
+    def test_compressed_path(self):
+        gcode = b'G1 X10 Y10 F1200\nG1 X20 E2\n'
+        with tempfile.TemporaryDirectory() as directory:
+            plain, compressed = os.path.join(directory, 'a.gcode'), os.path.join(directory, 'a.gcode.gz')
+            with open(plain, 'wb') as f:
+                f.write(gcode)
+            with gzip.open(compressed, 'wb') as f:
+                f.write(gcode)
+            self.assertEqual(gcode_analyzer.analyze_path(compressed), gcode_analyzer.analyze_path(plain))
+
+    def test_filament_weight(self):
+        # 1 m of 1.75 mm PLA (1.24 g/cm^3)
+        self.assertAlmostEqual(gcode_analyzer.filament_weight(1000, 1.24), 2.98, places=2)
+
+
+class GcodeMetadataTestCase(SimpleTestCase):
+    body = b''.join(b'G1 X%d Y%d E%d\n' % (i % 100, i % 37, i) for i in range(30000))
+    prusa_tail = (b'; filament used [mm] = 1234.56\n; filament used [cm3] = 2.97\n; filament used [g] = 3.68\n'
+                  b'; estimated printing time (normal mode) = 1h 2m 3s\n')
+    cura_head = b';FLAVOR:Marlin\n;TIME:3723\n;Filament used: 1.23456m\n;Generated with Cura_SteamEngine 4.8.0\n'
+
+    def read(self, gcode):
+        return gcode_metadata.read_stream(io.BytesIO(gcode))
+
+    def test_prusaslicer(self):
+        metadata = self.read(b'; generated by PrusaSlicer 2.3.0\n' + self.body + self.prusa_tail)
+        self.assertEqual(metadata, gcode_metadata.GcodeMetadata('PrusaSlicer', 3723, 1234.56, 3.68))
+
+    def test_slic3r(self):
+        gcode = b'; generated by Slic3r 1.3.0\n' + self.body + b'; filament used = 1234.5mm (2.9cm3)\n' + \
+                b''.join(b'; setting_%d = %d\n' % (i, i) for i in range(5000))
+        metadata = self.read(gcode)
+        self.assertEqual(metadata.slicer, 'Slic3r')
+        self.assertEqual(metadata.filament_length, 1234.5)
+        self.assertIsNone(metadata.build_time)
+
+    def test_cura(self):
+        metadata = self.read(self.cura_head + self.body)
+        self.assertEqual(metadata.slicer, 'Cura')
+        self.assertEqual(metadata.build_time, 3723)
+        self.assertAlmostEqual(metadata.filament_length, 1234.56)
+
+    def test_simplify3d(self):
+        gcode = b'; G-Code generated by Simplify3D(R) Version 4.1.2\n' + self.body + \
+                b';   Build time: 2 hours 5 minutes\n;   Filament length: 4321.0 mm (4.32 m)\n' \
+                b';   Plastic weight: 12.50 g (0.03 lb)\n'
+        self.assertEqual(self.read(gcode), gcode_metadata.GcodeMetadata('Simplify3D', 7500, 4321.0, 12.5))
+
+    def test_small_file(self):
+        self.assertEqual(self.read(b'; generated by PrusaSlicer 2.3.0\nG1 X10\n' + self.prusa_tail),
+                         gcode_metadata.GcodeMetadata('PrusaSlicer', 3723, 1234.56, 3.68))
+
+    def test_unknown(self):
+        self.assertEqual(self.read(self.body), gcode_metadata.GcodeMetadata(None, None, None, None))
+
+    def test_lines_split_between_blocks(self):
+        gcode = b'; generated by PrusaSlicer 2.3.0\n' + self.body + self.prusa_tail
+        expected = self.read(gcode)
+        for block_size in (7, 100, 1000):
+            with mock.patch.object(gcode_metadata, 'BLOCK_SIZE', block_size), \
+                    mock.patch.object(gcode_metadata, 'HEAD_SIZE', 50):
+                self.assertEqual(self.read(gcode), expected)
+
+    def test_compressed(self):
+        gcode = b'; generated by PrusaSlicer 2.3.0\n' + self.body + self.prusa_tail
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'a.gcode.gz')
+            with gzip.open(path, 'wb') as f:
+                f.write(gcode)
+            self.assertEqual(gcode_metadata.read_path(path), self.read(gcode))
+
+    def test_parse_duration(self):
+        self.assertEqual(gcode_metadata.parse_duration('1d 2h 3m 4s'), 93784)
+        self.assertEqual(gcode_metadata.parse_duration('2 hours 5 minutes'), 7500)
+        with self.assertRaises(ValueError):
+            gcode_metadata.parse_duration('soon')
+
+
+class GcodeStorageTestCase(SimpleTestCase):
+    gcode = b''.join(b'G1 X%d Y%d E%d\n' % (i % 100, i % 37, i) for i in range(20000))
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def stored(self, name, content):
+        # Django File on disk, like the ones FileFields return
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        file = File(open(path, 'rb'), name=path)
+        self.addCleanup(file.close)
+        return file
+
+    def compressed(self):
+        content = gcode_storage.compress_gcode(io.BytesIO(self.gcode), 'a.gcode')
+        with content:
+            return content.gcode_size, self.stored(content.name, content.read())
+
+    def test_round_trip(self):
+        size, file = self.compressed()
+        self.assertEqual(size, len(self.gcode))
+        self.assertTrue(gcode_storage.is_compressed(file))
+        self.assertLess(file.size, len(self.gcode))
+        with gcode_storage.open_gcode(file) as f:
+            self.assertEqual(f.read(), self.gcode)
+
+    def test_plain_files(self):
+        file = self.stored('a.gcode', self.gcode)
+        self.assertFalse(gcode_storage.is_compressed(file))
+        with gcode_storage.open_gcode(file) as f:
+            self.assertEqual(f.read(), self.gcode)
+        self.assertEqual(gcode_storage.gcode_size(file), len(self.gcode))
+
+    def test_text_streams(self):
+        content = gcode_storage.compress_gcode(io.StringIO(self.gcode.decode()), 'a.gcode')
+        with content:
+            self.assertEqual(gzip.decompress(content.read()), self.gcode)
+            self.assertEqual(content.gcode_size, len(self.gcode))
+
+    def test_gcode_size(self):
+        _, file = self.compressed()
+        self.assertEqual(gcode_storage.gcode_size(file, stored_size=123), 123)
+        # From the gzip trailer
+        with mock.patch.object(gcode_storage, 'open_gcode') as open_gcode:
+            self.assertEqual(gcode_storage.gcode_size(file), len(self.gcode))
+            open_gcode.assert_not_called()
+        # Too big to trust the trailer: counted
+        with mock.patch.object(gcode_storage, 'MAX_COMPRESSION_RATIO', 2 ** 32):
+            self.assertEqual(gcode_storage.gcode_size(file), len(self.gcode))
+
+    def test_names(self):
+        self.assertEqual(gcode_storage.compressed_name('a.gcode'), 'a.gcode.gz')
+        self.assertEqual(gcode_storage.compressed_name('a.gcode.gz'), 'a.gcode.gz')
+        self.assertEqual(gcode_storage.plain_name('a.gcode.gz'), 'a.gcode')
+        self.assertEqual(gcode_storage.plain_name('a.gcode'), 'a.gcode')
+
+
+class TaskResultsTestCase(SimpleTestCase):
+    class Job:
+        def __init__(self, celery_id):
+            self.celery_id = celery_id
+
+        def refresh_from_db(self):
+            pass
+
+    class RefreshableJob(task_results.TaskStatusMixin, Job):
+        pass
+
+    def setUp(self):
+        patcher = mock.patch.object(task_results, 'TaskResult')
+        self.objects = patcher.start().objects
+        self.addCleanup(patcher.stop)
+        self.objects.filter.return_value.values_list.return_value = [('a', 'SUCCESS'), ('b', 'STARTED')]
+
+    def test_single_query(self):
+        jobs = [self.Job('a'), self.Job('b'), self.Job('c'), self.Job(None), None]
+        task_results.resolve_task_status(jobs)
+        self.objects.filter.assert_called_once_with(task_id__in={'a', 'b', 'c'})
+        self.assertEqual([task_results.task_status(j) for j in jobs[:4]], ['SUCCESS', 'STARTED', None, None])
+        self.assertTrue(task_results.task_ready(jobs[0]))
+        self.assertFalse(task_results.task_ready(jobs[1]))
+        self.assertEqual(self.objects.filter.call_count, 1)
+
+    def test_changed_task_id(self):
+        job = self.Job('a')
+        task_results.resolve_task_status([job])
+        job.celery_id = 'd'
+        self.objects.filter.return_value.values_list.return_value = mock.Mock(first=mock.Mock(return_value='PENDING'))
+        self.assertEqual(task_results.task_status(job), 'PENDING')
+        self.objects.filter.assert_called_with(task_id='d')
+
+    def test_refresh_from_db(self):
+        job = self.RefreshableJob('a')
+        task_results.resolve_task_status([job])
+        job.refresh_from_db()
+        self.assertNotIn(task_results.CACHE_ATTRIBUTE, job.__dict__)
+
+    def test_no_task(self):
+        self.assertIsNone(task_results.task_status(self.Job(None)))
+        self.objects.filter.assert_not_called()
+
+
+class ModelCacheTestCase(SimpleTestCase):
+    class Response:
+        def __init__(self, status, content=b'', etag=None):
+            self.status, self.content = status, content
+            self.headers = {'ETag': etag} if etag is not None else {}
+
+        def stream(self, chunk_size):
+            yield self.content
+
+        def release_conn(self):
+            pass
+
+    class Server:
+        # Answers 304 whenever the request has the current ETag
+        def __init__(self, content, etag):
+            self.content, self.etag, self.requests = content, etag, []
+
+        def request(self, method, url, headers=None, preload_content=True):
+            headers = headers or {}
+            self.requests.append(headers)
+            if headers.get('If-None-Match') == self.etag:
+                return ModelCacheTestCase.Response(304)
+            return ModelCacheTestCase.Response(200, self.content, self.etag)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(MODEL_CACHE_DIR=directory.name, MODEL_CACHE_MAX_SIZE=10 ** 6)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_validated_copy(self):
+        server = self.Server(b'solid', '"1"')
+        path = model_cache.fetch(server, 'http://server/a.stl', 'a.stl')
+        self.assertEqual(model_cache.fetch(server, 'http://server/a.stl', 'a.stl'), path)
+        self.assertEqual(server.requests, [{}, {'If-None-Match': '"1"'}])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'solid')
+
+    def test_evicted_while_validating(self):
+        server = self.Server(b'solid', '"1"')
+        path = model_cache.fetch(server, 'http://server/a.stl', 'a.stl')
+        real_exists = os.path.exists
+
+        def evicted(p):
+            # The ETag is read, and the file is evicted right after
+            exists = real_exists(p)
+            if p == path and exists:
+                os.remove(p)
+            return exists
+        with mock.patch.object(model_cache.os.path, 'exists', evicted):
+            self.assertEqual(model_cache.fetch(server, 'http://server/a.stl', 'a.stl'), path)
+        self.assertEqual(server.requests[1:], [{'If-None-Match': '"1"'}, {}])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'solid')
+
+
+class LayerHeightOptimizationTestCase(SimpleTestCase):
+    def meshes(self):
+        # Closed meshes, tall triangles (cone, prism sides), and random triangles spanning many layers
+        random = np.random.RandomState(0)
+        yield trimesh.creation.icosphere(subdivisions=2, radius=10).triangles
+        yield trimesh.creation.cone(radius=5, height=20, sections=12).triangles
+        yield trimesh.creation.cone(radius=10, height=6, sections=7).triangles
+        yield trimesh.creation.cone(radius=20, height=3, sections=24).triangles
+        yield random.uniform(0, 10, (200, 3, 3))
+        yield random.uniform(0, 30, (50, 3, 3)) * [1, 1, 0.2] + random.uniform(0, 1, (50, 1, 3))
+
+    def optimizer(self, triangles):
+        limits_inf, limits_sup, angles = layer_height_optimization.faces_limits_and_angles(np.asarray(triangles))
+        height = limits_sup.max() - limits_inf.min()
+        return layer_height_optimization.LayerHeightOptimizer(None, limits_inf, limits_sup, angles, height)
+
+    @staticmethod
+    def reference_profile(optimizer):
+        # The original layer by layer loop
+        limits_inf, limits_sup = optimizer.limits_inf.copy(), optimizer.limits_sup.copy()
+        angles = optimizer.angles.copy()
+        final_z = limits_sup.max()
+        layers_profile = []
+        actual_z = limits_inf.min()
+        while actual_z <= final_z:
+            current_layer_height = optimizer.max_layer_height
+            condition_satisfied = False
+            while not condition_satisfied:
+                trig_index = np.intersect1d(np.flatnonzero(limits_inf < current_layer_height + actual_z),
+                                            np.flatnonzero(limits_sup > actual_z))
+                if len(trig_index) == 0:
+                    condition_satisfied = True
+                for index in trig_index:
+                    if angles[index] * current_layer_height > optimizer.q_factor:
+                        if current_layer_height - optimizer.step_layer_height > optimizer.min_layer_height:
+                            current_layer_height = current_layer_height - optimizer.step_layer_height
+                        else:
+                            current_layer_height = optimizer.min_layer_height
+                            condition_satisfied = True
+                        break
+                    else:
+                        condition_satisfied = True
+            layers_profile.append(current_layer_height)
+            delete_index = np.flatnonzero(limits_sup < current_layer_height + actual_z)
+            limits_sup = np.delete(limits_sup, delete_index)
+            limits_inf = np.delete(limits_inf, delete_index)
+            angles = np.delete(angles, delete_index)
+            actual_z += current_layer_height
+        return layers_profile
+
+    def test_exact_profile_matches_the_original_loop(self):
+        for triangles in self.meshes():
+            optimizer = self.optimizer(triangles)
+            self.assertEqual(optimizer.create_layer_profile(exact=True), self.reference_profile(optimizer))
+
+    def test_grid_profile_satisfies_the_quality_factor(self):
+        for triangles in self.meshes():
+            optimizer = self.optimizer(triangles)
+            profile = optimizer.create_layer_profile()
+            initial_z, final_z = optimizer.limits_inf.min(), optimizer.limits_sup.max()
+            self.assertGreaterEqual(sum(profile), final_z - initial_z)
+            # Layers start on the z grid (cells of step_layer_height). Summing the heights would drift from it
+            cells = 0
+            for h in profile:
+                self.assertIn(h, optimizer.candidate_layer_heights())
+                z = initial_z + cells * optimizer.step_layer_height
+                if h > optimizer.min_layer_height:
+                    in_layer = (optimizer.limits_inf < z + h) & (optimizer.limits_sup > z)
+                    self.assertLessEqual(optimizer.angles[in_layer].max(initial=0) * h, optimizer.q_factor + 1e-9)
+                cells += int(round(h / optimizer.step_layer_height))
+
+    def test_face_chunks_on_threads(self):
+        for triangles in self.meshes():
+            geometrymodel = mock.Mock(get_triangles=mock.Mock(return_value=np.asarray(triangles)))
+            serial = layer_height_optimization.LayerHeightOptimizer.import_from_geometrymodel(geometrymodel)
+            chunked = layer_height_optimization.LayerHeightOptimizer.import_from_geometrymodel(geometrymodel, workers=3,
+                                                                                              chunk_size=7)
+            for attribute in ('limits_inf', 'limits_sup', 'angles'):
+                np.testing.assert_array_equal(getattr(chunked, attribute), getattr(serial, attribute))
+            self.assertEqual(chunked.create_layer_profile(workers=3, chunk_size=7), serial.create_layer_profile())
+
+    def test_map_face_chunks(self):
+        values = np.arange(100)
+        chunks = parallel_geometry.map_face_chunks(lambda a, b, c: (len(a), a.sum() + b.sum() + c),
+                                                   [values, values * 2], args=(1,), workers=4, chunk_size=30)
+        self.assertEqual([n for n, _ in chunks], [30, 30, 30, 10])
+        self.assertEqual(sum(s for _, s in chunks), 3 * values.sum() + 4)
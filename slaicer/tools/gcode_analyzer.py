@@ -0,0 +1,241 @@
+import re
+import gzip
+import math
+import collections
+import numpy as np
+from django.conf import settings
+from . import gcode_storage
+
+'''
+G-code analyzer. Estimates build time and filament used from the moves themselves, for G-code without (known) slicer
+comments (see gcode_metadata.py). The file is read in BLOCK_SIZE blocks, and consecutive G0/G1 moves are computed
+together with NumPy, in batches of up to BATCH_SIZE moves. Other commands that change the state (G90/G91, M82/M83, G92,
+G28, M204) close the current batch. Its last move is computed again with the next batch, so batches are joined as any
+other move, unless the machine stops (G4 dwells, added as they are, and G28).
+Time estimation follows the firmware (Marlin) motion model, without its look-ahead planner: every move is a trapezoid,
+with the given acceleration, and the speed at each junction is limited by the jerk (the maximum instantaneous change of
+the velocity vector) and by the feed rate of both moves.
+'''
+
+BLOCK_SIZE = 4 * 1024 * 1024
+BATCH_SIZE = 100000
+# Feed rate (mm/min) until the G-code sets one
+DEFAULT_FEEDRATE = 3000
+
+GcodeAnalysis = collections.namedtuple('GcodeAnalysis', 'build_time filament_length moves')
+
+# Commands that change the state. They're rare, so the text between them is parsed at once. Lines might have a line
+# number (N123) before the command, and a checksum (*45) after its parameters (i.e., G-code sent by hosts)
+COMMAND = re.compile(rb'^[ \t]*(?:N\d+[ \t]*)?(G90|G91|M82|M83|G92|G28|M204|G4)(?!\d)([^;*\n]*)', re.M)
+MOVE = re.compile(rb'^[ \t]*(?:N\d+[ \t]*)?G0?[01](?!\d)([^;*\n]*)', re.M)
+WORD = re.compile(rb'([XYZEFPS])[ \t]*([-+]?\d*\.?\d+)')
+# Move parameters, and line breaks (to know which move each word belongs to)
+MOVE_WORD = re.compile(rb'[XYZEF][ \t]*[-+]?\d*\.?\d+|\n')
+# Words not separated by spaces (i.e., G1X10E2)
+PACKED_WORDS = re.compile(rb'[^ \n][XYZEF]')
+AXES = (b'X', b'Y', b'Z', b'E')
+
+
+def _forward_fill(values, start):
+    # Missing (NaN) values take the previous value on the column, starting with start
+    values = np.vstack((start, values))
+    index = np.where(np.isnan(values), 0, np.arange(len(values))[:, None])
+    np.maximum.accumulate(index, axis=0, out=index)
+    return values[index, np.arange(values.shape[1])]
+
+
+def move_durations(distance, direction, speed, acceleration, jerk):
+    """
+    Trapezoidal durations (s) of a sequence of moves, starting and ending at rest.
+    distance: (n, ) mm. direction: (n, 3) unit vectors (null for extruder only moves). speed: (n, ) nominal, in mm/s
+    """
+    # Junction speeds: the velocity vector can change up to jerk at once
+    change = np.linalg.norm(np.diff(direction, axis=0), axis=1)
+    with np.errstate(divide='ignore'):
+        junction = np.minimum(np.minimum(speed[:-1], speed[1:]), np.where(change > 0, jerk / change, np.inf))
+    rest = np.minimum(speed[:1], jerk), np.minimum(speed[-1:], jerk)
+    entry = np.concatenate((rest[0], junction))
+    exit = np.concatenate((junction, rest[1]))
+    # Moves that reach their nominal speed: acceleration, cruise and deceleration
+    accelerating = (speed ** 2 - entry ** 2) / (2 * acceleration)
+    decelerating = (speed ** 2 - exit ** 2) / (2 * acceleration)
+    cruise = distance - accelerating - decelerating
+    trapezoid = (2 * speed - entry - exit) / acceleration + np.maximum(cruise, 0) / speed
+    # Short moves: acceleration up to a peak speed, and deceleration
+    peak = np.sqrt(np.maximum(acceleration * distance + (entry ** 2 + exit ** 2) / 2, 0))
+    triangle = (2 * peak - entry - exit) / acceleration
+    # Too short to even go from the entry to the exit speed. We assume a linear change
+    linear = 2 * distance / np.maximum(entry + exit, 1e-9)
+    return np.where(cruise >= 0, trapezoid, np.where(peak >= np.maximum(entry, exit), triangle, linear))
+
+
+def _parse_words(tokens, count):
+    """
+    Returns a (count, 5) array with the X, Y, Z, E and F values of each move (NaN if it's missing). tokens: list of words
+    (i.e., b'X10.5') and line breaks. Every word is parsed at once, as a fixed width bytes array (first byte: letter,
+    then the value). Its move is given by the line breaks before it
+    """
+    raw = np.array(tokens)
+    raw = raw.view(np.uint8).reshape(len(tokens), -1)
+    letters = raw[:, 0]
+    line_break = letters == ord('\n')
+    rows = np.cumsum(line_break) - line_break
+    values = np.ascontiguousarray(raw[:, 1:]).view('S{}'.format(raw.shape[1] - 1)).ravel()
+    words = np.full((count, 5), np.nan)
+    for column, letter in enumerate(AXES + (b'F', )):
+        selected = letters == ord(letter)
+        words[rows[selected], column] = values[selected].astype(np.float64)
+    return words
+
+
+class GcodeAnalyzer:
+    def __init__(self, acceleration=None, jerk=None):
+        self.acceleration = settings.GCODE_ANALYZER_ACCELERATION if acceleration is None else acceleration
+        self.jerk = settings.GCODE_ANALYZER_JERK if jerk is None else jerk
+        # X, Y, Z, E
+        self.position = np.zeros(4)
+        self.feedrate = DEFAULT_FEEDRATE
+        self.absolute = True
+        self.absolute_extrusion = True
+        self.build_time = 0.
+        self.filament_length = 0.
+        self.moves = 0
+        self._batch = []
+        self._remainder = b''
+        # The last two moves of the previous batch (distance, direction, speed). The last one isn't computed yet: its
+        # exit speed depends on the next move. The one before gives the entry speed of the last one
+        self._carried = (np.empty(0), np.empty((0, 3)), np.empty(0))
+
+    def feed(self, data):
+        # Only whole lines are processed, the last one is kept until the next block
+        data = self._remainder + data
+        end = data.rfind(b'\n') + 1
+        self._remainder = data[end:]
+        self._process(data[:end])
+
+    def result(self):
+        self._process(self._remainder)
+        self._remainder = b''
+        self._flush(final=True)
+        return GcodeAnalysis(float(self.build_time), float(self.filament_length), self.moves)
+
+    def _process(self, text):
+        position = 0
+        for match in COMMAND.finditer(text):
+            self._add_moves(text, position, match.start())
+            # Dwells and homing stop the machine. Other commands don't, so the moves around them are still joined
+            self._flush(final=match.group(1) in (b'G4', b'G28'))
+            self._command(match.group(1), dict(WORD.findall(match.group(2))))
+            position = match.end()
+        self._add_moves(text, position, len(text))
+
+    def _add_moves(self, text, start, end):
+        self._batch.extend(MOVE.findall(text, start, end))
+        if len(self._batch) >= BATCH_SIZE:
+            self._flush()
+
+    def _command(self, code, words):
+        if code == b'G90':
+            self.absolute = self.absolute_extrusion = True
+        elif code == b'G91':
+            self.absolute = self.absolute_extrusion = False
+        elif code == b'M82':
+            self.absolute_extrusion = True
+        elif code == b'M83':
+            self.absolute_extrusion = False
+        elif code in (b'G92', b'G28'):
+            # Without parameters, every axis is set (G92) or homed (G28)
+            axes = [i for i, axis in enumerate(AXES) if axis in words] or range(4 if code == b'G92' else 3)
+            for i in axes:
+                self.position[i] = float(words.get(AXES[i], 0)) if code == b'G92' else 0
+        elif code == b'M204':
+            # Printing (P) or legacy (S) acceleration
+            value = words.get(b'P', words.get(b'S'))
+            if value is not None and float(value) > 0:
+                self.acceleration = float(value)
+        elif code == b'G4':
+            # Dwell, P in milliseconds or S in seconds
+            self.build_time += float(words[b'P']) / 1000 if b'P' in words else float(words.get(b'S', 0))
+
+    def _flush(self, final=False):
+        if self._batch:
+            self._add_durations(*self._parse_batch(), final)
+        elif final:
+            self._add_durations(np.empty(0), np.empty((0, 3)), np.empty(0), final)
+
+    def _parse_batch(self):
+        # Returns distance, direction and speed (mm/s) of each move of the batch, skipping the null ones
+        batch, self._batch = self._batch, []
+        text = b'\n'.join(batch).replace(b'\t', b' ')
+        try:
+            if PACKED_WORDS.search(text):
+                raise ValueError
+            words = _parse_words(text.replace(b'\n', b' \n ').split(b' '), len(batch))
+        except ValueError:
+            # Words aren't separated by spaces (i.e., G1X10Y10), we need the regex
+            words = _parse_words(MOVE_WORD.findall(text), len(batch))
+        coordinates, feedrate = words[:, :4], words[:, 4]
+        # Positions after each move
+        start = self.position.copy()
+        positions = np.empty((len(batch) + 1, 4))
+        for columns, absolute in ((slice(0, 3), self.absolute), (slice(3, 4), self.absolute_extrusion)):
+            if absolute:
+                positions[:, columns] = _forward_fill(coordinates[:, columns], start[columns])
+            else:
+                positions[:, columns] = np.vstack((start[columns], start[columns] +
+                                                   np.nancumsum(coordinates[:, columns], axis=0)))
+        feedrate = _forward_fill(feedrate[:, None], [self.feedrate])[1:, 0]
+        self.position = positions[-1]
+        self.feedrate = feedrate[-1]
+
+        delta = np.diff(positions, axis=0)
+        self.filament_length += delta[:, 3].sum()
+        length = np.linalg.norm(delta[:, :3], axis=1)
+        # Extruder only moves (retractions) are as long as the filament moved
+        distance = np.where(length > 0, length, np.abs(delta[:, 3]))
+        moving = (distance > 0) & (feedrate > 0)
+        direction = np.divide(delta[:, :3], length[:, None], out=np.zeros((len(delta), 3)), where=length[:, None] > 0)
+        return distance[moving], direction[moving], feedrate[moving] / 60
+
+    def _add_durations(self, distance, direction, speed, final):
+        # The carried moves are computed again, joined with this batch. The first one was already added
+        carried = len(self._carried[0])
+        distance, direction, speed = [np.concatenate((c, new)) for c, new in
+                                      zip(self._carried, (distance, direction, speed))]
+        if len(distance) == 0:
+            return
+        durations = move_durations(distance, direction, speed, self.acceleration, self.jerk)
+        added = slice(max(carried - 1, 0), None if final else -1)
+        self.build_time += durations[added].sum()
+        self.moves += len(durations[added])
+        self._carried = (np.empty(0), np.empty((0, 3)), np.empty(0)) if final else \
+            tuple(a[-2:] for a in (distance, direction, speed))
+
+
+def filament_weight(length, density, diameter=1.75):
+    # Weight (g) of length mm of filament. density in g/cm^3, diameter in mm
+    return math.pi * (diameter / 20) ** 2 * (length / 10) * density
+
+
+def analyze_stream(f, acceleration=None, jerk=None):
+    # f: binary stream, with the decompressed G-code. Returns build time (s), filament length (mm) and moves count
+    analyzer = GcodeAnalyzer(acceleration, jerk)
+    for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+        analyzer.feed(block)
+    return analyzer.result()
+
+
+def analyze_file(file, acceleration=None, jerk=None):
+    # file: Django File/FieldFile, compressed or not (see gcode_storage.py)
+    with gcode_storage.open_gcode(file) as f:
+        return analyze_stream(f, acceleration, jerk)
+
+
+def analyze_path(path, acceleration=None, jerk=None):
+    with open(path, 'rb') as raw:
+        if raw.read(2) == gcode_storage.GZIP_MAGIC:
+            raw.seek(0)
+            with gzip.GzipFile(fileobj=raw, mode='rb') as f:
+                return analyze_stream(f, acceleration, jerk)
+        raw.seek(0)
+        return analyze_stream(raw, acceleration, jerk)
@@ -0,0 +1,155 @@
+import re
+import gzip
+import os
+import collections
+from . import gcode_storage
+
+'''
+G-code metadata (slicer, estimated build time, filament used), read from the comments slicers write. Slicers write them
+on the first lines (Cura) or on the last ones (Slic3r, PrusaSlicer, Simplify3D), so we only read the head of the file,
+and its tail, backwards, in BLOCK_SIZE blocks, until every field is found. Compressed G-code can't be read backwards, so
+it's read once, keeping only the head and the last MAX_TAIL_SIZE bytes.
+'''
+
+BLOCK_SIZE = 64 * 1024
+HEAD_SIZE = 64 * 1024
+# Slic3r writes its whole configuration after the statistics, so they can be a few hundred lines away from the end
+MAX_TAIL_SIZE = 1024 * 1024
+
+GcodeMetadata = collections.namedtuple('GcodeMetadata', 'slicer build_time filament_length filament_weight')
+
+# (slicer, signature on the header). Order matters: the first match wins
+SLICERS = (
+    ('PrusaSlicer', b'PrusaSlicer'),
+    ('SuperSlicer', b'SuperSlicer'),
+    ('Slic3r', b'Slic3r'),
+    ('Simplify3D', b'Simplify3D'),
+    ('Cura', b'Cura'),
+)
+
+'''
+Patterns, per field: (regex, parser). build_time is returned in seconds, filament_length in mm and filament_weight in g
+'''
+
+
+def parse_duration(text):
+    # '1d 2h 3m 4s', '2 hours 5 minutes', etc
+    units = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+    matches = re.findall(r'(\d+(?:\.\d+)?)\s*([dhms])', text.lower())
+    if not matches:
+        raise ValueError("Invalid duration: {}".format(text))
+    return sum(float(value) * units[unit] for value, unit in matches)
+
+
+def _sum_values(text, scale=1):
+    # Multiple extruders are reported as a comma separated list
+    return sum(float(v) for v in re.findall(r'\d+(?:\.\d+)?', text)) * scale
+
+
+FIELDS = {
+    'build_time': (
+        (re.compile(rb'^; estimated printing time(?: \(normal mode\))? = (.+)$', re.M), parse_duration),
+        (re.compile(rb'^;TIME:(\d+(?:\.\d+)?)\s*$', re.M), float),
+        (re.compile(rb'^;\s*Build time: (.+)$', re.M), parse_duration),
+    ),
+    'filament_length': (
+        (re.compile(rb'^; filament used \[mm\] = (.+)$', re.M), _sum_values),
+        (re.compile(rb'^; filament used = ([\d.]+)mm', re.M), float),
+        (re.compile(rb'^;Filament used: (.+?)m?\s*$', re.M), lambda text: _sum_values(text, 1000)),
+        (re.compile(rb'^;\s*Filament length: ([\d.]+) mm', re.M), float),
+    ),
+    'filament_weight': (
+        (re.compile(rb'^; (?:total )?filament used \[g\] = (.+)$', re.M), _sum_values),
+        (re.compile(rb'^;\s*Plastic weight: ([\d.]+) g', re.M), float),
+    ),
+}
+
+
+def identify_slicer(head):
+    for slicer, signature in SLICERS:
+        if signature in head:
+            return slicer
+    return None
+
+
+def _search(text, field):
+    for pattern, parser in FIELDS[field]:
+        for match in reversed(pattern.findall(text)):
+            try:
+                return parser(match.decode('utf-8', errors='ignore').strip())
+            except ValueError:
+                continue
+    return None
+
+
+def _whole_lines(head, tail, contiguous):
+    # Fields are only searched on whole lines. If the tail starts right after the head, we search both together
+    if contiguous:
+        return head, head + tail
+    return head[:head.rfind(b'\n') + 1], tail[tail.find(b'\n') + 1:]
+
+
+def _parse(head, tail):
+    fields = {field: _search(tail, field) for field in FIELDS}
+    for field, value in fields.items():
+        if value is None:
+            fields[field] = _search(head, field)
+    return GcodeMetadata(slicer=identify_slicer(head), **fields)
+
+
+def _complete(metadata):
+    # Build time and filament length are enough: the weight can be computed from the length, not the other way around.
+    # Slicers write the weight closer to the end than the length, so it's found by then if the slicer wrote it
+    return metadata.build_time is not None and metadata.filament_length is not None
+
+
+def _read_seekable(f):
+    head = f.read(HEAD_SIZE)
+    end = f.seek(0, os.SEEK_END)
+    position = end
+    tail = b''
+    while position > len(head) and end - position < MAX_TAIL_SIZE:
+        start = max(position - BLOCK_SIZE, len(head))
+        f.seek(start)
+        tail = f.read(position - start) + tail
+        position = start
+        if _complete(_parse(*_whole_lines(head, tail, position == len(head)))):
+            break
+    return _whole_lines(head, tail, position == len(head))
+
+
+def _read_stream(f):
+    head = f.read(HEAD_SIZE)
+    blocks = collections.deque()
+    size = 0
+    contiguous = True
+    for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+        blocks.append(block)
+        size += len(block)
+        while size - len(blocks[0]) >= MAX_TAIL_SIZE:
+            size -= len(blocks.popleft())
+            contiguous = False
+    return _whole_lines(head, b''.join(blocks), contiguous)
+
+
+def read_stream(f):
+    # f: binary stream, with the decompressed G-code
+    if isinstance(f, gzip.GzipFile) or not f.seekable():
+        return _parse(*_read_stream(f))
+    return _parse(*_read_seekable(f))
+
+
+def read_file(file):
+    # file: Django File/FieldFile, compressed or not (see gcode_storage.py)
+    with gcode_storage.open_gcode(file) as f:
+        return read_stream(f)
+
+
+def read_path(path):
+    with open(path, 'rb') as raw:
+        if raw.read(2) == gcode_storage.GZIP_MAGIC:
+            raw.seek(0)
+            with gzip.GzipFile(fileobj=raw, mode='rb') as f:
+                return read_stream(f)
+        raw.seek(0)
+        return read_stream(raw)
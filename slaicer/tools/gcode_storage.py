@@ -0,0 +1,107 @@
+import gzip
+import os
+import struct
+import tempfile
+from django.conf import settings
+from django.core.files import File
+
+'''
+G-code storage helpers. G-code compresses really well (it's plain text with lots of repeated commands), so we store it
+gzipped under gcode/ and slaicer/gcode/. Reading is transparent: open_gcode returns a stream with the decompressed
+content, whether the stored file is compressed or not, so older (plain) files keep working.
+Gzip only keeps the decompressed size modulo 2**32, so it's counted while compressing, and models store it (Gcode,
+SliceJob and OctoprintTask gcode_size fields).
+'''
+
+GZIP_MAGIC = b'\x1f\x8b'
+GZIP_EXTENSION = '.gz'
+COPY_BUFFER_SIZE = 1024 * 1024
+# Deflate can't compress more than ~1032:1, so smaller compressed files have an exact size on the gzip trailer
+MAX_COMPRESSION_RATIO = 1032
+
+
+def compression_enabled():
+    return getattr(settings, 'GCODE_COMPRESSION', True)
+
+
+def is_compressed(file) -> bool:
+    with file.open('rb') as f:
+        compressed = f.read(2) == GZIP_MAGIC
+    return compressed
+
+
+def plain_name(name: str) -> str:
+    # Name of the decompressed file (that's the one we send to octoprint)
+    return name[:-len(GZIP_EXTENSION)] if name.endswith(GZIP_EXTENSION) else name
+
+
+def compressed_name(name: str) -> str:
+    return name if name.endswith(GZIP_EXTENSION) else name + GZIP_EXTENSION
+
+
+def open_gcode(file):
+    # Returns a binary stream with the decompressed G-code. Decompression is done on the fly, while reading
+    raw = file.open('rb')
+    if raw.read(2) == GZIP_MAGIC:
+        raw.seek(0)
+        stream = gzip.GzipFile(fileobj=raw, mode='rb')
+        # GzipFile only closes the underlying file if it's set as myfileobj
+        stream.myfileobj = raw
+        return stream
+    raw.seek(0)
+    return raw
+
+
+def gcode_size(file, stored_size=None) -> int:
+    '''
+    Size of the decompressed G-code. stored_size: the one counted when the file was compressed, if known. Otherwise, gzip
+    stores it (mod 2**32) on the last 4 bytes of the file. If the file might decompress to 4 GiB or more, we count it
+    '''
+    if stored_size is not None:
+        return stored_size
+    if not is_compressed(file):
+        return file.size
+    if file.size * MAX_COMPRESSION_RATIO < 2 ** 32:
+        with file.open('rb') as f:
+            f.seek(-4, os.SEEK_END)
+            size = struct.unpack('<I', f.read(4))[0]
+        return size
+    size = 0
+    with open_gcode(file) as f:
+        for chunk in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+            size += len(chunk)
+    return size
+
+
+def compress_gcode(f, name: str) -> File:
+    '''
+    Compress a binary stream into a temporary file, and returns it as a Django File, ready to be saved on a FileField.
+    The content is copied in blocks, so we never hold the whole G-code in memory. Its gcode_size attribute is the
+    decompressed size
+    '''
+    tmp = tempfile.TemporaryFile()
+    size = 0
+    with gzip.GzipFile(filename=plain_name(os.path.basename(name)), fileobj=tmp, mode='wb',
+                       compresslevel=getattr(settings, 'GCODE_COMPRESSION_LEVEL', 6)) as gz:
+        while True:
+            chunk = f.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            chunk = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+            gz.write(chunk)
+            size += len(chunk)
+    tmp.seek(0)
+    content = File(tmp, name=compressed_name(name))
+    content.gcode_size = size
+    return content
+
+
+def save_gcode(field_file, name: str, f, save=True) -> int:
+    # Stores the G-code on field_file, compressed if GCODE_COMPRESSION is enabled. Returns its decompressed size
+    if compression_enabled():
+        content = compress_gcode(f, name)
+        field_file.save(content.name, content, save=save)
+        content.close()
+        return content.gcode_size
+    field_file.save(name, File(f, name=name), save=save)
+    return field_file.size
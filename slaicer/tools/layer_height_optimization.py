@@ -5,6 +5,8 @@ from matplotlib.figure import Figure
 import random, string, matplotlib, io
 import numpy as np
 from django.core.files.base import ContentFile
+from .parallel_geometry import map_face_chunks
+from . import mesh_artifact
 
 
 class LayerHeightOptimizer:
@@ -16,7 +18,7 @@ class LayerHeightOptimizer:
         max_layer_height = 0.3
         # max-min tiene que ser divisible por step
         step_layer_height = 0.05
-        # Mesh de trimesh
+        # Mesh de trimesh (opcional)
         self.mesh = mesh
         # Limite inferior de cada triangulo (np-array)
         self.limits_inf = limits_inf
@@ -34,80 +36,147 @@ class LayerHeightOptimizer:
         self.step_layer_height = step_layer_height
 
     @classmethod
-    def import_from_geometrymodel(cls, geometrymodel):
-        mesh = trimesh.load_mesh(geometrymodel.get_model_path())
-        triangles_count = len(mesh.triangles)
-        # Completamos los arrays:
-        limits_inf = np.empty(triangles_count)
-        limits_sup = np.empty(triangles_count)
-        # Llenamos el array de limites
-        for trig_index, trig in enumerate(mesh.triangles):
-            limits_inf[trig_index] = min([trig[i][2] for i in range(0, 3)])
-            limits_sup[trig_index] = max([trig[i][2] for i in range(0, 3)])
-        # Llenamos el array de angulos
-        angles = np.empty(triangles_count)
-        for trig_index, trig in enumerate(mesh.face_normals):
-            hip = np.sqrt(trig[0] ** 2 + trig[1] ** 2)
-            if hip != 0:
-                angles[trig_index] = abs(trig[2]) / hip
-            else:
-                # Tangente de infinito. Un número lo suficientemente bajo, para que sea descartado naturalmente
-                angles[trig_index] = 0
+    def import_from_geometrymodel(cls, geometrymodel, workers=1, chunk_size=250000):
+        triangles = geometrymodel.get_triangles()
+        # Limites y tangentes de cada triangulo. En mallas grandes, se calculan por bloques de caras, en paralelo
+        chunks = map_face_chunks(faces_limits_and_angles, [triangles], workers=workers, chunk_size=chunk_size)
+        limits_inf, limits_sup, angles = [np.concatenate(c) for c in zip(*chunks)]
         # Calculamos la altura
-        height = max(limits_sup) - min(limits_inf)
-        return cls(mesh, limits_inf, limits_sup, angles, height)
+        height = limits_sup.max() - limits_inf.min()
+        return cls(None, limits_inf, limits_sup, angles, height)
 
     # Transladamos el mesh al origen
     def translate_to_origin(self):
         initial_z = min(self.limits_inf)
         self.limits_inf += -initial_z
         self.limits_sup += -initial_z
-        self.mesh.apply_translation([0, 0, -initial_z])
+        if self.mesh is not None:
+            self.mesh.apply_translation([0, 0, -initial_z])
+
+    # Alturas de capa candidatas, de mayor a menor: max_layer_height, max_layer_height - step_layer_height, ...
+    def candidate_layer_heights(self):
+        heights = [self.max_layer_height]
+        while heights[-1] - self.step_layer_height > self.min_layer_height:
+            heights.append(heights[-1] - self.step_layer_height)
+        heights.append(self.min_layer_height)
+        return heights
+
+    @staticmethod
+    def _cells_max(lo, hi, values, cells_count):
+        '''
+        Para cada celda c, el maximo de values[i] sobre los rangos (de celdas) que la contienen (lo[i] <= c <= hi[i]).
+        Cada rango se descompone en dos bloques de 2^p celdas (tabla dispersa), y luego se propagan los maximos desde los
+        bloques mas grandes hacia las celdas
+        '''
+        valid = hi >= lo
+        lo, hi, values = lo[valid], hi[valid], values[valid]
+        if len(lo) == 0:
+            return np.zeros(cells_count)
+        # p = floor(log2(largo del rango))
+        p = np.frexp(hi - lo + 1)[1] - 1
+        levels = p.max() + 1
+        table = np.zeros((levels, cells_count))
+        np.maximum.at(table, (p, lo), values)
+        np.maximum.at(table, (p, hi - (1 << p) + 1), values)
+        for level in range(levels - 1, 0, -1):
+            half = 1 << (level - 1)
+            np.maximum(table[level - 1], table[level], out=table[level - 1])
+            np.maximum(table[level - 1, half:], table[level, :cells_count - half], out=table[level - 1, half:])
+        return table[0]
 
     # Crea un array con las alturas de capa adaptivas. Es decir, la suma sobre este array, da la altura del objeto
-    def create_layer_profile(self):
-        initial_z = min(self.limits_inf)
-        final_z = max(self.limits_sup)
+    def create_layer_profile(self, exact=False, workers=1, chunk_size=250000):
+        '''
+        La altura de capa permitida es la mayor altura candidata h tal que tangente_maxima(capa) * h <= q_factor.
+        Discretizamos z en celdas de step_layer_height: las capas empiezan y terminan en los bordes de las celdas, de modo
+        que la tangente maxima de una capa de j celdas es el maximo, sobre esas celdas, de la tangente maxima de cada
+        celda. Calculamos todo eso de una vez (vectorizado) para todas las capas posibles, y luego solo recorremos el
+        perfil. exact=True usa el barrido original, capa por capa (ver create_exact_layer_profile). workers > 1 reparte
+        el calculo de las celdas en hilos, en bloques de chunk_size caras
+        '''
+        if exact:
+            return self.create_exact_layer_profile()
+        step = self.step_layer_height
+        initial_z = self.limits_inf.min()
+        final_z = self.limits_sup.max()
+        # Las capas empiezan en initial_z + k * step, mientras no superen final_z
+        cells_count = int(np.floor((final_z - initial_z) / step)) + 1
+        heights = self.candidate_layer_heights()
+        cells = [int(round(h / step)) for h in heights]
+        max_cells = max(cells)
+        # Tangente maxima de cada celda. En mallas grandes, se calcula por bloques de caras, en paralelo
+        padded_count = cells_count + max_cells
+        cells_max = np.maximum.reduce(map_face_chunks(cells_tangent, [self.limits_inf, self.limits_sup, self.angles],
+                                                      args=(initial_z, step, padded_count), workers=workers,
+                                                      chunk_size=chunk_size))
+        # window_max[j][k]: tangente maxima de la capa de j celdas que empieza en la celda k
+        window_max = {1: cells_max}
+        for j in range(2, max_cells + 1):
+            window_max[j] = np.maximum(window_max[j - 1][:-1], cells_max[j - 1:])
+        # Para cada celda, la altura de capa elegida (indice en heights). La minima, si ninguna verifica la condicion
+        choice = np.full(cells_count, len(heights) - 1)
+        for index in range(len(heights) - 2, -1, -1):
+            satisfied = window_max[cells[index]][:cells_count] * heights[index] <= self.q_factor
+            choice[satisfied] = index
+        # Recorremos el perfil
+        layers_profile = []
+        k = 0
+        while k < cells_count:
+            layers_profile.append(heights[choice[k]])
+            k += cells[choice[k]]
+        self.layers_profile = layers_profile
+        return layers_profile
+
+    # Perfil de altura de capa, calculado capa por capa
+    def create_exact_layer_profile(self):
+        '''
+        Barrido (sweep line) sobre z. Los triangulos se ordenan por su limite inferior, y solo se analizan los activos: los
+        que empiezan por debajo de la capa mas alta posible (actual_z + max_layer_height) y terminan por encima de actual_z.
+        Para cada capa, tomamos la mayor altura de capa que verifique la condicion de stepover, reduciendola de a
+        step_layer_height. Como en la version original, los triangulos de la capa se recorren en orden de indice: si el
+        primero no verifica la condicion, reducimos la altura y volvemos a analizar la capa. Si no verifica alguno de los
+        siguientes, reducimos la altura una unica vez y aceptamos la capa.
+        '''
+        initial_z = self.limits_inf.min()
+        final_z = self.limits_sup.max()
+        order = np.argsort(self.limits_inf, kind='stable')
+        sorted_inf = self.limits_inf[order]
+        # Indices de los triangulos activos
+        active = np.empty(0, dtype=np.intp)
+        admitted = 0
         layers_profile = []
         # Comenzamos con el barrido sobre el objeto
         actual_z = initial_z
         while actual_z <= final_z:
+            # Ingresan los triangulos que empiezan por debajo de la capa mas alta posible
+            limit = np.searchsorted(sorted_inf, self.max_layer_height + actual_z, side='left')
+            if limit > admitted:
+                active = np.concatenate([active, order[admitted:limit]])
+                admitted = limit
+            # Y salen los que terminan por debajo de actual_z
+            active = active[self.limits_sup[active] > actual_z]
+            limits_inf = self.limits_inf[active]
+            angles = self.angles[active]
             current_layer_height = self.max_layer_height
-            condition_satisfied = False
-            # print("Analizando capa {}".format(actual_z))
-            # Mientras que el error no sea menor al especificado, vamos reduciendo la altura de capa actual
-            while not condition_satisfied:
-                '''
-                Verifica la altura de capa actual la condicion? Para ello, buscamos todos los triangulos
-                que intersequen (o esten contenidos entre) a los planos z=actual_z y z=current_layer_height+actual_z
-                Con ello, tomamos el más inclinado (ie, de mayor angulo; y por lo tanto, mayor tangente),
-                y calculamos el stepover. Si no satisface la conidicion, reducimos la altura de capa
-                '''
-                trig_index = np.intersect1d(np.flatnonzero(self.limits_inf < current_layer_height + actual_z),
-                                            np.flatnonzero(self.limits_sup > actual_z))
-                if len(trig_index) == 0:
-                    condition_satisfied = True
-                for index in trig_index:
-                    stepover = self.angles[index] * current_layer_height
-                    # print(stepover)
-                    if stepover > self.q_factor:
-                        # No alcanza. Reducimos la altura de capa
-                        if current_layer_height - self.step_layer_height > self.min_layer_height:
-                            current_layer_height = current_layer_height - self.step_layer_height
-                        else:
-                            # Alcanzamos el minimo :(
-                            current_layer_height = self.min_layer_height
-                            condition_satisfied = True
-                        break
-                    else:
-                        condition_satisfied = True
+            while True:
+                # Triangulos que intersecan (o estan contenidos entre) los planos z=actual_z y z=current_layer_height+actual_z
+                in_layer = limits_inf < current_layer_height + actual_z
+                violating = in_layer & (angles * current_layer_height > self.q_factor)
+                if not violating.any():
+                    break
+                first = active[in_layer].min()
+                first_violating = active[violating].min()
+                # No alcanza. Reducimos la altura de capa
+                if current_layer_height - self.step_layer_height > self.min_layer_height:
+                    current_layer_height = current_layer_height - self.step_layer_height
+                else:
+                    # Alcanzamos el minimo :(
+                    current_layer_height = self.min_layer_height
+                    break
+                if first_violating != first:
+                    break
             # Ya tenemos lista esta capa. Guardamos la altura, y pasamos a la proxima
             layers_profile.append(current_layer_height)
-            # Borramos los triangulos cuyo limite sup, esta por debajo de actual_z+current_layer_height
-            delete_index = np.flatnonzero(self.limits_sup < current_layer_height + actual_z)
-            self.limits_sup = np.delete(self.limits_sup, delete_index)
-            self.limits_inf = np.delete(self.limits_inf, delete_index)
-            self.angles = np.delete(self.angles, delete_index)
             actual_z += current_layer_height
         self.layers_profile = layers_profile
         return layers_profile
@@ -145,3 +214,27 @@ class LayerHeightOptimizer:
         ax.plot(height, lp)
         canvas.print_png(buf)
         return ContentFile(buf.getvalue())
+
+
+# Limites y tangentes de un bloque de triangulos
+def faces_limits_and_angles(triangles):
+    # Limites inferior y superior de cada triangulo (coordenada z de sus vertices)
+    z = triangles[:, :, 2]
+    limits_inf = z.min(axis=1).astype(np.float64)
+    limits_sup = z.max(axis=1).astype(np.float64)
+    # Tangente del angulo de cada normal. Si la normal es vertical (tangente de infinito), usamos 0: un número lo
+    # suficientemente bajo, para que sea descartado naturalmente
+    normals = mesh_artifact.face_normals(triangles)
+    hip = np.sqrt(normals[:, 0] ** 2 + normals[:, 1] ** 2)
+    angles = np.zeros(len(normals))
+    np.divide(np.abs(normals[:, 2]), hip, out=angles, where=hip != 0)
+    return limits_inf, limits_sup, angles
+
+
+# Tangente maxima de cada celda de step de alto (a partir de initial_z), sobre un bloque de triangulos
+def cells_tangent(limits_inf, limits_sup, angles, initial_z, step, cells_count):
+    # Rango de celdas que interseca cada triangulo
+    lo = np.floor((limits_inf - initial_z) / step).astype(np.int64)
+    hi = np.ceil((limits_sup - initial_z) / step).astype(np.int64) - 1
+    return LayerHeightOptimizer._cells_max(np.clip(lo, 0, cells_count - 1), np.clip(hi, 0, cells_count - 1), angles,
+                                           cells_count)
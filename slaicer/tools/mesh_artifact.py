@@ -0,0 +1,86 @@
+import io
+import numpy as np
+import trimesh
+from django.core.files.base import ContentFile
+
+'''
+Mesh artifacts. Each GeometryModel file (STL, OBJ, etc) is parsed only once, and its triangles are saved as a NumPy
+array (.npy, float32, shape (faces, 3, 3)). Analysis and slicing tasks memory-map it, instead of parsing the model again.
+'''
+
+EXTENSION = '.npy'
+
+
+def parse_triangles(path):
+    # Parses a model file with trimesh. Multi-body files (scenes) are merged
+    mesh = trimesh.load_mesh(path)
+    if isinstance(mesh, trimesh.Scene):
+        mesh = mesh.dump(concatenate=True)
+    return np.asarray(mesh.triangles, dtype=np.float32)
+
+
+def to_file(triangles):
+    buf = io.BytesIO()
+    np.save(buf, np.ascontiguousarray(triangles, dtype=np.float32), allow_pickle=False)
+    return ContentFile(buf.getvalue())
+
+
+def load(path, mmap=True):
+    return np.load(path, mmap_mode='r' if mmap else None, allow_pickle=False)
+
+
+def face_normals(triangles):
+    # Unit normals (float64). Degenerate faces get a null normal
+    triangles = np.asarray(triangles, dtype=np.float64)
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    norm = np.sqrt((normals ** 2).sum(axis=1))
+    np.divide(normals, norm[:, None], out=normals, where=norm[:, None] > 0)
+    normals[norm == 0] = 0
+    return normals
+
+
+def extents(triangles):
+    # Axis aligned bounding box size
+    vertices = np.asarray(triangles).reshape(-1, 3)
+    return (vertices.max(axis=0) - vertices.min(axis=0)).astype(np.float64)
+
+
+def to_trimesh(triangles):
+    return trimesh.Trimesh(**trimesh.triangles.to_kwargs(np.asarray(triangles, dtype=np.float64)))
+
+
+def tweaker_mesh(triangles):
+    # Tweaker-3 takes a (faces * 3, 3) vertex array, the same FileHandler.load_mesh returns for STL files
+    return np.asarray(triangles, dtype=np.float64).reshape(-1, 3)
+
+
+def transform(triangles, matrix):
+    # Applies a 4x4 homogeneous transformation to every vertex
+    triangles = np.asarray(triangles, dtype=np.float64)
+    matrix = np.asarray(matrix, dtype=np.float64)
+    return triangles @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def place(triangles, x, y, rotated=False):
+    # Moves the mesh so its bounding box lower corner is at (x, y, 0). Rotated: turned 90 degrees around z before
+    triangles = np.asarray(triangles, dtype=np.float64)
+    if rotated:
+        triangles = np.stack((-triangles[..., 1], triangles[..., 0], triangles[..., 2]), axis=-1)
+    vertices = triangles.reshape(-1, 3)
+    return triangles + (np.array([x, y, 0]) - vertices.min(axis=0))
+
+
+STL_DTYPE = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attributes', '<u2')])
+
+
+def write_stl(path, triangles):
+    # Binary STL writer. The whole body is built as a single structured array, and written at once
+    triangles = np.asarray(triangles)
+    data = np.zeros(len(triangles), dtype=STL_DTYPE)
+    data['normal'] = face_normals(triangles)
+    data['vertices'] = triangles
+    with open(path, 'wb') as f:
+        f.write(b'\0' * 80)
+        f.write(np.uint32(len(triangles)).tobytes())
+        f.write(data.tobytes())
+    return path
@@ -0,0 +1,46 @@
+import numpy as np
+import logging
+from . import mesh_artifact
+
+'''
+Mesh decimation, used to build low resolution proxies of large meshes (see multi-resolution orientation, in
+orientation_optimization.py). Quadric decimation is used when trimesh has a backend for it (open3d or
+fast-simplification); otherwise, vertices are clustered on a regular grid.
+'''
+
+
+def decimate(triangles, target_faces):
+    """
+    Returns a (faces, 3, 3) triangles array with about target_faces faces. Meshes that are already small enough are
+    returned unchanged
+    """
+    triangles = np.asarray(triangles)
+    if len(triangles) <= target_faces:
+        return triangles
+    try:
+        mesh = mesh_artifact.to_trimesh(triangles).simplify_quadric_decimation(face_count=target_faces)
+        if len(mesh.faces):
+            return np.asarray(mesh.triangles, dtype=np.float32)
+    except Exception as e:
+        logging.debug("Quadric decimation not available ({}), using vertex clustering".format(e))
+    return cluster_vertices(triangles, target_faces)
+
+
+def cluster_vertices(triangles, target_faces):
+    # Every vertex is moved to the centroid of its grid cell, and the faces that collapse are removed
+    vertices = np.asarray(triangles, dtype=np.float64).reshape(-1, 3)
+    area = np.sqrt((np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0],
+                             axis=1).astype(np.float64) ** 2).sum(axis=1)).sum() / 2
+    # A surface covered by square cells of size cell has about area / cell ** 2 cells, and twice as many faces
+    cell = np.sqrt(2 * area / target_faces) if area > 0 else 1
+    keys = np.floor((vertices - vertices.min(axis=0)) / cell).astype(np.int64)
+    keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    counts = np.bincount(inverse, minlength=len(keys))[:, None]
+    centroids = np.stack([np.bincount(inverse, weights=vertices[:, i], minlength=len(keys)) for i in range(3)],
+                         axis=1) / counts
+    faces = inverse.reshape(-1, 3)
+    faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])]
+    # Duplicated faces (same vertices, in any order) are kept once
+    faces = faces[np.unique(np.sort(faces, axis=1), axis=0, return_index=True)[1]]
+    return centroids[faces].astype(np.float32)
@@ -0,0 +1,114 @@
+import os
+import hashlib
+import tempfile
+import logging
+from django.conf import settings
+from urllib3.exceptions import HTTPError
+
+'''
+Cache local (por worker) de archivos remotos (modelos, artefactos de mallas). Cada archivo se guarda con el hash de su
+nombre en el storage, junto a su ETag. Antes de usar una copia, se valida con el servidor (If-None-Match), y las descargas
+se escriben por partes a un archivo temporal, que luego se mueve atomicamente. Cuando el cache supera
+MODEL_CACHE_MAX_SIZE, se borran los archivos usados hace mas tiempo (LRU, segun mtime).
+'''
+
+CHUNK_SIZE = 1024 * 1024
+ETAG_SUFFIX = '.etag'
+TEMP_PREFIX = '.download-'
+
+
+def cache_dir():
+    path = settings.MODEL_CACHE_DIR
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def cache_path(name):
+    extension = os.path.splitext(name)[1]
+    return os.path.join(cache_dir(), hashlib.sha1(name.encode('utf-8')).hexdigest() + extension)
+
+
+def _read_etag(path):
+    try:
+        with open(path + ETAG_SUFFIX) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _atomic_write(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TEMP_PREFIX)
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def fetch(http, url, name):
+    """
+    Returns the local path of the file stored as name (available at url), downloading it if it's not cached or it
+    changed. http: urllib3 PoolManager
+    """
+    path = cache_path(name)
+    etag = _read_etag(path) if os.path.exists(path) else None
+    headers = {'If-None-Match': etag} if etag is not None else {}
+    try:
+        r = http.request('GET', url, headers=headers, preload_content=False)
+    except HTTPError:
+        if os.path.exists(path):
+            # The server isn't available, but we have a copy
+            logging.warning("Couldn't validate cached {}, using it anyway".format(name))
+            os.utime(path)
+            return path
+        raise
+    try:
+        if r.status == 304:
+            try:
+                os.utime(path)
+                return path
+            except FileNotFoundError:
+                # Another worker evicted it after we read its ETag: download it again
+                r.release_conn()
+                r = http.request('GET', url, preload_content=False)
+        if r.status != 200:
+            raise HTTPError("Error downloading {} ({})".format(url, r.status))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in r.stream(CHUNK_SIZE):
+                    f.write(chunk)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+    finally:
+        r.release_conn()
+    if r.headers.get('ETag'):
+        _atomic_write(path + ETAG_SUFFIX, r.headers['ETag'])
+    elif os.path.exists(path + ETAG_SUFFIX):
+        os.remove(path + ETAG_SUFFIX)
+    evict(keep=path)
+    return path
+
+
+def evict(max_size=None, keep=None):
+    # Removes the least recently used files, until the cache size is below max_size (bytes)
+    max_size = settings.MODEL_CACHE_MAX_SIZE if max_size is None else max_size
+    entries = []
+    for entry in os.scandir(cache_dir()):
+        if entry.name.endswith(ETAG_SUFFIX) or entry.name.startswith(TEMP_PREFIX) or not entry.is_file():
+            continue
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(e[1] for e in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        for p in (path, path + ETAG_SUFFIX):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+        total -= size
+    return total
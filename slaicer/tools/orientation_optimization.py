@@ -2,19 +2,26 @@ import sys
 import os
 from time import time
 import importlib.util
-import trimesh
 from django.conf import settings
-import random, string
+import numpy as np
+from . import mesh_artifact, mesh_decimation
 from django.apps import apps
 import logging
+import collections
+import functools
 
 '''
 Esta funcion ejecuta el mismo orientador que usa Cura, y se puede encontrar aca: https://github.com/ChristophSchranz/Tweaker-3/
 Considera la orientacion de impresion más factible. Asimismo, sugiere o no el uso de soporte via el parametro "Unprintability"
 '''
 
-def generate_tweaker_result(geometrymodel):
-    # Cargamos Tweaker3. Este bardo es porque no esta en el directorio donde corre el script
+TweakerModules = collections.namedtuple('TweakerModules', 'Tweaker ThreeMF FileHandler')
+
+
+@functools.lru_cache(maxsize=None)
+def load_tweaker_modules():
+    # Cargamos Tweaker3. Este bardo es porque no esta en el directorio donde corre el script. Se carga una unica vez por
+    # proceso (los workers lo precargan al iniciar, ver slaicer/tasks.py)
     spec = importlib.util.spec_from_file_location('Tweak', settings.BASE_DIR + '/slaicer/lib/Tweaker-3/MeshTweaker.py')
     Tweaker = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(Tweaker)
@@ -27,53 +34,90 @@ def generate_tweaker_result(geometrymodel):
         spec.loader.exec_module(FileHandler)
     except ModuleNotFoundError:
         raise ValueError("Error importing FileHandler. Please remove the ThreeMF import line from slaicer/lib/Tweaker-3/FileHandler.py")
+    return TweakerModules(Tweaker, ThreeMF, FileHandler)
+
+
+TWEAKER_SETTINGS = {
+    'extended_mode': True,
+    'verbose': False,
+    'show_progress':  False,
+    'favside': None,
+    'volume': None
+}
+
+
+def generate_tweaker_result(geometrymodel):
+    # Le pasamos a Tweaker los vertices del artefacto de la malla directamente (en memoria), con el mismo formato que
+    # devuelve FileHandler para un STL. Los modelos con varios cuerpos ya vienen unidos en el artefacto
+    triangles = geometrymodel.get_triangles()
+    if geometrymodel.orientation_mode == 'multires':
+        return tweak_multiresolution(triangles, settings.ORIENTATION_PROXY_FACES, settings.ORIENTATION_CANDIDATES)
+    return tweak(triangles)
+
+
+def tweak(triangles):
+    Tweaker, ThreeMF, FileHandler = load_tweaker_modules()
+    try:
+        return Tweaker.Tweak(mesh_artifact.tweaker_mesh(triangles),
+                             TWEAKER_SETTINGS['extended_mode'],
+                             TWEAKER_SETTINGS['verbose'],
+                             TWEAKER_SETTINGS['show_progress'],
+                             TWEAKER_SETTINGS['favside'],
+                             TWEAKER_SETTINGS['volume'])
+    except (KeyboardInterrupt, SystemExit):
+        raise SystemExit("\nError, tweaking process failed!")
+
+
+'''
+Orientacion multi-resolucion. La busqueda de orientaciones candidatas (la parte cara de Tweak, que crece con la cantidad de
+caras) se hace sobre una version simplificada de la malla, de a lo sumo proxy_faces caras. Luego, solo las mejores
+candidates orientaciones se vuelven a evaluar sobre la malla completa, y nos quedamos con la mejor.
+'''
+
+# Columna de unprintability en los resultados de Tweak (best_5)
+UNPRINTABILITY = 4
+
 
+def tweak_multiresolution(triangles, proxy_faces, candidates):
+    if len(triangles) <= proxy_faces:
+        return tweak(triangles)
+    x = tweak(mesh_decimation.decimate(triangles, proxy_faces))
     try:
-        path = geometrymodel.get_model_path()
-        FileHandlerInstance = FileHandler.FileHandler()
-        objs = FileHandlerInstance.load_mesh(path)
-        if objs is None:
-            raise ValueError
-    except(KeyboardInterrupt, SystemExit, ValueError):
-        # Hubo un error al cargar el archivo, intentamos pasarlo por trimesh previamente
-        mesh = trimesh.load_mesh(path)
-        rand_str = ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
-        path = settings.BASE_DIR + '/tmp/' + rand_str + '.stl'
-        with open(path, 'wb') as f:
-            f.write(trimesh.exchange.stl.export_stl(mesh))
-        FileHandlerInstance = FileHandler.FileHandler()
-        objs = FileHandlerInstance.load_mesh(path)
-
-    # Una vez con el STL cargado, ejecutamos el optimizador
-
-    tweaker_settings = {
-        'extended_mode': True,
-        'verbose': False,
-        'show_progress':  False,
-        'favside': None,
-        'volume': None
-    }
-    info = dict()
-    if len(objs.items()) > 1:
-        logging.warning("Multiple parts detected, this shouldn't happen")
-    for part, content in objs.items():
-        mesh = content["mesh"]
-        info[part] = dict()
-        try:
-            cstime = time()
-            x = Tweaker.Tweak(mesh,
-                              tweaker_settings['extended_mode'],
-                              tweaker_settings['verbose'],
-                              tweaker_settings['show_progress'],
-                              tweaker_settings['favside'],
-                              tweaker_settings['volume'])
-            info[part]["matrix"] = x.matrix
-            info[part]["tweaker_stats"] = x
-
-        except (KeyboardInterrupt, SystemExit):
-            raise SystemExit("\nError, tweaking process failed!")
+        # Resultados de la busqueda: [orientacion, bottom, overhang, contour, unprintability, ...]. Algunas versiones
+        # agregan mas columnas (angulos de euler, matriz), por eso usamos el indice de unprintability explicitamente
+        results = getattr(x, 'all_orientations', None)
+        if results is None:
+            results = x.best_5
+        results = sorted(results, key=lambda r: r[UNPRINTABILITY])[:candidates]
+        evaluator = _create_evaluator(triangles)
+        results = [_evaluate(evaluator, np.asarray(r[0], dtype=np.float64)) for r in results]
+    except AttributeError as e:
+        # Esta version de Tweaker no expone lo que necesitamos para evaluar orientaciones sueltas
+        logging.warning("Couldn't refine the orientation ({}), using full resolution mode".format(e))
+        return tweak(triangles)
+    best = min(results, key=lambda r: r[UNPRINTABILITY])
+    # Actualizamos el resultado con la mejor orientacion, evaluada sobre la malla completa
+    x.alignment, x.bottom_area, x.overhang_area, x.contour, x.unprintability = best
+    x.matrix = evaluator.euler(best)[-1]
+    x.best_5 = sorted(results, key=lambda r: r[UNPRINTABILITY])[:5]
     return x
 
 
+def _create_evaluator(triangles):
+    # Instancia de Tweak que solo preprocesa la malla (sin ejecutar la busqueda), para evaluar orientaciones puntuales
+    Tweaker, ThreeMF, FileHandler = load_tweaker_modules()
+    evaluator = Tweaker.Tweak.__new__(Tweaker.Tweak)
+    evaluator.extended_mode = TWEAKER_SETTINGS['extended_mode']
+    evaluator.verbose = False
+    evaluator.show_progress = False
+    evaluator.mesh = evaluator.preprocess(mesh_artifact.tweaker_mesh(triangles))
+    return evaluator
 
 
+def _evaluate(evaluator, orientation):
+    # Versiones viejas de Tweaker-3 llaman project_verteces al metodo
+    project = getattr(evaluator, 'project_vertices', None) or evaluator.project_verteces
+    project(orientation)
+    bottom, overhang, contour = evaluator.calc_overhang(orientation, min_volume=TWEAKER_SETTINGS['volume'])
+    unprintability = evaluator.target_function(bottom, overhang, contour, min_volume=TWEAKER_SETTINGS['volume'])
+    return [orientation, bottom, overhang, contour, unprintability]
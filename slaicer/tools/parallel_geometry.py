@@ -0,0 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Analisis de mallas grandes en paralelo. Cada hilo trabaja sobre un bloque de caras, y los resultados parciales se
+combinan en el hilo que llama. Usamos hilos y no procesos: NumPy libera el GIL en las operaciones sobre arrays, los
+bloques son vistas de los arrays originales (no hay copias), y los hilos se pueden crear desde los procesos daemon del
+pool prefork de celery, que no pueden tener procesos hijos.
+'''
+
+
+def map_face_chunks(function, arrays, args=(), workers=1, chunk_size=250000):
+    """
+    Executes function(*[a[start:stop] for a in arrays], *args) for each chunk of faces, and returns the list of results.
+    arrays: per face arrays (same length). function should spend its time on NumPy array operations
+    """
+    count = len(arrays[0])
+    bounds = [(start, min(start + chunk_size, count)) for start in range(0, count, chunk_size)] or [(0, 0)]
+    chunks = [[a[start:stop] for a in arrays] for start, stop in bounds]
+    if workers <= 1 or len(chunks) == 1:
+        return [function(*chunk, *args) for chunk in chunks]
+    with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+        return list(executor.map(lambda chunk: function(*chunk, *args), chunks))
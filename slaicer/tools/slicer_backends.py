@@ -0,0 +1,98 @@
+import os
+import shutil
+import subprocess
+import collections
+import logging
+from django.conf import settings
+
+'''
+Slicers. Todos se ejecutan por linea de comandos, con la misma interfaz: un archivo ini de configuracion, los modelos, y
+el archivo de salida. La salida del proceso se lee linea por linea, mientras corre (ver on_line), asi podemos informar el
+progreso del sliceo. El backend se elige con SLICER_BACKEND:
+ - slic3r: Slic3r (perl), en slaicer/lib/Slic3r
+ - prusaslicer: PrusaSlicer (o SuperSlicer), en SLICER_PATH. Al ser un binario compilado, arranca mucho mas rapido que
+   el interprete de perl, lo que se nota en los sliceos chicos (ej., cotizaciones)
+La cantidad de sliceos simultaneos por host se limita con la concurrencia del worker de la cola slicer (ver run_celery.sh)
+'''
+
+SlicerRun = collections.namedtuple('SlicerRun', 'ok output returncode')
+
+
+class SlicerBackend:
+    name = None
+
+    def executable(self):
+        raise NotImplementedError
+
+    def command(self, ini_path, output_path, models_path, arranged=False):
+        # arranged: the models are already placed on the bed, so they're merged as they are
+        raise NotImplementedError
+
+    def succeeded(self, returncode, output, output_path):
+        return returncode == 0 and os.path.exists(output_path)
+
+    def run(self, ini_path, output_path, models_path, arranged=False, on_line=None):
+        executable = self.executable()
+        if executable is None or not os.path.exists(executable):
+            # Circular import: slaicer.models imports slaicer.tasks
+            from slaicer.models import LibrariesNotConfigured
+            raise LibrariesNotConfigured
+        command = self.command(ini_path, output_path, models_path, arranged)
+        logging.info(' '.join(command))
+        output = []
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+                                bufsize=1)
+        try:
+            for line in proc.stdout:
+                output.append(line)
+                if on_line is not None:
+                    on_line(line.rstrip())
+            returncode = proc.wait()
+        except BaseException:
+            # Task time limits, revocations, etc. We don't leave the slicer running
+            proc.kill()
+            proc.wait()
+            raise
+        finally:
+            proc.stdout.close()
+        output = ''.join(output)
+        return SlicerRun(self.succeeded(returncode, output, output_path), output, returncode)
+
+
+class Slic3rBackend(SlicerBackend):
+    name = 'slic3r'
+
+    def executable(self):
+        return os.path.join(settings.BASE_DIR, 'slaicer/lib/Slic3r/slic3r.pl')
+
+    def command(self, ini_path, output_path, models_path, arranged=False):
+        arrange = ['--merge', '--dont-arrange'] if arranged else []
+        return [self.executable(), '--load', ini_path, *arrange, '-o', output_path, *models_path]
+
+    def succeeded(self, returncode, output, output_path):
+        # Slic3r 1.x doesn't always set the exit status, so we also look for its final message
+        return 'Done' in output and os.path.exists(output_path)
+
+
+class PrusaSlicerBackend(SlicerBackend):
+    name = 'prusaslicer'
+
+    def executable(self):
+        return settings.SLICER_PATH or shutil.which('prusa-slicer') or shutil.which('superslicer')
+
+    def command(self, ini_path, output_path, models_path, arranged=False):
+        # Every model is printed on the same bed
+        arrange = ['--dont-arrange'] if arranged else []
+        return [self.executable(), '--export-gcode', '--load', ini_path, '--merge', *arrange, '--output', output_path,
+                *models_path]
+
+
+BACKENDS = {b.name: b for b in (Slic3rBackend, PrusaSlicerBackend)}
+
+
+def get_backend(name=None):
+    name = settings.SLICER_BACKEND if name is None else name
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError("Unknown slicer backend {}. Options: {}".format(name, ', '.join(BACKENDS)))
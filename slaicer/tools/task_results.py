@@ -0,0 +1,90 @@
+from django_celery_results.models import TaskResult
+from django.core.exceptions import ObjectDoesNotExist
+from celery import states
+
+'''
+Celery results lookups. Several models (TweakerResult, GeometryResult, SliceJob, Gcode, Schedule) consider themselves
+ready when their celery task reached a ready state. Instead of querying TaskResult for each object, resolve_task_status
+fetches the status of many objects with a single task_id__in query, and caches it on each instance, along with the task
+id it belongs to: if the task id changes, the cached status is ignored. Models using TaskStatusMixin also drop it on
+refresh_from_db, so long lived instances can look it up again.
+It's used by the scheduler snapshot, the admin list pages and the REST list serializers.
+'''
+
+# Used to tell apart "not resolved yet" from "resolved, but celery didn't store a result"
+_missing = object()
+# Instance attribute with the cached statuses, as {field: (task id, status)}
+CACHE_ATTRIBUTE = '_task_status_cache'
+
+
+def resolve_task_status(objects, field: str = 'celery_id'):
+    '''
+    Resolves the celery status of every object (identified by its field attribute) with one query. Accepts any
+    iterable of model instances, None values are skipped. Returns a dict task_id -> status
+    '''
+    objects = [o for o in objects if o is not None]
+    task_ids = set(str(getattr(o, field)) for o in objects if getattr(o, field) is not None)
+    found = dict(TaskResult.objects.filter(task_id__in=task_ids).values_list('task_id', 'status')) if task_ids else {}
+    for o in objects:
+        task_id = getattr(o, field)
+        task_id = str(task_id) if task_id is not None else None
+        o.__dict__.setdefault(CACHE_ATTRIBUTE, {})[field] = (task_id, found.get(task_id, _missing))
+    return found
+
+
+def clear_task_status(obj):
+    obj.__dict__.pop(CACHE_ATTRIBUTE, None)
+
+
+def task_status(obj, field: str = 'celery_id'):
+    # Status resolved in bulk (see resolve_task_status). Otherwise, we look it up with a single query
+    task_id = getattr(obj, field)
+    task_id = str(task_id) if task_id is not None else None
+    cached = obj.__dict__.get(CACHE_ATTRIBUTE, {}).get(field)
+    if cached is not None and cached[0] == task_id:
+        return None if cached[1] is _missing else cached[1]
+    if task_id is None:
+        return None
+    return TaskResult.objects.filter(task_id=task_id).values_list('status', flat=True).first()
+
+
+def task_ready(obj, field: str = 'celery_id') -> bool:
+    return task_status(obj, field) in states.READY_STATES
+
+
+class TaskStatusMixin:
+    # Model mixin. Reloading the instance drops its cached celery status
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        clear_task_status(self)
+
+
+def follow(obj, path: str):
+    # Follows a dotted relation path (i.e., 'connection.active_task.slicejob'). Missing relations return None
+    for attribute in [a for a in path.split('.') if a]:
+        if obj is None:
+            return None
+        try:
+            obj = getattr(obj, attribute)
+        except ObjectDoesNotExist:
+            return None
+    return obj
+
+
+def resolve_lookups(objects, lookups):
+    # lookups is a list of (relation path, celery id field). An empty path means the object itself
+    objects = list(objects)
+    for path, field in lookups:
+        resolve_task_status([follow(o, path) for o in objects], field)
+    return objects
+
+
+class ResolveTaskStatusAdminMixin:
+    # Resolves the celery status of the whole changelist page, with one query per lookup
+    task_status_lookups = ()
+
+    def get_changelist_instance(self, request):
+        cl = super().get_changelist_instance(request)
+        # Evaluating result_list fills the queryset cache, so the template renders these same instances
+        resolve_lookups(cl.result_list, self.task_status_lookups)
+        return cl
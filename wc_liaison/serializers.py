@@ -1,8 +1,9 @@
 from rest_framework import serializers
 from wc_liaison.models import Product, Attribute, Variation, Component, AttributeTerm, Order, OrderItem, Customer
-from skynet.models import Order as PoMaOrder, Piece, Material, Color, Filament
+from skynet.models import Order as PoMaOrder, Piece, Material, Color, Filament, OrderQuote
 from datetime import datetime, timedelta
 from django.utils import timezone
+from django.db import transaction
  # Serializers
 
 class AttributeSerializer(serializers.ModelSerializer):
@@ -170,6 +171,7 @@ class OrderSerializer(serializers.ModelSerializer):
         model = Order
         fields = ('customer', 'order_number', 'items')
 
+    @transaction.atomic
     def create(self, validated_data):
         # Get Client
         customer, created = Customer.objects.update_or_create(uuid=validated_data['customer']['uuid'], defaults={'first_name':validated_data['customer']['first_name'], 'last_name':validated_data['customer']['last_name'], 'email':validated_data['customer']['email'], 'username':validated_data['customer']['username']})
@@ -209,6 +211,8 @@ class OrderSerializer(serializers.ModelSerializer):
             # Create pieces from variation components
             for component in components:
                 piece = Piece(order=order, print_settings=component.print_settings, copies=component.quantity*item['quantity'], stl=component.stl, gcode=component.gcode, woocommerce_component=component)
+                # Pieces are quoted all together, with the order
+                piece.defer_quoting = True
                 piece.save()
 
                 # Add compatible colors and materials to piece
@@ -218,6 +222,10 @@ class OrderSerializer(serializers.ModelSerializer):
                 for material in compatible_materials:
                     piece.materials.add(material)
 
+        # Order level quoting (see skynet.models.OrderQuote). Its tasks read the pieces, so they're launched once they
+        # are committed
+        transaction.on_commit(lambda: OrderQuote.objects.quote_order(order))
+
         return wc_order
 
 